@@ -0,0 +1,42 @@
+"""Benchmarks for the gradient magnitude used by the podocyte watershed.
+
+Run with airspeed velocity (asv run) from the repository root.
+The ROI shapes are typical of the glomerulus crops in find_podocytes.
+"""
+import numpy as np
+
+from podocytes.image_processing import gradient_of_image
+
+
+def gradient_of_image_stacked(image):
+    """Previous implementation, kept for comparison."""
+    grad = np.gradient(image)  # gradients for individual directions
+    grad = np.stack(grad, axis=-1)  # from list of arrays to single numpy array
+    gradient_image = np.sum(abs(grad), axis=-1)
+    return gradient_image
+
+
+class GradientSuite(object):
+    params = ([(40, 120, 120), (60, 170, 170), (80, 250, 250)],
+              ['stacked', 'l1', 'l2', 'sobel'])
+    param_names = ['roi_shape', 'method']
+
+    def setup(self, roi_shape, method):
+        rng = np.random.RandomState(0)
+        self.image = rng.random_sample(roi_shape).astype(np.float32)
+        self.out = np.empty_like(self.image)
+
+    def _gradient(self, method):
+        if method == 'stacked':
+            return gradient_of_image_stacked(self.image)
+        return gradient_of_image(self.image, norm=method)
+
+    def time_gradient(self, roi_shape, method):
+        self._gradient(method)
+
+    def peakmem_gradient(self, roi_shape, method):
+        self._gradient(method)
+
+    def time_gradient_preallocated(self, roi_shape, method):
+        if method != 'stacked':
+            gradient_of_image(self.image, norm=method, out=self.out)
@@ -0,0 +1,18 @@
+"""Import time of the command line entry points, in a fresh interpreter.
+
+The headless command line interface (podocytes.cli) should not pay for
+the image processing libraries until a command runs, and no entry point
+should import Gooey, wx or matplotlib before they are needed.
+"""
+
+
+def timeraw_import_cli():
+    return "import podocytes.cli"
+
+
+def timeraw_import_cellcounter_xml():
+    return "import podocytes.cellcounter_xml"
+
+
+def timeraw_import_main():
+    return "import podocytes.main"
@@ -0,0 +1,202 @@
+"""Benchmarks for each stage of the glomeruli and podocyte segmentation.
+
+Run with airspeed velocity (asv run) from the repository root.
+Every stage is timed separately (time_*) and its peak memory tracked
+(peakmem_*), on synthetic volumes of different sizes and podocyte
+densities, plus the end-to-end process_image_series.
+"""
+import os
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from podocytes.image_processing import (count_labels,
+                                        crop_region_of_interest,
+                                        denoise_image,
+                                        filter_by_size,
+                                        find_glomeruli,
+                                        find_podocytes,
+                                        marker_controlled_watershed,
+                                        measure_glomerulus)
+from podocytes.statistics import (StatisticsAccumulator,
+                                  glom_statistics,
+                                  podocyte_avg_statistics,
+                                  podocyte_statistics,
+                                  summarize_statistics)
+
+from .synthetic import SyntheticReader, channel_frame, synthetic_volume
+
+SHAPES = [(40, 256, 256), (60, 512, 512)]
+DENSITIES = [20, 80]  # podocytes per glomerulus
+VOXEL_VOLUME = 0.5 * 0.5 * 1.0
+
+
+def pipeline_args(output_directory='.'):
+    """User input arguments for process_image_series."""
+    return argparse.Namespace(input_directory='.',
+                              output_directory=output_directory,
+                              glomeruli_channel_number=0,
+                              podocyte_channel_number=1,
+                              minimum_glomerular_diameter=30.0,
+                              maximum_glomerular_diameter=300.0,
+                              file_extension='.tif')
+
+
+class GlomeruliSuite(object):
+    """Whole volume stages: denoising, glomeruli labelling, size filter."""
+    params = [SHAPES]
+    param_names = ['shape']
+    timeout = 300
+
+    def setup(self, shape):
+        volume = synthetic_volume(shape)
+        self.glomeruli_view = channel_frame(volume, 0)
+        self.podocytes_view = channel_frame(volume, 1)
+        self.label_image = find_glomeruli(self.glomeruli_view)
+
+    def time_denoise_image(self, shape):
+        denoise_image(self.podocytes_view)
+
+    def peakmem_denoise_image(self, shape):
+        denoise_image(self.podocytes_view)
+
+    def time_find_glomeruli(self, shape):
+        find_glomeruli(self.glomeruli_view)
+
+    def peakmem_find_glomeruli(self, shape):
+        find_glomeruli(self.glomeruli_view)
+
+    def time_filter_by_size(self, shape):
+        filter_by_size(self.label_image, 30.0, 300.0)
+
+    def peakmem_filter_by_size(self, shape):
+        filter_by_size(self.label_image, 30.0, 300.0)
+
+
+class PodocyteSuite(object):
+    """Per glomerulus stages, for the first glomerulus in the volume."""
+    params = [SHAPES[:1], DENSITIES]
+    param_names = ['shape', 'podocytes_per_glomerulus']
+
+    def setup(self, shape, podocytes_per_glomerulus):
+        volume = synthetic_volume(
+            shape, podocytes_per_glomerulus=podocytes_per_glomerulus)
+        label_image = find_glomeruli(channel_frame(volume, 0))
+        self.glom = filter_by_size(label_image, 30.0, 300.0)[0]
+        self.podocytes_view = denoise_image(channel_frame(volume, 1))
+        self.image_roi = crop_region_of_interest(self.podocytes_view,
+                                                 self.glom.bbox, margin=10)
+        self.counts, self.centroid_offset, self.wshed = find_podocytes(
+            self.podocytes_view, self.glom)
+        self.blobs = np.column_stack([self.counts.centroid,
+                                      np.ones(len(self.counts.label))])
+
+    def time_crop_region_of_interest(self, shape, podocytes_per_glomerulus):
+        crop_region_of_interest(self.podocytes_view, self.glom.bbox, margin=10)
+
+    def time_find_podocytes(self, shape, podocytes_per_glomerulus):
+        find_podocytes(self.podocytes_view, self.glom)
+
+    def peakmem_find_podocytes(self, shape, podocytes_per_glomerulus):
+        find_podocytes(self.podocytes_view, self.glom)
+
+    def time_marker_controlled_watershed(self, shape,
+                                         podocytes_per_glomerulus):
+        marker_controlled_watershed(self.image_roi, self.blobs)
+
+    def peakmem_marker_controlled_watershed(self, shape,
+                                            podocytes_per_glomerulus):
+        marker_controlled_watershed(self.image_roi, self.blobs)
+
+    def time_count_labels(self, shape, podocytes_per_glomerulus):
+        count_labels(self.wshed)
+
+    def time_measure_glomerulus(self, shape, podocytes_per_glomerulus):
+        measure_glomerulus(self.glom)
+
+    def time_podocyte_statistics(self, shape, podocytes_per_glomerulus):
+        df = podocyte_statistics(self.counts, self.centroid_offset,
+                                 VOXEL_VOLUME)
+        df = podocyte_avg_statistics(df)
+        glom_statistics(df, self.glom, 0, VOXEL_VOLUME)
+
+    def time_statistics_accumulator(self, shape, podocytes_per_glomerulus):
+        accumulator = StatisticsAccumulator('synthetic.tif', 'Image:0',
+                                            'synthetic')
+        accumulator.add_glomerulus(self.glom, self.counts,
+                                   self.centroid_offset, VOXEL_VOLUME)
+        accumulator.to_dataframe()
+
+
+class SummarySuite(object):
+    """Summary statistics for a batch with many glomeruli."""
+    params = [[100, 2000]]
+    param_names = ['n_glomeruli']
+
+    def setup(self, n_glomeruli):
+        rng = np.random.RandomState(0)
+        n_rows = n_glomeruli * 40
+        glom_index = np.repeat(np.arange(n_glomeruli), 40)
+        self.detailed_stats = _detailed_stats(rng, n_rows, glom_index)
+        self.output_directory = tempfile.mkdtemp()
+        self.output_filename = os.path.join(self.output_directory,
+                                            'summary.csv')
+
+    def teardown(self, n_glomeruli):
+        if os.path.exists(self.output_filename):
+            os.remove(self.output_filename)
+        os.rmdir(self.output_directory)
+
+    def time_summarize_statistics(self, n_glomeruli):
+        summarize_statistics(self.detailed_stats, self.output_filename)
+
+    def peakmem_summarize_statistics(self, n_glomeruli):
+        summarize_statistics(self.detailed_stats, self.output_filename)
+
+
+class ProcessImageSeriesSuite(object):
+    """End-to-end processing of a single image series."""
+    params = [SHAPES, DENSITIES]
+    param_names = ['shape', 'podocytes_per_glomerulus']
+    timeout = 600
+
+    def setup(self, shape, podocytes_per_glomerulus):
+        from podocytes.main import process_image_series
+        self.process_image_series = process_image_series
+        self.volume = synthetic_volume(
+            shape, podocytes_per_glomerulus=podocytes_per_glomerulus)
+        self.args = pipeline_args()
+
+    def time_process_image_series(self, shape, podocytes_per_glomerulus):
+        images = SyntheticReader(self.volume)
+        self.process_image_series(images, 'synthetic.tif', self.args)
+
+    def peakmem_process_image_series(self, shape, podocytes_per_glomerulus):
+        images = SyntheticReader(self.volume)
+        self.process_image_series(images, 'synthetic.tif', self.args)
+
+
+def _detailed_stats(rng, n_rows, glom_index):
+    """Random detailed statistics table, shaped like run_program output."""
+    per_glom = {
+        'image_filename': 'synthetic.tif',
+        'image_series_name': 'synthetic',
+        'image_series_num': 'Image:0',
+        'glomeruli_index': glom_index,
+        'glomeruli_label_number': glom_index + 1,
+    }
+    n_glomeruli = glom_index.max() + 1
+    for column in ['glomeruli_voxel_number', 'glomeruli_volume',
+                   'glomeruli_equiv_diam_pixels', 'glomeruli_centroid_x',
+                   'glomeruli_centroid_y', 'glomeruli_centroid_z',
+                   'number_of_podocytes', 'avg_podocyte_voxel_number',
+                   'avg_podocyte_volume', 'podocyte_density']:
+        per_glom[column] = rng.random_sample(n_glomeruli)[glom_index]
+    for column in ['podocyte_label_number', 'podocyte_voxel_number',
+                   'podocyte_volume', 'podocyte_equiv_diam_pixels',
+                   'podocyte_centroid_x', 'podocyte_centroid_y',
+                   'podocyte_centroid_z']:
+        per_glom[column] = rng.random_sample(n_rows)
+    return pd.DataFrame(per_glom)
@@ -0,0 +1,100 @@
+"""Synthetic fluorescence volumes for benchmarking the segmentation pipeline.
+
+Glomeruli are bright ellipsoids in the glomeruli channel, placed on a grid,
+and podocytes are small bright blobs scattered inside each glomerulus in
+the podocyte channel. Both channels have background noise added.
+"""
+import numpy as np
+import pims
+from pims import FramesSequenceND
+from scipy import ndimage as ndi
+
+VOXEL_METADATA = {'mpp': 0.5, 'mppZ': 1.0}
+
+
+def synthetic_volume(shape=(40, 256, 256), glomerulus_radius=40,
+                     podocytes_per_glomerulus=40, seed=0):
+    """Return synthetic glomeruli and podocyte channel images.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of each channel volume (planes, rows, columns).
+    glomerulus_radius : int, optional
+        Radius of each glomerulus in the x-y plane, in pixels.
+        Glomeruli are tiled in x-y with a spacing of three radii.
+    podocytes_per_glomerulus : int, optional
+        Number of podocyte blobs placed inside each glomerulus.
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    volume : ndarray of uint8
+        Image array with 'zyxc' axes, glomeruli in channel 0 and podocytes
+        in channel 1.
+    """
+    rng = np.random.RandomState(seed)
+    glomeruli = np.zeros(shape, dtype=np.float32)
+    podocytes = np.zeros(shape, dtype=np.float32)
+    spacing = 3 * glomerulus_radius
+    z_radius = max(min(glomerulus_radius // 2, shape[0] // 2 - 2), 1)
+    zz, yy, xx = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    for y in range(spacing // 2, shape[1] - glomerulus_radius, spacing):
+        for x in range(spacing // 2, shape[2] - glomerulus_radius, spacing):
+            z = shape[0] // 2
+            inside = (((zz - z) / z_radius) ** 2 +
+                      ((yy - y) / glomerulus_radius) ** 2 +
+                      ((xx - x) / glomerulus_radius) ** 2) < 1
+            glomeruli[inside] = 1
+            for _ in range(podocytes_per_glomerulus):
+                offset = rng.uniform(-0.7, 0.7, 3)
+                pz = int(z + offset[0] * z_radius)
+                py = int(y + offset[1] * glomerulus_radius)
+                px = int(x + offset[2] * glomerulus_radius)
+                podocytes[pz - 2:pz + 3, py - 3:py + 4, px - 3:px + 4] = 1
+    glomeruli = ndi.gaussian_filter(glomeruli, 2) * 180
+    glomeruli += rng.random_sample(shape) * 40
+    podocytes = podocytes * 200 + rng.random_sample(shape) * 50
+    volume = np.stack([glomeruli, podocytes], axis=-1).astype(np.uint8)
+    return volume
+
+
+def channel_frame(volume, channel):
+    """Single channel of a synthetic volume, with pims metadata."""
+    metadata = dict(VOXEL_METADATA, axes='zyx')
+    return pims.Frame(np.ascontiguousarray(volume[..., channel]),
+                      metadata=metadata)
+
+
+class SyntheticReader(FramesSequenceND):
+    """pims reader for a synthetic 'zyxc' volume, like pims.Bioformats."""
+    def __init__(self, volume):
+        super(SyntheticReader, self).__init__()
+        self._volume = volume
+        self.series = 0
+        self.metadata = _SyntheticMetadata()
+        self._init_axis('z', volume.shape[0])
+        self._init_axis('y', volume.shape[1])
+        self._init_axis('x', volume.shape[2])
+        self._init_axis('c', volume.shape[3])
+        self._register_get_frame(self.get_frame_2D, 'yx')
+
+    @property
+    def pixel_type(self):
+        return self._volume.dtype
+
+    def get_frame_2D(self, **coords):
+        plane = self._volume[coords.get('z', 0), ..., coords.get('c', 0)]
+        return pims.Frame(plane, metadata=dict(VOXEL_METADATA))
+
+
+class _SyntheticMetadata(object):
+    def ImageCount(self):
+        return 1
+
+    def ImageID(self, series):
+        return f"Image:{series}"
+
+    def ImageName(self, series):
+        return 'synthetic'
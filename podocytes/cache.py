@@ -0,0 +1,397 @@
+"""Persistent on-disk caches of decoded images and intermediate results.
+
+Each decoded (file, series, channel) volume is stored as a .npy file
+and is memory-mapped when it is read back, so later runs do not need to
+decode the image file through Bio-Formats again. Cache entries are keyed
+by the image file path, modification time and size, so editing or
+replacing an image file automatically invalidates its cache entries.
+The least recently used volumes are removed once the cache grows beyond
+its maximum size.
+
+Intermediate results (denoised channels and glomeruli label images) are
+stored the same way, keyed by a hash of the input image content plus the
+parameters used to compute them.
+"""
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import pims
+
+from podocytes.chunked import denoise_image_chunked, find_glomeruli_chunked
+from podocytes.image_processing import (denoise_image,
+                                        find_glomeruli,
+                                        voxel_geometry)
+
+
+__all__ = ['array_cache_key',
+           'cached_intermediate',
+           'denoise_image_cached',
+           'evict_cache',
+           'file_cache_key',
+           'find_glomeruli_cached',
+           'load_cached_channel',
+           'load_manifest',
+           'save_cached_channel',
+           'save_manifest']
+
+MANIFEST_FILENAME = 'manifest.json'
+INTERMEDIATE_VERSION = 1  # increase to invalidate old intermediate results
+
+
+def file_cache_key(filename):
+    """Cache key for an image file, from its path, mtime and size.
+
+    Parameters
+    ----------
+    filename : str
+        Input image filename.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal hash string.
+    """
+    stat = os.stat(filename)
+    identity = f"{os.path.abspath(filename)}|{stat.st_mtime_ns}|{stat.st_size}"
+    key = hashlib.sha1(identity.encode('utf-8')).hexdigest()
+    return key
+
+
+def load_manifest(cache_directory, filename):
+    """Return cached image series information for a file, or None.
+
+    Parameters
+    ----------
+    cache_directory : str
+        Cache directory location.
+    filename : str
+        Input image filename.
+
+    Returns
+    -------
+    manifest : dict or None
+        Dictionary with a 'series' list, containing the 'id', 'name'
+        and 'n_channels' of each image series in the file.
+    """
+    manifest_filename = os.path.join(_file_directory(cache_directory, filename),
+                                     MANIFEST_FILENAME)
+    try:
+        with open(manifest_filename) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    return manifest
+
+
+def save_manifest(cache_directory, filename, manifest):
+    """Save image series information for a file to the cache.
+
+    Parameters
+    ----------
+    cache_directory : str
+        Cache directory location.
+    filename : str
+        Input image filename.
+    manifest : dict
+        Image series information, see load_manifest.
+    """
+    file_directory = _file_directory(cache_directory, filename)
+    os.makedirs(file_directory, exist_ok=True)
+    manifest = dict(manifest, filename=os.path.abspath(filename))
+    _atomic_write_json(os.path.join(file_directory, MANIFEST_FILENAME),
+                       manifest)
+
+
+def load_cached_channel(cache_directory, filename, series, channel):
+    """Return a cached channel volume as a memory-mapped array, or None.
+
+    Parameters
+    ----------
+    cache_directory : str
+        Cache directory location.
+    filename : str
+        Input image filename.
+    series : int
+        Image series number.
+    channel : int
+        Channel number (0-based indexing).
+
+    Returns
+    -------
+    volume : pims.Frame or None
+        Read-only memory-mapped image array with pims metadata,
+        or None if this channel is not in the cache.
+    """
+    array_filename, metadata_filename = _channel_filenames(
+        cache_directory, filename, series, channel)
+    try:
+        with open(metadata_filename) as metadata_file:
+            metadata = json.load(metadata_file)
+        volume = np.load(array_filename, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    os.utime(array_filename)  # mark as recently used
+    logging.debug(f"Read series {series}, channel {channel} from cache.")
+    return pims.Frame(volume, metadata=metadata)
+
+
+def save_cached_channel(cache_directory, filename, series, channel, volume):
+    """Save a decoded channel volume to the cache.
+
+    Parameters
+    ----------
+    cache_directory : str
+        Cache directory location.
+    filename : str
+        Input image filename.
+    series : int
+        Image series number.
+    channel : int
+        Channel number (0-based indexing).
+    volume : pims.Frame
+        Image array with pims metadata.
+
+    Returns
+    -------
+    volume : pims.Frame
+        Read-only memory-mapped copy of the volume, from the cache.
+    """
+    array_filename, metadata_filename = _channel_filenames(
+        cache_directory, filename, series, channel)
+    os.makedirs(os.path.dirname(array_filename), exist_ok=True)
+    metadata = {key: val for key, val in getattr(volume, 'metadata', {}).items()
+                if isinstance(val, (str, int, float, bool))}
+    _atomic_write_json(metadata_filename, metadata)
+    temporary_filename = f"{array_filename}.{os.getpid()}.tmp"
+    with open(temporary_filename, 'wb') as array_file:
+        np.save(array_file, np.asarray(volume))
+    os.replace(temporary_filename, array_filename)
+    cached = np.load(array_filename, mmap_mode='r')
+    return pims.Frame(cached, metadata=metadata)
+
+
+def evict_cache(cache_directory, cache_size):
+    """Remove least recently used volumes until the cache is small enough.
+
+    Parameters
+    ----------
+    cache_directory : str
+        Cache directory location.
+    cache_size : float
+        Maximum total size of the cached volumes, in gigabytes.
+
+    Returns
+    -------
+    n_evicted : int
+        Number of cached volumes removed.
+    """
+    entries = []
+    for root, _, files in os.walk(cache_directory):
+        for f in files:
+            if f.endswith('.npy'):
+                entry = os.path.join(root, f)
+                try:
+                    stat = os.stat(entry)
+                except OSError:
+                    continue  # removed by another process
+                entries.append((stat.st_mtime, stat.st_size, entry))
+    total_size = sum(size for _, size, _ in entries)
+    n_evicted = 0
+    for _, size, entry in sorted(entries):
+        if total_size <= cache_size * 1e9:
+            break
+        for stale_filename in [entry, entry[:-len('.npy')] + '.json']:
+            try:
+                os.remove(stale_filename)
+            except OSError:
+                pass
+        total_size -= size
+        n_evicted += 1
+    if n_evicted > 0:
+        logging.info(f"Removed {n_evicted} volumes from image cache.")
+    return n_evicted
+
+
+def array_cache_key(image, **params):
+    """Cache key for an image array plus the parameters used to process it.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image array.
+    **params : optional
+        Processing parameters. Must be serializable as json.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal hash string.
+    """
+    image = np.asarray(image)
+    hasher = hashlib.sha1()
+    hasher.update(f"{image.shape}|{image.dtype.str}".encode('utf-8'))
+    for plane in image.reshape((-1,) + image.shape[-2:]):
+        hasher.update(np.ascontiguousarray(plane).data)  # one plane at a time
+    params = dict(params, version=INTERMEDIATE_VERSION)
+    hasher.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    key = hasher.hexdigest()
+    return key
+
+
+def cached_intermediate(intermediate_directory, function, image,
+                        function_kwargs=None, extra_kwargs=None, **params):
+    """Return function(image), computed once and then loaded from disk.
+
+    Parameters
+    ----------
+    intermediate_directory : str
+        Directory where intermediate results are saved.
+    function : callable
+        Function to compute the intermediate result from the image.
+    image : ndarray
+        Input image array.
+    function_kwargs : dict, optional
+        Keyword arguments passed on to function. These are part of the
+        cache key, so must be serializable as json.
+    extra_kwargs : dict, optional
+        Keyword arguments passed on to function that do not change its
+        result, eg: a directory for temporary files. These are not part
+        of the cache key.
+    **params : optional
+        Any other parameters that change the output of function(image),
+        for example values derived from the image metadata.
+        These are part of the cache key.
+
+    Returns
+    -------
+    result : ndarray
+        Output of function(image), memory-mapped if read from the cache.
+    """
+    function_kwargs = function_kwargs or {}
+    key = array_cache_key(image, function=function.__name__,
+                          function_kwargs=function_kwargs, **params)
+    result_filename = os.path.join(intermediate_directory,
+                                   f"{function.__name__}_{key}.npy")
+    try:
+        result = np.load(result_filename, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    else:
+        logging.info(f"Loaded {function.__name__} result from "
+                     f"{result_filename}")
+        return result
+    result = function(image, **function_kwargs, **(extra_kwargs or {}))
+    os.makedirs(intermediate_directory, exist_ok=True)
+    temporary_filename = f"{result_filename}.{os.getpid()}.tmp"
+    with open(temporary_filename, 'wb') as result_file:
+        np.save(result_file, np.asarray(result))
+    os.replace(temporary_filename, result_filename)
+    return result
+
+
+def denoise_image_cached(image, intermediate_directory=None,
+                         dtype=np.float32, geometry=None, chunk_size=None,
+                         directory=None):
+    """denoise_image, reusing a saved result from an earlier run if possible.
+
+    Parameters
+    ----------
+    image : 3D ndarray
+        Original image data from a single fluorescence channel.
+    intermediate_directory : str, optional
+        Directory where intermediate results are saved.
+        If None (default), nothing is saved or reused.
+    dtype : numpy dtype, optional
+        Floating point precision of the output, see denoise_image.
+    geometry : VoxelGeometry, optional
+        Physical voxel size, see denoise_image.
+    chunk_size : int or tuple of int, optional
+        If given, denoise the image one chunk at a time with
+        denoise_image_chunked, for volumes larger than memory.
+    directory : str, optional
+        Directory for temporary memory-mapped arrays, if chunk_size is given.
+        Not part of the cache key.
+
+    Returns
+    -------
+    denoised : 3D ndarray
+        Image denoised by slight gaussian blur.
+    """
+    geometry = geometry or voxel_geometry(image)
+    function = denoise_image
+    function_kwargs = {'dtype': np.dtype(dtype).name, 'geometry': geometry}
+    extra_kwargs = {}
+    if chunk_size:
+        function = denoise_image_chunked
+        function_kwargs['chunk_size'] = chunk_size
+        extra_kwargs['directory'] = directory
+    if intermediate_directory is None:
+        return function(image, **function_kwargs, **extra_kwargs)
+    return cached_intermediate(intermediate_directory, function, image,
+                               function_kwargs, extra_kwargs)
+
+
+def find_glomeruli_cached(glomeruli_view, intermediate_directory=None,
+                          dtype=np.float32, geometry=None, chunk_size=None,
+                          directory=None):
+    """find_glomeruli, reusing a saved result from an earlier run if possible.
+
+    Parameters
+    ----------
+    glomeruli_view : 3D ndarray
+        Image array of glomeruli fluorescence channel.
+    intermediate_directory : str, optional
+        Directory where intermediate results are saved.
+        If None (default), nothing is saved or reused.
+    dtype : numpy dtype, optional
+        Floating point precision used for denoising, see denoise_image.
+    geometry : VoxelGeometry, optional
+        Physical voxel size, see denoise_image.
+    chunk_size : int or tuple of int, optional
+        If given, find glomeruli one chunk at a time with
+        find_glomeruli_chunked, for volumes larger than memory.
+    directory : str, optional
+        Directory for temporary memory-mapped arrays, if chunk_size is given.
+        Not part of the cache key.
+
+    Returns
+    -------
+    label_image : 3D ndarray
+        Label image identifying fluorescence regions in glomeruli channel.
+    """
+    geometry = geometry or voxel_geometry(glomeruli_view)
+    function = find_glomeruli
+    function_kwargs = {'dtype': np.dtype(dtype).name, 'geometry': geometry}
+    extra_kwargs = {}
+    if chunk_size:
+        function = find_glomeruli_chunked
+        function_kwargs['chunk_size'] = chunk_size
+        extra_kwargs['directory'] = directory
+    if intermediate_directory is None:
+        return function(glomeruli_view, **function_kwargs, **extra_kwargs)
+    return cached_intermediate(intermediate_directory, function,
+                               glomeruli_view, function_kwargs, extra_kwargs,
+                               threshold='yen')
+
+
+def _file_directory(cache_directory, filename):
+    """Cache subdirectory for a single image file."""
+    return os.path.join(cache_directory, file_cache_key(filename))
+
+
+def _channel_filenames(cache_directory, filename, series, channel):
+    """Array and metadata filenames for a cached channel volume."""
+    basename = os.path.join(_file_directory(cache_directory, filename),
+                            f"series{series}_channel{channel}")
+    return basename + '.npy', basename + '.json'
+
+
+def _atomic_write_json(output_filename, content):
+    """Write json file so that readers never see a partially written file."""
+    temporary_filename = f"{output_filename}.{os.getpid()}.tmp"
+    with open(temporary_filename, 'w') as output_file:
+        json.dump(content, output_file)
+    os.replace(temporary_filename, output_filename)
@@ -1,13 +1,14 @@
 import os
 import logging
-import xml.etree.ElementTree as ET
 
-import numpy as np
 import pandas as pd
-from gooey.python_bindings.gooey_decorator import Gooey as gooey
-from gooey.python_bindings.gooey_parser import GooeyParser
 
-from podocytes.util import log_file_begins, find_files, marker_coords
+from podocytes.parallel import process_pool
+from podocytes.util import (configure_parser_cellcounter,
+                            gooey,
+                            log_file_begins,
+                            find_files,
+                            iterparse_markers)
 
 
 def main(args):
@@ -30,14 +31,9 @@ def configure_parser():
     args : argparse arguments
         Parsed user input arguments.
     """
+    from gooey.python_bindings.gooey_parser import GooeyParser
     parser = GooeyParser(prog='Podocyte Profiler', description=__DESCR__)
-    parser.add_argument('input_directory', widget='DirChooser',
-                        help='Folder containing files for processing.')
-    parser.add_argument('output_directory', widget='DirChooser',
-                        help='Folder to save output analysis files.')
-    parser.add_argument('number_of_image_channels',
-                        help='Total number of color channels in image.',
-                        type=int, default=2)
+    parser = configure_parser_cellcounter(parser)
     return parser
 
 
@@ -53,30 +49,47 @@ def process_folder(args):
     counts : pandas dataframe with summarized results from CellCounter xml.
     """
     marker_files = find_files(args.input_directory, '.xml')
-    contents = []
     column_names = ['filename',
                     'xml_image_name',
                     'mouse',
                     'glom_id',
                     'n_podocytes']
-    for xml_filename in marker_files:
-        mouse = os.path.basename(os.path.dirname(xml_filename))
-        glom_id = os.path.splitext(os.path.basename(xml_filename))[0][-2:]
-        xml_tree = ET.parse(xml_filename)
-        xml_image_name = xml_tree.find('.//Image_Filename').text
-        markers = marker_coords(xml_tree, args.number_of_image_channels)
-        n_podocytes = len(markers)
+    workers = getattr(args, 'workers', 1)
+    if workers > 1:
+        with process_pool(workers) as pool:
+            chunksize = max(1, len(marker_files) // (4 * workers))
+            contents = list(pool.map(count_markers, marker_files,
+                                     chunksize=chunksize))
+    else:
+        contents = [count_markers(xml_filename)
+                    for xml_filename in marker_files]
+    for xml_filename, _, _, _, n_podocytes in contents:
         logging.info(f"{n_podocytes} markers counted from file: "
                      f"{xml_filename}")
-        contents.append([xml_filename,
-                         xml_image_name,
-                         mouse,
-                         glom_id,
-                         n_podocytes])
     counts = pd.DataFrame(contents, columns=column_names)
     return counts
 
 
+def count_markers(xml_filename):
+    """Count the markers in a single CellCounter xml file.
+
+    Parameters
+    ----------
+    xml_filename : str
+        CellCounter xml filename.
+
+    Returns
+    -------
+    row : list
+        Filename, image name, mouse, glomerulus id and number of markers.
+    """
+    mouse = os.path.basename(os.path.dirname(xml_filename))
+    glom_id = os.path.splitext(os.path.basename(xml_filename))[0][-2:]
+    xml_image_name, coords = iterparse_markers(xml_filename)
+    n_podocytes = len(coords['MarkerX'])
+    return [xml_filename, xml_image_name, mouse, glom_id, n_podocytes]
+
+
 if __name__ == "__main__":
     parser = configure_parser()
     args = parser.parse_args()
@@ -0,0 +1,174 @@
+"""Per image series checkpoints, so interrupted batch runs can be resumed.
+
+The statistics for each image series are written to their own csv file as
+soon as the series has been processed, then the (file, series) pair is
+appended to a manifest of completed work. A series only counts as done
+once it is listed in the manifest, so a run that is killed part way
+through writing a checkpoint simply processes that series again.
+
+The user input arguments that change the statistics are saved next to the
+manifest, and a run can only be resumed with the same arguments. The
+checkpoints are removed once the whole run has finished.
+"""
+import os
+import csv
+import json
+import shutil
+import hashlib
+import logging
+
+import pandas as pd
+
+from podocytes._version import __version__
+
+
+__all__ = ['Checkpoint',
+           'run_parameters']
+
+MANIFEST_FILENAME = 'completed_series.csv'
+PARAMETERS_FILENAME = 'run_parameters.json'
+
+# User input arguments that change the statistics of an image series
+RUN_PARAMETERS = ['glomeruli_channel_number',
+                  'podocyte_channel_number',
+                  'minimum_glomerular_diameter',
+                  'maximum_glomerular_diameter',
+                  'precision']
+
+
+def run_parameters(args):
+    """Return the user input arguments that change the statistics.
+
+    Parameters
+    ----------
+    args : user input arguments
+
+    Returns
+    -------
+    parameters : dict
+        Argument values, plus the podocytes version number.
+    """
+    parameters = {name: getattr(args, name, None) for name in RUN_PARAMETERS}
+    parameters['precision'] = getattr(args, 'precision', 'float32')
+    parameters['version'] = __version__
+    return parameters
+
+
+class Checkpoint(object):
+    """Record of the image series completed so far in a batch run.
+
+    Parameters
+    ----------
+    directory : str
+        Folder to keep checkpoint files in.
+    resume : bool, optional
+        If True, continue from the checkpoints already in the directory.
+        If False (default), any existing checkpoints are removed.
+    parameters : dict, optional
+        User input arguments of this run, see run_parameters.
+
+    Raises
+    ------
+    ValueError
+        If resuming from checkpoints made with different parameters.
+    """
+    def __init__(self, directory, resume=False, parameters=None):
+        self.directory = directory
+        if not resume and os.path.isdir(directory):
+            logging.info(f"Removing old checkpoints from {directory}")
+            shutil.rmtree(directory)
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_filename = os.path.join(directory, MANIFEST_FILENAME)
+        self.completed = self._read_manifest()
+        self._check_parameters(parameters or {})
+        if len(self.completed) > 0:
+            logging.info(f"Resuming run, {len(self.completed)} image series "
+                         "already completed.")
+
+    def is_complete(self, filename, series):
+        """Return True if this image series has already been processed."""
+        return (os.path.abspath(filename), series) in self.completed
+
+    def load(self, filename, series):
+        """Return the saved statistics for a completed image series.
+
+        Returns
+        -------
+        single_image_stats : DataFrame or None
+            None if no glomeruli were found in the image series.
+        """
+        stats_filename = self.completed[(os.path.abspath(filename), series)]
+        if not stats_filename:
+            return None
+        single_image_stats = pd.read_csv(
+            os.path.join(self.directory, stats_filename), index_col=0)
+        return single_image_stats
+
+    def save(self, filename, series, single_image_stats):
+        """Save the statistics for an image series and mark it as complete.
+
+        Parameters
+        ----------
+        filename : str
+            Input image filename.
+        series : int
+            Image series number.
+        single_image_stats : DataFrame or None
+            Statistics for the image series.
+        """
+        filename = os.path.abspath(filename)
+        if single_image_stats is None:
+            stats_filename = ''
+        else:
+            file_key = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+            stats_filename = f"{file_key}_series{series}.csv"
+            output_filename = os.path.join(self.directory, stats_filename)
+            single_image_stats.to_csv(output_filename + '.tmp')
+            os.replace(output_filename + '.tmp', output_filename)
+        with open(self.manifest_filename, 'a', newline='') as manifest_file:
+            csv.writer(manifest_file).writerow([filename, series,
+                                                stats_filename])
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        self.completed[(filename, series)] = stats_filename
+
+    def remove(self):
+        """Remove all the checkpoints, eg: once the whole run has finished."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.completed = {}
+
+    def _check_parameters(self, parameters):
+        parameters = json.loads(json.dumps(parameters))  # eg: tuples
+        parameters_filename = os.path.join(self.directory, PARAMETERS_FILENAME)
+        if os.path.exists(parameters_filename):
+            with open(parameters_filename) as parameters_file:
+                saved_parameters = json.load(parameters_file)
+        elif len(self.completed) > 0:
+            saved_parameters = {}  # unknown, from an older version
+        else:
+            with open(parameters_filename, 'w') as parameters_file:
+                json.dump(parameters, parameters_file)
+            return
+        different = sorted(name for name in set(parameters) |
+                           set(saved_parameters)
+                           if parameters.get(name) !=
+                           saved_parameters.get(name))
+        if different:
+            raise ValueError(f"Cannot resume from the checkpoints in "
+                             f"{self.directory}, they were made with "
+                             f"different {', '.join(different)}. "
+                             f"Run again without --resume to start over.")
+
+    def _read_manifest(self):
+        completed = {}
+        if os.path.exists(self.manifest_filename):
+            with open(self.manifest_filename, newline='') as manifest_file:
+                for row in csv.reader(manifest_file):
+                    if len(row) != 3:
+                        continue  # skip any partially written line
+                    filename, series, stats_filename = row
+                    if stats_filename and not os.path.exists(
+                            os.path.join(self.directory, stats_filename)):
+                        continue
+                    completed[(filename, int(series))] = stats_filename
+        return completed
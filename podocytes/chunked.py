@@ -0,0 +1,338 @@
+"""Chunked, out-of-core versions of the glomeruli segmentation steps.
+
+Whole channel volumes are processed one block at a time, so peak memory
+depends on the chunk size rather than the size of the image volume.
+Large intermediate arrays can be kept in anonymous memory-mapped files
+on disk, by passing a directory to the functions below.
+"""
+import itertools
+import tempfile
+
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.measure import label
+
+from podocytes.image_processing import as_float, voxel_geometry
+
+
+__all__ = ['denoise_image_chunked',
+           'empty_array',
+           'find_glomeruli_chunked',
+           'gaussian_chunked',
+           'iter_chunks',
+           'label_chunked',
+           'threshold_yen_chunked']
+
+
+def iter_chunks(shape, chunk_size):
+    """Yield tuples of slices that tile an array of the given shape.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the whole array.
+    chunk_size : int or tuple of int
+        Maximum chunk size along each axis.
+
+    Yields
+    ------
+    chunk : tuple of slice
+    """
+    chunk_shape = _chunk_shape(shape, chunk_size)
+    starts = [range(0, size, step) for size, step in zip(shape, chunk_shape)]
+    for start in itertools.product(*starts):
+        yield tuple(slice(begin, min(begin + step, size))
+                    for begin, step, size in zip(start, chunk_shape, shape))
+
+
+def empty_array(shape, dtype, directory=None):
+    """Empty array in memory, or memory-mapped to an anonymous temp file.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the array.
+    dtype : numpy dtype
+        Data type of the array.
+    directory : str, optional
+        If given, the array is a temporary memory-mapped file created in
+        this directory, which is deleted once the array is no longer used.
+
+    Returns
+    -------
+    array : ndarray or np.memmap
+    """
+    if directory is None:
+        return np.empty(shape, dtype=dtype)
+    temporary_file = tempfile.TemporaryFile(dir=directory)
+    return np.memmap(temporary_file, dtype=dtype, mode='w+', shape=shape)
+
+
+def gaussian_chunked(image, sigma, chunk_size, truncate=4.0, directory=None,
+                     dtype=np.float32):
+    """Gaussian blur applied blockwise with halo overlap.
+
+    Gives the same result as skimage.filters.gaussian (with mode='nearest')
+    on an image converted with as_float,
+    because every chunk is blurred together with a halo of neighbouring
+    voxels as wide as the gaussian kernel radius.
+
+    Parameters
+    ----------
+    image : 3D ndarray
+        Input image. Can be a memory-mapped array.
+    sigma : float or sequence of float
+        Standard deviation of the gaussian kernel for each axis.
+    chunk_size : int or tuple of int
+        Maximum chunk size along each axis (not including the halo).
+    truncate : float, optional
+        Truncate the gaussian kernel at this many standard deviations.
+    directory : str, optional
+        If given, the output array is a temporary memory-mapped file
+        created in this directory instead of being held in memory.
+    dtype : numpy dtype, optional
+        Floating point precision of the output, np.float32 (default)
+        or np.float64.
+
+    Returns
+    -------
+    blurred : 3D ndarray of float
+        Blurred image.
+    """
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (image.ndim,))
+    halo = [int(truncate * sd + 0.5) for sd in sigma]
+    blurred = empty_array(image.shape, dtype, directory)
+    for chunk in iter_chunks(image.shape, chunk_size):
+        outer = tuple(slice(max(sl.start - h, 0), min(sl.stop + h, size))
+                      for sl, h, size in zip(chunk, halo, image.shape))
+        inner = tuple(slice(sl.start - out.start, sl.stop - out.start)
+                      for sl, out in zip(chunk, outer))
+        block = as_float(np.asarray(image[outer]), dtype)
+        block = ndi.gaussian_filter(block, sigma, mode='nearest',
+                                    truncate=truncate)
+        blurred[chunk] = block[inner]
+    return blurred
+
+
+def denoise_image_chunked(image, chunk_size, directory=None,
+                          dtype=np.float32, geometry=None):
+    """Chunked version of denoise_image, for volumes larger than memory.
+
+    Parameters
+    ----------
+    image : 3D ndarray
+        Original image data from a single fluorescence channel,
+        with pims metadata.
+    chunk_size : int or tuple of int
+        Maximum chunk size along each axis.
+    directory : str, optional
+        Directory for the temporary memory-mapped output array.
+    dtype : numpy dtype, optional
+        Floating point precision of the output, see denoise_image.
+    geometry : VoxelGeometry, optional
+        Physical voxel size, see denoise_image.
+
+    Returns
+    -------
+    denoised : 3D ndarray
+        Image denoised by slight gaussian blur.
+    """
+    geometry = geometry or voxel_geometry(image)
+    denoised = gaussian_chunked(image, geometry.sigma, chunk_size,
+                                directory=directory, dtype=dtype)
+    return denoised
+
+
+def threshold_yen_chunked(image, chunk_size, nbins=256):
+    """Yen threshold computed from a histogram streamed over chunks.
+
+    Gives the same result as skimage.filters.threshold_yen on a
+    floating point image, without holding the whole image in memory.
+    The chunks are read twice: once to find the intensity range, then
+    again to count the histogram bins, which depend on that range.
+
+    Parameters
+    ----------
+    image : 3D ndarray
+        Input image. Can be a memory-mapped array.
+    chunk_size : int or tuple of int
+        Maximum chunk size along each axis.
+    nbins : int, optional
+        Number of histogram bins.
+
+    Returns
+    -------
+    threshold : float
+        Upper threshold value. Voxels above this value are foreground.
+    """
+    image_min, image_max = np.inf, -np.inf
+    for chunk in iter_chunks(image.shape, chunk_size):
+        block = np.asarray(image[chunk])  # one read for both min and max
+        image_min = min(image_min, block.min())
+        image_max = max(image_max, block.max())
+    counts = np.zeros(nbins, dtype=np.int64)
+    for chunk in iter_chunks(image.shape, chunk_size):
+        chunk_counts, bin_edges = np.histogram(image[chunk], bins=nbins,
+                                               range=(image_min, image_max))
+        counts += chunk_counts
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2.
+    return _threshold_yen_from_histogram(counts, bin_centers)
+
+
+def _threshold_yen_from_histogram(counts, bin_centers):
+    """Yen threshold from histogram counts, as in scikit-image."""
+    if bin_centers.size == 1:
+        return bin_centers[0]
+    pmf = counts.astype('float32', copy=False) / counts.sum()
+    P1 = np.cumsum(pmf)  # cumulative normalized histogram
+    P1_sq = np.cumsum(pmf ** 2)
+    P2_sq = np.cumsum(pmf[::-1] ** 2)[::-1]
+    crit = np.log(((P1_sq[:-1] * P2_sq[1:]) ** -1) *
+                  (P1[:-1] * (1.0 - P1[:-1])) ** 2)
+    return bin_centers[crit.argmax()]
+
+
+def label_chunked(image, threshold, chunk_size, connectivity=None,
+                  directory=None):
+    """Label connected components of image > threshold, chunk by chunk.
+
+    Each chunk is labelled separately, then labels touching across the
+    chunk seams are merged. The final labels are numbered in raster order,
+    so the output is identical to skimage.measure.label on the whole image.
+
+    Parameters
+    ----------
+    image : 3D ndarray
+        Input image. Can be a memory-mapped array.
+    threshold : float
+        Voxels with values above the threshold are foreground.
+    chunk_size : int or tuple of int
+        Maximum chunk size along each axis.
+    connectivity : int, optional
+        Maximum number of orthogonal hops to consider a voxel a neighbour.
+        Defaults to full connectivity, like skimage.measure.label.
+    directory : str, optional
+        Directory for the temporary memory-mapped output array.
+
+    Returns
+    -------
+    label_image : 3D ndarray of int32
+        Label image identifying connected foreground regions.
+    """
+    ndim = image.ndim
+    if connectivity is None:
+        connectivity = ndim
+    label_image = empty_array(image.shape, np.int32, directory)
+    chunks = list(iter_chunks(image.shape, chunk_size))
+    # Label each chunk separately, with labels unique across chunks
+    first_voxel = [-1]  # label zero is the background, numbered first
+    n_labels = 0
+    for chunk in chunks:
+        chunk_labels, chunk_n_labels = label(image[chunk] > threshold,
+                                             connectivity=connectivity,
+                                             return_num=True)
+        chunk_labels = chunk_labels.astype(np.int32, copy=False)
+        labels, index = np.unique(chunk_labels, return_index=True)
+        index = index[labels > 0]
+        coords = np.unravel_index(index, chunk_labels.shape)
+        coords = tuple(coord + sl.start for coord, sl in zip(coords, chunk))
+        first_voxel.extend(np.ravel_multi_index(coords, image.shape))
+        chunk_labels[chunk_labels > 0] += n_labels
+        label_image[chunk] = chunk_labels
+        n_labels += chunk_n_labels
+    # Merge labels connected across chunk seams
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for chunk in chunks:
+        for axis in range(ndim):
+            if chunk[axis].start > 0:
+                pairs.append(_seam_label_pairs(label_image, chunk, axis,
+                                               connectivity))
+    pairs = np.concatenate(pairs)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(n_labels + 1, n_labels + 1))
+    _, components = connected_components(graph, directed=False)
+    # Number the merged labels in raster order, like skimage.measure.label
+    component_first_voxel = np.full(components.max() + 1,
+                                    np.iinfo(np.int64).max)
+    np.minimum.at(component_first_voxel, components,
+                  np.array(first_voxel, dtype=np.int64))
+    order = np.argsort(component_first_voxel, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    relabel = rank[components].astype(np.int32)
+    for chunk in chunks:
+        label_image[chunk] = relabel[label_image[chunk]]
+    return label_image
+
+
+def find_glomeruli_chunked(glomeruli_view, chunk_size, directory=None,
+                           dtype=np.float32, geometry=None):
+    """Chunked version of find_glomeruli, for volumes larger than memory.
+
+    Parameters
+    ----------
+    glomeruli_view : 3D ndarray
+        Image array of glomeruli fluorescence channel, with pims metadata.
+    chunk_size : int or tuple of int
+        Maximum chunk size along each axis.
+    directory : str, optional
+        Directory for temporary memory-mapped arrays.
+    dtype : numpy dtype, optional
+        Floating point precision used for denoising, see denoise_image.
+    geometry : VoxelGeometry, optional
+        Physical voxel size, see denoise_image.
+
+    Returns
+    -------
+    label_image : 3D ndarray
+        Label image identifying fluorescence regions in glomeruli channel.
+    """
+    denoised = denoise_image_chunked(glomeruli_view, chunk_size,
+                                     directory=directory, dtype=dtype,
+                                     geometry=geometry)
+    threshold = threshold_yen_chunked(denoised, chunk_size)
+    label_image = label_chunked(denoised, threshold, chunk_size,
+                                directory=directory)
+    return label_image
+
+
+def _seam_label_pairs(label_image, chunk, axis, connectivity):
+    """Pairs of labels that touch across the lower seam of a chunk."""
+    ndim = label_image.ndim
+    face = list(chunk)
+    face[axis] = chunk[axis].start
+    inner_face = label_image[tuple(face)]
+    # The neighbouring face is one voxel larger on every side, so that
+    # diagonal neighbours across the seam are also included.
+    neighbour = [slice(max(sl.start - 1, 0), min(sl.stop + 1, size))
+                 for sl, size in zip(chunk, label_image.shape)]
+    neighbour[axis] = chunk[axis].start - 1
+    neighbour_face = np.zeros([s + 2 for s in inner_face.shape],
+                              dtype=label_image.dtype)
+    pad = tuple(slice(sl.start - (chunk_sl.start - 1),
+                      sl.stop - (chunk_sl.start - 1))
+                for sl, chunk_sl, dim in zip(neighbour, chunk, range(ndim))
+                if dim != axis)
+    neighbour_face[pad] = label_image[tuple(neighbour)]
+    pairs = []
+    for offset in itertools.product((-1, 0, 1), repeat=ndim - 1):
+        if np.count_nonzero(offset) + 1 > connectivity:
+            continue
+        shifted = neighbour_face[tuple(slice(1 + o, 1 + o + size)
+                                       for o, size in zip(offset,
+                                                          inner_face.shape))]
+        touching = (inner_face > 0) & (shifted > 0)
+        pairs.append(np.stack([inner_face[touching], shifted[touching]],
+                              axis=-1))
+    pairs = np.unique(np.concatenate(pairs).astype(np.int64), axis=0)
+    return pairs
+
+
+def _chunk_shape(shape, chunk_size):
+    """Chunk shape for an array, from an int or tuple chunk size."""
+    chunk_shape = np.broadcast_to(np.asarray(chunk_size, dtype=int),
+                                  (len(shape),))
+    return tuple(int(min(step, size)) if size > 0 else 1
+                 for step, size in zip(chunk_shape, shape))
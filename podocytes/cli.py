@@ -0,0 +1,99 @@
+"""Command line interface, without the Gooey graphical user interface.
+
+For machines without a display, such as cluster nodes::
+
+    python -m podocytes.cli run input_dir output_dir 1 2 30 300 .lif
+    python -m podocytes.cli validate input_dir output_dir 1 2 30 300 .lif \
+        .xml counts_dir
+    python -m podocytes.cli count-markers input_dir output_dir 2
+
+Only argparse and podocytes.util are imported to parse the arguments.
+The image processing modules are imported once a command is chosen,
+and Gooey, wx and matplotlib are never imported.
+"""
+import sys
+import argparse
+
+from podocytes.__init__ import __version__
+from podocytes.util import (configure_parser_cellcounter,
+                            configure_parser_main,
+                            configure_parser_validate,
+                            log_file_begins,
+                            log_file_ends,
+                            parse_args)
+
+
+__all__ = ['configure_parser',
+           'main']
+
+__DESCR__ = ('Load, segment, count, and measure glomeruli and podocytes in '
+             f'fluorescence images.\nVersion {__version__}')
+
+
+def configure_parser():
+    """Configure parser with a subcommand for each program.
+
+    Returns
+    -------
+    parser : argparse.ArgumentParser
+        Parser for the run, validate and count-markers subcommands.
+    """
+    parser = argparse.ArgumentParser(prog='podocytes', description=__DESCR__)
+    parser.add_argument('--version', action='version', version=__version__)
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+    run_parser = subparsers.add_parser(
+        'run', help='Count and measure podocytes in each glomerulus.')
+    configure_parser_main(run_parser)
+    run_parser.set_defaults(function=run)
+    validate_parser = subparsers.add_parser(
+        'validate',
+        help='Compare podocyte counts with CellCounter marker files.')
+    configure_parser_validate(validate_parser)
+    validate_parser.set_defaults(function=validate)
+    count_parser = subparsers.add_parser(
+        'count-markers',
+        help='Count the number of markers in CellCounter xml files.')
+    configure_parser_cellcounter(count_parser)
+    count_parser.set_defaults(function=count_markers)
+    return parser
+
+
+def run(args):
+    """Count and measure podocytes, see podocytes.main."""
+    from podocytes.main import run_program
+    return run_program(args)
+
+
+def validate(args):
+    """Compare podocyte counts with CellCounter files, see podocytes.validate.
+    """
+    from podocytes import validate as validation
+    time_start = log_file_begins(args)
+    podocyte_comparison_stats = validation.main(args)
+    log_file_ends(time_start)
+    return podocyte_comparison_stats
+
+
+def count_markers(args):
+    """Count CellCounter markers, see podocytes.cellcounter_xml."""
+    from podocytes import cellcounter_xml
+    log_file_begins(args)
+    return cellcounter_xml.main(args)
+
+
+def main(argv=None):
+    """Parse command line arguments and run the chosen program.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        Command line arguments. Default is sys.argv[1:].
+    """
+    parser = configure_parser()
+    args = parse_args(parser, argv)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
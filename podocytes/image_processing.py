@@ -1,26 +1,102 @@
+import logging
+import collections
+
 import numpy as np
+from scipy import ndimage as ndi
 
-from skimage.util import invert
+from skimage.util import invert, img_as_float32, img_as_float64
 from skimage.filters import threshold_yen, gaussian
 from skimage.morphology import ball, watershed, binary_closing, binary_dilation
 from skimage.measure import label, regionprops
 from skimage.feature import blob_dog
 
+from podocytes.profiling import profile_stage, record_array
+
+# Arrays with one value per object. Field names match scikit-image
+# regionprops, so it can be used with podocyte_statistics.
+LabelCounts = collections.namedtuple(
+    "LabelCounts", ["label", "area", "centroid", "equivalent_diameter"])
+
+GroundTruthPoints = collections.namedtuple(
+    "GroundTruthPoints", ["coords", "labels", "shape"])
+
+# Field names match scikit-image regionprops, so either can be used
+# with glom_statistics and find_podocytes.
+GlomerulusMeasurement = collections.namedtuple(
+    "GlomerulusMeasurement",
+    ["label", "bbox", "centroid", "filled_area", "equivalent_diameter"])
 
-__all__ = ['crop_region_of_interest',
+
+class VoxelGeometry(collections.namedtuple("VoxelGeometry",
+                                           ["spacing", "axes"])):
+    """Physical voxel size of an image, built once per image series.
+
+    Parameters
+    ----------
+    spacing : tuple of float
+        Voxel size along each spatial axis of the image, in microns.
+    axes : str
+        Spatial axes of the image, for example 'zyx'.
+    """
+    __slots__ = ()
+
+    @property
+    def voxel_volume(self):
+        """Real space volume of a single image voxel."""
+        return float(np.prod(self.spacing))
+
+    @property
+    def sigma(self):
+        """Gaussian sigma for denoising, scaled for non-isotropic voxels."""
+        xy_pixel_size = self.spacing[self.axes.index('x')]
+        return np.divide(xy_pixel_size, self.spacing)
+
+    def equivalent_diameter(self, voxel_count):
+        """Diameter of a sphere with the same real space volume.
+
+        Parameters
+        ----------
+        voxel_count : int or ndarray
+            Number of voxels in each object.
+
+        Returns
+        -------
+        diameter : float or ndarray
+            Equivalent diameter in microns. Takes the voxel anisotropy into
+            account, unlike the equivalent_diameter (in pixels) of
+            scikit-image regionprops.
+        """
+        ndim = len(self.spacing)
+        volume = np.multiply(voxel_count, self.voxel_volume)
+        return (2 * ndim * volume / np.pi) ** (1 / ndim)
+
+
+__all__ = ['as_float',
+           'crop_ground_truth',
+           'count_labels',
+           'crop_region_of_interest',
            'denoise_image',
+           'filled_voxel_count',
            'filter_by_size',
            'find_glomeruli',
            'find_podocytes',
            'gradient_of_image',
            'marker_controlled_watershed',
            'markers_from_blob_coords',
-           'ground_truth_image']
+           'measure_glomerulus',
+           'pad_region_of_interest',
+           'region_of_interest_slices',
+           'ground_truth_image',
+           'voxel_geometry']
 
 
 def crop_region_of_interest(image, bbox, margin=0, pad_mode='mean'):
     """Return cropped region of interest, with border padding.
 
+    If the region of interest lies inside the image, the output is a view
+    of the input image (no copy is made). Otherwise the region is padded,
+    keeping the input image dtype.
+
     Parameters
     ----------
     image : 3D ndarray
@@ -41,63 +117,169 @@ def crop_region_of_interest(image, bbox, margin=0, pad_mode='mean'):
     Returns
     -------
     roi_image : 3D ndarray
-        The cropped output array.
+        The cropped output array. Do not modify it in place, as it may be
+        a view of the input image.
     """
-    ndims = image.ndim
-    max_image_size = np.array([np.size(image, dim) for dim in range(ndims)])
-    bbox_min_plus_margin = np.array([coord - margin for coord in bbox[:ndims]])
-    bbox_max_plus_margin = np.array([coord + margin for coord in bbox[ndims:]])
-    image_min_coords = bbox_min_plus_margin.clip(min=0)
-    image_max_coords = bbox_max_plus_margin.clip(max=max_image_size)
-    max_roi_size = np.array([
-        abs(bbox_max_plus_margin[dim] - bbox_min_plus_margin[dim])
-        for dim in range(ndims)])
-    roi_min_coord = abs(image_min_coords - bbox_min_plus_margin)
-    roi_max_coord = max_roi_size - abs(bbox_max_plus_margin - image_max_coords)
-    image_slicer = tuple(slice(image_min_coords[dim], image_max_coords[dim], 1)
-                         for dim in range(ndims))
-    roi_slicer = tuple(slice(roi_min_coord[dim], roi_max_coord[dim], 1)
-                       for dim in range(ndims))
+    if pad_mode not in ('mean', 'zeros'):
+        raise ValueError("'pad_mode' keyword argument unrecognized.")
+    image_slicer, pad_width = region_of_interest_slices(image.shape, bbox,
+                                                        margin=margin)
+    roi_image = pad_region_of_interest(image[image_slicer], pad_width,
+                                       pad_mode=pad_mode)
+    return roi_image
+
+
+def region_of_interest_slices(image_shape, bbox, margin=0):
+    """Slices and border padding needed to crop a region of interest.
+
+    Compute this once to crop several images with the same shape.
+
+    Parameters
+    ----------
+    image_shape : tuple of int
+        Shape of the input image.
+    bbox : tuple
+        Bounding box coordinates, see crop_region_of_interest.
+    margin : int, optional
+        How many pixels to increase the size of the bounding box by.
+
+    Returns
+    -------
+    image_slicer : tuple of slice
+        Part of the region of interest inside the image.
+    pad_width : tuple of (int, int)
+        Padding needed before and after image[image_slicer] along each axis,
+        in the format used by np.pad.
+    """
+    ndims = len(image_shape)
+    roi_min = np.array(bbox[:ndims]) - margin
+    roi_max = np.array(bbox[ndims:]) + margin
+    image_min = roi_min.clip(min=0)
+    image_max = np.minimum(roi_max, image_shape)
+    image_slicer = tuple(slice(int(start), int(stop))
+                         for start, stop in zip(image_min, image_max))
+    pad_width = tuple((int(before), int(after)) for before, after
+                      in zip(image_min - roi_min, roi_max - image_max))
+    return image_slicer, pad_width
+
+
+def pad_region_of_interest(roi_image, pad_width, pad_mode='mean'):
+    """Pad a cropped region of interest where it extends past the image.
+
+    Parameters
+    ----------
+    roi_image : ndarray
+        Part of the region of interest inside the image.
+    pad_width : tuple of (int, int)
+        Padding before and after each axis, see region_of_interest_slices.
+    pad_mode : string, optional
+        Type of border padding to use. Is either 'mean' (default) or 'zeros'.
+
+    Returns
+    -------
+    roi_image : ndarray
+        The input array if no padding is needed, otherwise a padded copy
+        with the same dtype.
+    """
+    if not any(before or after for before, after in pad_width):
+        return roi_image
     if pad_mode == 'zeros':
-        roi_image = np.zeros(max_roi_size)
+        pad_value = 0
     elif pad_mode == 'mean':
-        roi_image = np.ones(max_roi_size) * np.mean(image[image_slicer])
+        pad_value = np.mean(roi_image)
+        if not np.issubdtype(roi_image.dtype, np.inexact):
+            pad_value = np.round(pad_value)
     else:
         raise ValueError("'pad_mode' keyword argument unrecognized.")
-    roi_image[roi_slicer] = image[image_slicer]
+    roi_image = np.pad(np.asarray(roi_image), pad_width, mode='constant',
+                       constant_values=pad_value)
     return roi_image
 
 
-def denoise_image(image):
+def as_float(image, dtype=np.float32):
+    """Convert image to floating point, rescaling integer image types.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image.
+    dtype : numpy dtype, optional
+        Either np.float32 (default) or np.float64.
+
+    Returns
+    -------
+    image : ndarray
+        Image with values between 0 and 1 (for unsigned integer input).
+    """
+    if np.dtype(dtype) == np.float32:
+        return img_as_float32(image)
+    elif np.dtype(dtype) == np.float64:
+        return img_as_float64(image)
+    else:
+        raise ValueError("'dtype' must be either float32 or float64.")
+
+
+def denoise_image(image, dtype=np.float32, geometry=None):
     """Denoise images with a slight gaussian blur.
 
     Parameters
     ----------
     image : 3D ndarray
         Original image data from a single fluorescence channel.
+    dtype : numpy dtype, optional
+        Floating point precision of the output, np.float32 (default)
+        or np.float64. Single precision halves memory use.
+    geometry : VoxelGeometry, optional
+        Physical voxel size. If None (default), it is read from the
+        image metadata with voxel_geometry.
 
     Returns
     -------
     denoised : 3D ndarray
         Image denoised by slight gaussian blur.
     """
-    xy_pixel_size = image.metadata['mpp']
-    z_pixel_size = image.metadata['mppZ']
-    voxel_dimensions = []
+    geometry = geometry or voxel_geometry(image)
+    denoised = gaussian(as_float(image, dtype), sigma=geometry.sigma)
+    return denoised
+
+
+def voxel_geometry(image):
+    """Physical voxel size of an image, from its pims metadata.
+
+    Parameters
+    ----------
+    image : 3D ndarray
+        Image from a single fluorescence channel, with pims metadata
+        containing 'mpp', 'mppZ' and 'axes' keys.
+
+    Returns
+    -------
+    geometry : VoxelGeometry
+        Voxel size in microns along each spatial axis of the image.
+    """
+    xy_pixel_size = float(image.metadata['mpp'])
+    z_pixel_size = float(image.metadata['mppZ'])
+    spacing = []
+    axes = ''
     for i in image.metadata['axes']:
         if i == 'x' or i == 'y':
-            voxel_dimensions.append(xy_pixel_size)
+            spacing.append(xy_pixel_size)
+            axes += i
         elif i == 'z':
-            voxel_dimensions.append(z_pixel_size)
-    sigma = np.divide(xy_pixel_size, voxel_dimensions)  # non-isotropic
-    denoised = gaussian(image, sigma=sigma)
-    return denoised
+            spacing.append(z_pixel_size)
+            axes += i
+    geometry = VoxelGeometry(tuple(spacing), axes)
+    return geometry
 
 
-def filter_by_size(label_image, min_diameter, max_diameter):
+def filter_by_size(label_image, min_diameter, max_diameter, geometry=None):
     """Identify objects within a certain size range & return those regions.
 
-    Uses the equivalent_diameter attribute of regionprops to check size.
+    Objects are rejected using their voxel counts, from np.bincount over
+    one image plane at a time. Region properties are then found with
+    scikit-image regionprops, on a copy of the label image holding only
+    the objects within the size range. The copy keeps the original label
+    numbers, in the smallest integer type that fits them.
 
     Parameters
     ----------
@@ -105,38 +287,182 @@ def filter_by_size(label_image, min_diameter, max_diameter):
         Label image
     min_diameter : float
         Minimum expected size (equivalent diameter of labelled voxels)
-        Uses the equivalent_diameter attribute of scikit-image regionprops.
     max_diameter : float
         Maximum expected size (equivalent diameter of labelled voxels)
-        Uses the equivalent_diameter attribute of scikit-image regionprops.
+    geometry : VoxelGeometry, optional
+        Physical voxel size. If given, diameters are in microns, see
+        VoxelGeometry.equivalent_diameter. If None (default), diameters
+        are in pixels, like the equivalent_diameter attribute of
+        scikit-image regionprops.
 
     Returns
     -------
     regions : list of RegionProperties
         RegionProperties from scikit-image.
     """
-    regions = []
-    for region in regionprops(label_image):
-        if region.equivalent_diameter >= min_diameter:
-            if region.equivalent_diameter <= max_diameter:
-                regions.append(region)
+    if geometry is None:
+        geometry = VoxelGeometry((1.0,) * label_image.ndim,
+                                 'zyx'[-label_image.ndim:])
+    voxel_count = np.zeros(1, dtype=np.int64)
+    for plane in label_image:
+        plane_count = np.bincount(np.ravel(plane))
+        if len(plane_count) > len(voxel_count):
+            voxel_count = np.pad(voxel_count,
+                                 (0, len(plane_count) - len(voxel_count)))
+        voxel_count[:len(plane_count)] += plane_count
+    diameter = geometry.equivalent_diameter(voxel_count)
+    keep = (diameter >= min_diameter) & (diameter <= max_diameter)
+    keep[0] = False  # background
+    survivors = np.flatnonzero(keep)
+    if len(survivors) == 0:
+        return []
+    survivor_image = np.zeros(label_image.shape,
+                              dtype=np.min_scalar_type(int(survivors[-1])))
+    for survivor_plane, plane in zip(survivor_image, label_image):
+        survivor_plane[...] = np.where(keep[plane], plane, 0)
+    regions = regionprops(survivor_image)
     return regions
 
 
-def find_glomeruli(glomeruli_view):
+def measure_glomerulus(region):
+    """Measure a glomerulus once, for statistics, logging and summaries.
+
+    Parameters
+    ----------
+    region : RegionProperties
+        Single glomeruli region, found with scikit-image regionprops.
+
+    Returns
+    -------
+    measurement : GlomerulusMeasurement
+        Named tuple with the label, bbox, centroid, filled_area (number of
+        voxels after filling holes) and equivalent_diameter (in pixels)
+        of the glomerulus. Unlike the region, it does not keep a reference
+        to the label image.
+    """
+    measurement = GlomerulusMeasurement(
+        label=int(region.label),
+        bbox=tuple(int(i) for i in region.bbox),
+        centroid=tuple(float(i) for i in region.centroid),
+        filled_area=filled_voxel_count(region.image),
+        equivalent_diameter=float(region.equivalent_diameter))
+    return measurement
+
+
+def filled_voxel_count(mask):
+    """Number of voxels in a binary mask, once any holes are filled.
+
+    Gives the same result as the filled_area of scikit-image regionprops
+    (scipy.ndimage.binary_fill_holes with full connectivity), but labels
+    the background once instead of repeatedly dilating it in from the
+    image border.
+
+    Parameters
+    ----------
+    mask : ndarray of bool
+        Binary mask, for example the image attribute of a regionprops
+        region.
+
+    Returns
+    -------
+    count : int
+        Number of voxels in the mask plus its holes.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    structure = np.ones((3,) * mask.ndim)
+    background, n_background = ndi.label(~mask, structure)
+    # Background regions touching the border are outside, not holes
+    outside = np.zeros(n_background + 1, dtype=bool)
+    outside[0] = True  # the mask itself
+    for axis in range(mask.ndim):
+        outside[np.take(background, 0, axis=axis)] = True
+        outside[np.take(background, -1, axis=axis)] = True
+    sizes = np.bincount(background.ravel(), minlength=n_background + 1)
+    count = int(np.count_nonzero(mask) + sizes[~outside].sum())
+    return count
+
+
+def count_labels(label_image):
+    """Count the voxels in every object of a label image, in a single pass.
+
+    Parameters
+    ----------
+    label_image : 3D ndarray
+        Label image, with background label zero. Labels do not need to
+        be consecutive, or even integers.
+
+    Returns
+    -------
+    counts : LabelCounts
+        Named tuple of arrays, with one value per object (in order of
+        increasing label, background excluded). Fields are:
+        * label : label number
+        * area : number of voxels with each label
+        * centroid : centroid coordinate (plane, row, column)
+        * equivalent_diameter : diameter of a sphere with the same volume,
+          the same as the equivalent_diameter of scikit-image regionprops
+    """
+    label_image = np.asarray(label_image)
+    label_values = None
+    if label_image.size == 0:
+        index_image, n_labels = label_image.astype(np.intp), 1
+    elif label_image.dtype.kind in 'bu' or (label_image.dtype.kind == 'i' and
+                                            label_image.min() >= 0):
+        index_image, n_labels = label_image, int(label_image.max()) + 1
+    else:  # negative or non-integer labels
+        label_values, index_image = np.unique(label_image, return_inverse=True)
+        index_image = index_image.reshape(label_image.shape)
+        n_labels = len(label_values)
+    voxel_count, centroid = _label_sums(index_image, n_labels)
+    index = np.flatnonzero(voxel_count)
+    label_number = index if label_values is None else label_values[index]
+    index = index[label_number != 0]
+    label_number = label_number[label_number != 0]
+    area = voxel_count[index]
+    ndim = label_image.ndim
+    equivalent_diameter = (2 * ndim * area / np.pi) ** (1 / ndim)
+    return LabelCounts(label_number, area, centroid[index],
+                       equivalent_diameter)
+
+
+def _label_sums(label_image, n_labels):
+    """Voxel counts and centroids for labels 0 to n_labels - 1."""
+    n_rows, n_cols = label_image.shape[1:]
+    rows = np.repeat(np.arange(n_rows, dtype=np.float64), n_cols)
+    cols = np.tile(np.arange(n_cols, dtype=np.float64), n_rows)
+    voxel_count = np.zeros(n_labels, dtype=np.int64)
+    coordinate_sum = np.zeros((n_labels, 3))
+    for plane_number, plane in enumerate(label_image):
+        plane = np.asarray(plane).ravel().astype(np.intp, copy=False)
+        plane_count = np.bincount(plane, minlength=n_labels)
+        voxel_count += plane_count
+        coordinate_sum[:, 0] += plane_number * plane_count
+        coordinate_sum[:, 1] += np.bincount(plane, rows, minlength=n_labels)
+        coordinate_sum[:, 2] += np.bincount(plane, cols, minlength=n_labels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid = coordinate_sum / voxel_count[:, np.newaxis]
+    return voxel_count, centroid
+
+
+def find_glomeruli(glomeruli_view, dtype=np.float32, geometry=None):
     """Preprocess glomeruli channel image, return labelled glomeruli image.
 
     Parameters
     ----------
     glomeruli_view : 3D ndarray
         Image array of glomeruli fluorescence channel.
+    dtype : numpy dtype, optional
+        Floating point precision used for denoising, see denoise_image.
+    geometry : VoxelGeometry, optional
+        Physical voxel size, see denoise_image.
 
     Returns
     -------
     label_image : 3D ndarray
         Label image identifying fluorescence regions in glomeruli channel.
     """
-    glomeruli_view = denoise_image(glomeruli_view)
+    glomeruli_view = denoise_image(glomeruli_view, dtype=dtype,
+                                   geometry=geometry)
     threshold = threshold_yen(glomeruli_view)
     label_image = label(glomeruli_view > threshold)
     return label_image
@@ -164,36 +490,116 @@ def find_podocytes(podocyte_image, glomeruli_region,
 
     Returns
     -------
-    regions : List of RegionProperties
-        Region properties for podocytes identified.
+    podocyte_counts : LabelCounts
+        Label number, voxel count, centroid and equivalent diameter of
+        each podocyte identified, see count_labels.
     centroid_offset : tuple of int
         Coordinate offset of glomeruli subvolume in image.
     wshed : 3D ndarray
         Watershed image showing podoyctes.
     """
     bbox = glomeruli_region.bbox  # bounding box coordinates
+    glomerulus = getattr(glomeruli_region, 'label', None)
     centroid_offset = tuple(bbox[dim] - cropping_margin
                             for dim in range(podocyte_image.ndim))
-    image_roi = crop_region_of_interest(podocyte_image, bbox,
-                                        margin=cropping_margin)
-    blobs = blob_dog(image_roi,
-                     min_sigma=min_sigma,
-                     max_sigma=max_sigma,
-                     threshold=dog_threshold)
-    wshed = marker_controlled_watershed(image_roi, blobs)
-    regions = regionprops(wshed, intensity_image=image_roi)
-    return (regions, centroid_offset, wshed)
-
-
-def gradient_of_image(image):
-    """Take the maximum absolute gradient of the image in all directions."""
-    grad = np.gradient(image)  # gradients for individual directions
-    grad = np.stack(grad, axis=-1)  # from list of arrays to single numpy array
-    gradient_image = np.sum(abs(grad), axis=-1)
-    return gradient_image
-
-
-def marker_controlled_watershed(grayscale_image, marker_coords):
+    with profile_stage('crop_region_of_interest', glomerulus) as record:
+        image_roi = crop_region_of_interest(podocyte_image, bbox,
+                                            margin=cropping_margin)
+        record_array(record, image_roi)
+    with profile_stage('blob_dog', glomerulus) as record:
+        blobs = blob_dog(image_roi,
+                         min_sigma=min_sigma,
+                         max_sigma=max_sigma,
+                         threshold=dog_threshold)
+        record_array(record, image_roi)
+    with profile_stage('marker_controlled_watershed', glomerulus) as record:
+        wshed = marker_controlled_watershed(image_roi, blobs)
+        record_array(record, wshed)
+    with profile_stage('count_labels', glomerulus) as record:
+        # One pass over the watershed, not one per podocyte region
+        podocyte_counts = count_labels(wshed)
+        record_array(record, wshed)
+    return (podocyte_counts, centroid_offset, wshed)
+
+
+def gradient_of_image(image, norm='l1', out=None):
+    """Take the magnitude of the image gradient, combining all directions.
+
+    The gradient along each axis is computed one at a time into a single
+    scratch array and accumulated into the output, so only two image-sized
+    arrays are allocated regardless of the number of dimensions.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image.
+    norm : str, optional
+        How the gradients along each axis are combined. Either
+        'l1' (default): sum of absolute central differences, as np.gradient,
+        'l2': euclidean norm of the central differences, or
+        'sobel': euclidean norm of the scipy.ndimage.sobel filter responses.
+    out : ndarray, optional
+        Preallocated floating point output array, the same shape as image.
+
+    Returns
+    -------
+    gradient_image : ndarray
+        Gradient magnitude image.
+    """
+    if norm not in ('l1', 'l2', 'sobel'):
+        raise ValueError("'norm' keyword argument unrecognized.")
+    if any(size < 2 for size in image.shape):
+        raise ValueError("Image must have at least two pixels along each axis.")
+    image = np.asarray(image)
+    if out is None:
+        if np.issubdtype(image.dtype, np.floating):
+            dtype = image.dtype
+        else:
+            dtype = np.float64  # same as np.gradient
+        out = np.empty(image.shape, dtype=dtype)
+    scratch = np.empty_like(out)
+    for axis in range(image.ndim):
+        if norm == 'sobel':
+            ndi.sobel(image, axis=axis, output=scratch, mode='nearest')
+        else:
+            _central_difference(image, axis, scratch)
+        if norm == 'l1':
+            np.abs(scratch, out=scratch)
+        else:
+            np.multiply(scratch, scratch, out=scratch)
+        if axis == 0:
+            out[...] = scratch
+        else:
+            out += scratch
+    if norm != 'l1':
+        np.sqrt(out, out=out)
+    return out
+
+
+def _central_difference(image, axis, out):
+    """Gradient along one axis, written into out. Matches np.gradient."""
+    def along_axis(sl):
+        index = [slice(None)] * image.ndim
+        index[axis] = sl
+        return tuple(index)
+    # Second order central differences in the interior
+    interior = out[along_axis(slice(1, -1))]
+    np.subtract(image[along_axis(slice(2, None))],
+                image[along_axis(slice(None, -2))], out=interior,
+                dtype=out.dtype)  # no integer wraparound
+    np.multiply(interior, 0.5, out=interior)
+    # First order one-sided differences at the edges
+    np.subtract(image[along_axis(slice(1, 2))],
+                image[along_axis(slice(0, 1))],
+                out=out[along_axis(slice(0, 1))], dtype=out.dtype)
+    np.subtract(image[along_axis(slice(-1, None))],
+                image[along_axis(slice(-2, -1))],
+                out=out[along_axis(slice(-1, None))], dtype=out.dtype)
+    return out
+
+
+def marker_controlled_watershed(grayscale_image, marker_coords,
+                                gradient_norm='l1'):
     """Returns the watershed result given a grayscale image and marker seeds.
 
     Parameters
@@ -203,13 +609,16 @@ def marker_controlled_watershed(grayscale_image, marker_coords):
     marker_coords : 3D ndarray
         Array where the first consecutive elements in each row
         are the spatial coordinates of the markers.
+    gradient_norm : str, optional
+        Gradient magnitude used as the watershed landscape,
+        see gradient_of_image.
 
     Returns
     -------
     wshed : 3D ndarray
         Label image of watershed results.
     """
-    gradient_image = gradient_of_image(grayscale_image)
+    gradient_image = gradient_of_image(grayscale_image, norm=gradient_norm)
     seeds = markers_from_blob_coords(marker_coords, grayscale_image.shape)
     wshed = watershed(gradient_image, seeds)
     wshed[wshed == np.max(seeds)] = 0  # set background area to zero
@@ -240,7 +649,7 @@ def markers_from_blob_coords(blobs, image_shape):
     return markers
 
 
-def ground_truth_image(ground_truth_coords, image_shape):
+def ground_truth_image(ground_truth_coords, image_shape, sparse=False):
     """Label image from coordinates in CellCounter xml marker file.
 
     Creates a label image where pixels labelled with int > 0 match
@@ -249,16 +658,73 @@ def ground_truth_image(ground_truth_coords, image_shape):
 
     Parameters
     ----------
-    ground_truth_coords :  array where first columns are x, y, and z coords.
-    image_shape : shape of image, eg: img_array.shape
+    ground_truth_coords : (N, ndim) array
+        Marker coordinates, in the same axis order as image_shape
+        (eg: plane, row, column). Any extra columns are ignored.
+    image_shape : tuple
+        Shape of image, eg: img_array.shape
+    sparse : bool, optional
+        If True, return the labelled coordinates instead of a label image.
 
     Returns
     -------
-    image : label image
+    image : 3D ndarray of int32, or GroundTruthPoints
+        Label image, where each marker is labelled with its position in
+        ground_truth_coords plus one. Markers outside the image are left
+        out, and where markers share a pixel the last one is kept.
+        If sparse, a named tuple of the in-bounds integer coordinates,
+        their labels and the image shape.
     """
-    image = np.zeros(image_shape).astype(np.int32)
-    for i, gt_coord in enumerate(ground_truth_coords):
-        coord = [slice(int(gt_coord[dim]), int(gt_coord[dim]) + 1, 1)
-                 for dim in range(image.ndim)]
-        image[coord] = i + 1  # only background pixels labelled zero.
+    ndim = len(image_shape)
+    coords = np.asarray(ground_truth_coords)
+    if coords.size == 0:
+        coords = np.zeros((0, ndim))
+    coords = coords[:, :ndim].astype(np.intp)
+    labels = np.arange(1, len(coords) + 1, dtype=np.int32)
+    in_bounds = np.all((coords >= 0) & (coords < image_shape), axis=1)
+    if not np.all(in_bounds):
+        logging.warning(f"{np.sum(~in_bounds)} markers outside the image "
+                        "bounds were ignored.")
+        coords, labels = coords[in_bounds], labels[in_bounds]
+    # Keep only the last marker in each pixel
+    flat_index = np.ravel_multi_index(tuple(coords.T), image_shape)
+    _, last = np.unique(flat_index[::-1], return_index=True)
+    keep = np.sort(len(flat_index) - 1 - last)
+    coords, labels = coords[keep], labels[keep]
+    if sparse:
+        return GroundTruthPoints(coords, labels, tuple(image_shape))
+    image = np.zeros(image_shape, dtype=np.int32)
+    image[tuple(coords.T)] = labels  # only background pixels labelled zero.
     return image
+
+
+def crop_ground_truth(points, bbox, margin=0):
+    """Ground truth label image for a region of interest only.
+
+    Gives the same result as crop_region_of_interest with zero padding
+    of the whole ground truth label image, without creating the whole
+    label image.
+
+    Parameters
+    ----------
+    points : GroundTruthPoints
+        Sparse ground truth, from ground_truth_image(..., sparse=True).
+    bbox : tuple
+        Bounding box coordinates, see crop_region_of_interest.
+    margin : int, optional
+        How many pixels to increase the size of the bounding box by.
+
+    Returns
+    -------
+    roi_image : 3D ndarray of int32
+        Ground truth label image of the region of interest.
+    """
+    ndim = len(points.shape)
+    roi_min = np.array(bbox[:ndim]) - margin
+    roi_max = np.array(bbox[ndim:]) + margin
+    inside = np.all((points.coords >= roi_min) & (points.coords < roi_max),
+                    axis=1)
+    roi_image = np.zeros(roi_max - roi_min, dtype=np.int32)
+    roi_image[tuple((points.coords[inside] - roi_min).T)] = \
+        points.labels[inside]
+    return roi_image
@@ -1,44 +1,45 @@
 import os
 import time
 import logging
+from contextlib import closing
+from concurrent.futures import as_completed
 
-import numpy as np
 import pandas as pd
-import matplotlib as mpl
-mpl.use('wxagg')
-from skimage import io
-import pims
-import jpype
-import matplotlib.pyplot as plt
-
-from gooey.python_bindings.gooey_decorator import Gooey as gooey
-from gooey.python_bindings.gooey_parser import GooeyParser
-
-from skimage.util import invert
-from skimage.filters import threshold_yen, gaussian
-from skimage.morphology import ball, watershed, binary_closing, binary_dilation
-from skimage.measure import label, regionprops
-from skimage.feature import blob_dog
-
-import tifffile._tifffile  # imported to silence pims warning
 
 from podocytes.__init__ import __version__
-from podocytes.util import (configure_parser_default,
+from podocytes.util import (configure_parser_main,
+                            gooey,
                             parse_args,
                             log_file_begins,
                             log_file_ends,
-                            find_files)
-from podocytes.image_processing import (crop_region_of_interest,
-                                        denoise_image,
-                                        filter_by_size,
-                                        find_glomeruli,
+                            find_files,
+                            intermediate_directory)
+from podocytes.image_processing import (filter_by_size,
                                         find_podocytes,
-                                        gradient_of_image,
-                                        marker_controlled_watershed,
-                                        markers_from_blob_coords)
-from podocytes.statistics import (glom_statistics,
-                                  podocyte_statistics,
-                                  podocyte_avg_statistics,
+                                        measure_glomerulus,
+                                        voxel_geometry)
+from podocytes.cache import denoise_image_cached, find_glomeruli_cached
+from podocytes.checkpoint import Checkpoint, run_parameters
+from podocytes.output import StatisticsWriter
+from podocytes.parallel import (Prefetcher,
+                                find_podocytes_parallel,
+                                process_pool,
+                                worker_reader)
+from podocytes.profiling import (add_profile_records,
+                                 enable_profiling,
+                                 pop_profile_records,
+                                 profile_stage,
+                                 record_array,
+                                 set_profile_context,
+                                 write_profile)
+from podocytes.reader import (ReaderPool,
+                              add_reader_metrics,
+                              load_series,
+                              log_reader_metrics,
+                              pop_reader_metrics,
+                              read_channels,
+                              uses_bioformats)
+from podocytes.statistics import (StatisticsAccumulator,
                                   summarize_statistics)
 
 
@@ -51,48 +52,262 @@ def run_program(args):
     time_start = log_file_begins(args)
     timestamp = time.strftime('%d-%b-%Y_%H-%M%p', time.localtime())
 
+    enable_profiling(getattr(args, 'profile', False))
+    pop_reader_metrics()  # only count the files opened in this run
     # Get to work
-    stats_list = []
     filelist = find_files(args.input_directory, args.file_extension)
-    logging.info(f"Java path: {jpype.get_default_jvm_path()}")
     logging.info(f"{len(filelist)} {args.file_extension} files found.")
-    for filename in filelist:
-        logging.info(f"Processing file: {filename}")
-        try:
-            images = pims.Bioformats(filename)
-        except Exception as err:
-            logging.warning(f'Exception raised when trying to open {filename}')
-            logging.warning(f'{str(type(err))[8:-2]}: {err}')
-            continue  # move on to the next file
-        for im_series_num in range(images.metadata.ImageCount()):
-            logging.info(f"{images.metadata.ImageID(im_series_num)}")
-            logging.info(f"{images.metadata.ImageName(im_series_num)}")
-            images.series = im_series_num
-            images.bundle_axes = 'zyxc'
-            single_image_stats = process_image_series(images, filename, args)
-            stats_list.append(single_image_stats)
+    checkpoint = Checkpoint(os.path.join(args.output_directory, 'checkpoint'),
+                            resume=getattr(args, 'resume', False),
+                            parameters=run_parameters(args))
+    workers = getattr(args, 'workers', 1)
+    output_basename = os.path.join(args.output_directory,
+                                   'Podocyte_detailed_stats_' + timestamp)
+    with StatisticsWriter(output_basename,
+                          getattr(args, 'output_format', 'csv')) as writer:
+        if workers > 1:
+            logging.info(f"Processing image series with {workers} workers.")
+            stats_list = process_files_parallel(filelist, args, workers,
+                                                checkpoint=checkpoint,
+                                                writer=writer)
+        else:
+            if any(uses_bioformats(filename) for filename in filelist):
+                import jpype  # not needed for TIFF files
+                logging.info(f"Java path: {jpype.get_default_jvm_path()}")
+            stats_list = process_files(filelist, args, checkpoint=checkpoint,
+                                       writer=writer)
+    log_reader_metrics()
+    write_profile(args.output_directory, timestamp)
     # Summarize output and write to file
     try:
         detailed_stats = pd.concat(stats_list, ignore_index=True, copy=False)
     except ValueError as err:
         logging.warning(f'No glomeruli identified in these images.')
         logging.warning(f'{str(type(err))[8:-2]}: {err}')
+        checkpoint.remove()  # finished, nothing left to resume
         return None
     else:
-        output_filename_detailed_stats = os.path.join(args.output_directory,
-                'Podocyte_detailed_stats_' + timestamp + '.csv')
         output_filename_summary_stats = os.path.join(args.output_directory,
                 'Podocyte_summary_stats_' + timestamp + '.csv')
-        detailed_stats.to_csv(output_filename_detailed_stats)
         summary_stats = summarize_statistics(detailed_stats,
                                              output_filename_summary_stats)
         if len(summary_stats) > 0:
             total_gloms_counted = len(summary_stats)
         else:
             total_gloms_counted = 0
+    checkpoint.remove()  # finished, nothing left to resume
     log_file_ends(time_start, total_gloms_counted=total_gloms_counted)
 
 
+def process_files(filelist, args, checkpoint=None, writer=None):
+    """Process every image series in every file, one after the other.
+
+    If args.prefetch is more than zero, a background thread reads the
+    next image series from disk while the current one is being processed.
+
+    Parameters
+    ----------
+    filelist : list of str
+        Input image filenames.
+    args : user input arguments
+    checkpoint : Checkpoint, optional
+        Record of completed image series. Completed series are loaded
+        instead of processed, and new results are saved as they finish.
+    writer : StatisticsWriter, optional
+        Detailed statistics output file, appended to as each series
+        finishes.
+
+    Returns
+    -------
+    stats_list : list of DataFrame
+        Statistics for each image series, in file and series order.
+    """
+    stats_list = []
+    prefetch = getattr(args, 'prefetch', 0)
+    with ReaderPool(cache_directory=getattr(args, 'cache_directory', None),
+                    cache_size=getattr(args, 'cache_size', 100)) as pool:
+        series_list = iter_image_series(filelist, args, pool,
+                                        checkpoint=checkpoint,
+                                        load=(prefetch > 0))
+        if prefetch > 0:
+            prefetch_memory = getattr(args, 'prefetch_memory', 4)
+            logging.info(f"Reading up to {prefetch} image series ahead "
+                         f"({prefetch_memory} GB maximum).")
+            series_list = Prefetcher(series_list, depth=prefetch,
+                                     max_bytes=prefetch_memory * 1e9,
+                                     nbytes=lambda item: getattr(item[2],
+                                                                 'nbytes', 0))
+        with closing(series_list):
+            for filename, im_series_num, images in series_list:
+                if images is None:
+                    logging.info("Already processed, loading from checkpoint.")
+                    single_image_stats = checkpoint.load(filename,
+                                                         im_series_num)
+                else:
+                    single_image_stats = process_image_series(images,
+                                                              filename, args)
+                    if checkpoint:
+                        checkpoint.save(filename, im_series_num,
+                                        single_image_stats)
+                if writer:
+                    writer.write(single_image_stats)
+                stats_list.append(single_image_stats)
+    return stats_list
+
+
+def iter_image_series(filelist, args, pool, checkpoint=None, load=False):
+    """Open each image file in turn, and select each of its image series.
+
+    Parameters
+    ----------
+    filelist : list of str
+        Input image filenames.
+    args : user input arguments
+    pool : ReaderPool
+        Image readers. Each file is closed once all its series are done.
+    checkpoint : Checkpoint, optional
+        Record of completed image series, which are not read again.
+    load : bool, optional
+        Whether to read the glomeruli and podocyte channels into memory
+        (eg: when this runs in a background thread).
+
+    Yields
+    ------
+    filename : str
+        Input image filename.
+    im_series_num : int
+        Image series number.
+    images : pims image object, LoadedSeries or None
+        Image reader with this image series selected, or the image series
+        read into memory if load is True. None if this series is
+        complete in the checkpoint.
+    """
+    for filename in filelist:
+        logging.info(f"Processing file: {filename}")
+        try:
+            images = pool.open(filename)
+        except Exception as err:
+            logging.warning(f'Exception raised when trying to open {filename}')
+            logging.warning(f'{str(type(err))[8:-2]}: {err}')
+            continue  # move on to the next file
+        for im_series_num in range(images.metadata.ImageCount()):
+            logging.info(f"{images.metadata.ImageID(im_series_num)}")
+            logging.info(f"{images.metadata.ImageName(im_series_num)}")
+            if checkpoint and checkpoint.is_complete(filename, im_series_num):
+                yield filename, im_series_num, None
+                continue
+            images.series = im_series_num
+            images.bundle_axes = 'zyxc'
+            if load:
+                channels = [args.glomeruli_channel_number,
+                            args.podocyte_channel_number]
+                yield filename, im_series_num, load_series(images, channels)
+            else:
+                yield filename, im_series_num, images
+        pool.close(filename)  # finished with this file
+
+
+def process_files_parallel(filelist, args, workers, checkpoint=None,
+                           writer=None):
+    """Process image series in a pool of worker processes.
+
+    Each (file, series) pair is a separate job. Results are returned and
+    written to the output file in the same order as process_files,
+    regardless of which job finishes first. Finished results are held back
+    until every job before them has been written, but each one is saved to
+    the checkpoint as soon as it finishes.
+
+    Parameters
+    ----------
+    filelist : list of str
+        Input image filenames.
+    args : user input arguments
+    workers : int
+        Number of worker processes.
+    checkpoint : Checkpoint, optional
+        Record of completed image series. Completed series are loaded
+        instead of processed, and new results are saved as they finish.
+    writer : StatisticsWriter, optional
+        Detailed statistics output file, appended to in file and series
+        order.
+
+    Returns
+    -------
+    stats_list : list of DataFrame
+        Statistics for each image series, in file and series order.
+    """
+    def write_finished():
+        """Write results in job order, up to the first unfinished job."""
+        nonlocal n_written
+        while n_written < len(jobs) and jobs[n_written][:2] in results:
+            if writer:
+                writer.write(results[jobs[n_written][:2]])
+            n_written += 1
+
+    n_written = 0
+    with process_pool(workers) as pool:
+        series_counts = list(pool.map(count_image_series, filelist,
+                                      [args] * len(filelist)))
+        jobs = [(filename, im_series_num, args)
+                for filename, n_series in zip(filelist, series_counts)
+                for im_series_num in range(n_series)]
+        logging.info(f"{len(jobs)} image series to process.")
+        results = {}
+        futures = {}
+        for job in jobs:
+            filename, im_series_num, _ = job
+            if checkpoint and checkpoint.is_complete(filename, im_series_num):
+                results[job[:2]] = checkpoint.load(filename, im_series_num)
+            else:
+                futures[pool.submit(process_series_job, job)] = job[:2]
+        for future in as_completed(futures):
+            filename, im_series_num = futures[future]
+            single_image_stats, profile_records, reader_metrics = \
+                future.result()
+            add_profile_records(profile_records)
+            add_reader_metrics(reader_metrics)
+            if checkpoint:
+                checkpoint.save(filename, im_series_num, single_image_stats)
+            results[(filename, im_series_num)] = single_image_stats
+            write_finished()
+    write_finished()  # eg: every job was already in the checkpoint
+    stats_list = [results[job[:2]] for job in jobs]
+    return stats_list
+
+
+def count_image_series(filename, args):
+    """Return the number of image series in a file, or zero if unreadable."""
+    try:
+        images = worker_reader(filename,
+                               getattr(args, 'cache_directory', None),
+                               getattr(args, 'cache_size', 100))
+    except Exception as err:
+        logging.warning(f'Exception raised when trying to open {filename}')
+        logging.warning(f'{str(type(err))[8:-2]}: {err}')
+        return 0
+    return images.metadata.ImageCount()
+
+
+def process_series_job(job):
+    """Process a single (filename, series number, args) job in a worker.
+
+    Returns the image series statistics, plus the profile records (empty
+    unless profiling is enabled) and reader metrics from this worker process.
+    """
+    filename, im_series_num, args = job
+    enable_profiling(getattr(args, 'profile', False))
+    images = worker_reader(filename,
+                           getattr(args, 'cache_directory', None),
+                           getattr(args, 'cache_size', 100))
+    logging.info(f"Processing file: {filename}")
+    logging.info(f"{images.metadata.ImageID(im_series_num)}")
+    logging.info(f"{images.metadata.ImageName(im_series_num)}")
+    images.series = im_series_num
+    images.bundle_axes = 'zyxc'
+    single_image_stats = process_image_series(images, filename, args)
+    return single_image_stats, pop_profile_records(), pop_reader_metrics()
+
+
 __DESCR__ = ('Load, segment, count, and measure glomeruli and podocytes in '
              f'fluorescence images.\nVersion {__version__}')
 @gooey(default_size=(800, 700),
@@ -107,8 +322,9 @@ def configure_parser():
         Parsed user input arguments.
 
     """
+    from gooey.python_bindings.gooey_parser import GooeyParser
     parser = GooeyParser(prog='Podocyte Profiler', description=__DESCR__)
-    parser = configure_parser_default(parser)
+    parser = configure_parser_main(parser)
     args = parse_args(parser)
     return args
 
@@ -118,8 +334,9 @@ def process_image_series(images, filename, args):
 
     Parameters
     ----------
-    images : pims image object, where images[0] is the image ndarray.
-        Input image plus metadata.
+    images : pims image object, with the image series already selected.
+        Input image plus metadata. Only the glomeruli and podocyte
+        channels are read from the file.
     filename : str
         Input image filename.
     args : user input arguments
@@ -129,47 +346,69 @@ def process_image_series(images, filename, args):
     single_image_stats : DataFrame
 
     """
-    df_list = []
-    glomeruli_view = images[0][..., args.glomeruli_channel_number]
-    podocytes_view = images[0][..., args.podocyte_channel_number]
-    voxel_volume = images[0].metadata['mpp'] * \
-                   images[0].metadata['mpp'] * \
-                   images[0].metadata['mppZ']
+    accumulator = StatisticsAccumulator(
+        filename, images.metadata.ImageID(images.series),
+        images.metadata.ImageName(images.series))
+    set_profile_context(filename, images.series)
+    chunk_size = getattr(args, 'chunk_size', None)
+    with profile_stage('read_channels') as record:
+        glomeruli_view, podocytes_view = read_channels(
+            images, [args.glomeruli_channel_number,
+                     args.podocyte_channel_number],
+            directory=args.output_directory if chunk_size else None)
+        record_array(record, glomeruli_view, podocytes_view)
+    geometry = voxel_geometry(glomeruli_view)
+    voxel_volume = geometry.voxel_volume
     logging.info(f"Voxel volume in real space: {voxel_volume}")
-    glomeruli_labels = find_glomeruli(glomeruli_view)
-    glom_regions = filter_by_size(glomeruli_labels,
-                                  args.minimum_glomerular_diameter,
-                                  args.maximum_glomerular_diameter)
-    glom_index = 0  # labels not always sequential after filtering by size
+    precision = getattr(args, 'precision', 'float32')
+    with profile_stage('find_glomeruli') as record:
+        # With chunk_size, temporary arrays are memory-mapped, anonymous files
+        glomeruli_labels = find_glomeruli_cached(
+            glomeruli_view, intermediate_directory(args), dtype=precision,
+            geometry=geometry, chunk_size=chunk_size,
+            directory=args.output_directory)
+        record_array(record, glomeruli_labels)
+    with profile_stage('filter_by_size') as record:
+        glom_regions = filter_by_size(glomeruli_labels,
+                                      args.minimum_glomerular_diameter,
+                                      args.maximum_glomerular_diameter,
+                                      geometry=geometry)
+        record_array(record, glomeruli_labels)
+    with profile_stage('measure_glomerulus'):
+        glom_regions = [measure_glomerulus(glom) for glom in glom_regions]
     logging.info(f"{len(glom_regions)} glomeruli identified.")
     if len(glom_regions) > 0:
-        podocytes_view = denoise_image(podocytes_view)
-        for glom in glom_regions:
-            podocyte_regions, centroid_offset, wshed = \
-                    find_podocytes(podocytes_view, glom)
-            df = podocyte_statistics(podocyte_regions,
-                                     centroid_offset,
-                                     voxel_volume)
-            logging.info(f"{len(df)} podocytes found for glomerulus " +
+        with profile_stage('denoise_image') as record:
+            podocytes_view = denoise_image_cached(
+                podocytes_view, intermediate_directory(args),
+                dtype=precision, geometry=geometry, chunk_size=chunk_size,
+                directory=args.output_directory)
+            record_array(record, podocytes_view)
+        glomeruli_workers = getattr(args, 'glomeruli_workers', 1)
+        if glomeruli_workers > 1:
+            podocyte_results = find_podocytes_parallel(podocytes_view,
+                                                       glom_regions,
+                                                       glomeruli_workers)
+        else:
+            podocyte_results = (find_podocytes(podocytes_view, glom)
+                                for glom in glom_regions)
+        for glom, (podocyte_counts, centroid_offset, wshed) in \
+                zip(glom_regions, podocyte_results):
+            with profile_stage('podocyte_statistics', glom.label):
+                n_podocytes = accumulator.add_glomerulus(glom,
+                                                         podocyte_counts,
+                                                         centroid_offset,
+                                                         voxel_volume)
+            logging.info(f"{n_podocytes} podocytes found for glomerulus " +
                          f"with centroid voxel coord (x,y,z): (" +
                          f"{int(glom.centroid[2])}, " +
                          f"{int(glom.centroid[1])}, " +
                          f"{int(glom.centroid[0])})")
-            if len(df) > 0:
-                df = podocyte_avg_statistics(df)
-                df = glom_statistics(df, glom, glom_index, voxel_volume)
-                df['image_series_num'] = images.metadata.ImageID(images.series)
-                df['image_series_name'] = images.metadata.ImageName(images.series)
-                df['image_filename'] = filename
-                glom_index += 1
-                df_list.append(df)
-    try:
-        single_image_stats = pd.concat(df_list, ignore_index=True, copy=False)
-    except ValueError as err:
+    if len(accumulator) == 0:
         logging.warning(f'No glomeruli identified.')
-        logging.warning(f'{str(type(err))[8:-2]}: {err}')
-    else:
-        return single_image_stats
+        return None
+    single_image_stats = accumulator.to_dataframe()
+    return single_image_stats
 
 
 if __name__ == '__main__':
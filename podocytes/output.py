@@ -0,0 +1,112 @@
+"""Detailed statistics output, written one image series at a time.
+
+Each image series is appended to the output file as soon as it has been
+processed, instead of collecting every series in memory first. Besides
+csv, the detailed statistics can be written as parquet (one row group per
+image series, with dictionary encoded string columns) or as an Arrow IPC
+file. Both of these need the optional pyarrow dependency.
+"""
+import logging
+
+
+__all__ = ['OUTPUT_FORMATS',
+           'StatisticsWriter']
+
+# Output format names and their filename extensions
+OUTPUT_FORMATS = {'csv': '.csv',
+                  'parquet': '.parquet',
+                  'arrow': '.arrow'}
+
+# Columns repeated on every podocyte row, stored once per row group
+DICTIONARY_COLUMNS = ['image_filename',
+                      'image_series_name',
+                      'image_series_num']
+
+
+class StatisticsWriter(object):
+    """Append detailed statistics to a file, one image series at a time.
+
+    Parameters
+    ----------
+    output_basename : str
+        Output filepath, without the filename extension.
+    output_format : str, optional
+        One of 'csv' (default), 'parquet' or 'arrow'.
+
+    Examples
+    --------
+    >>> with StatisticsWriter('Podocyte_detailed_stats', 'parquet') as writer:
+    ...     for single_image_stats in stats_list:
+    ...         writer.write(single_image_stats)
+    """
+    def __init__(self, output_basename, output_format='csv'):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("'output_format' keyword argument unrecognized.")
+        if output_format != 'csv':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError as err:
+                raise ImportError(f"The {output_format} output format "
+                                  "requires pyarrow.") from err
+        self.output_format = output_format
+        self.output_filename = output_basename + OUTPUT_FORMATS[output_format]
+        self.n_rows = 0
+        self._schema = None
+        self._writer = None
+
+    def write(self, single_image_stats):
+        """Append the statistics for a single image series.
+
+        Parameters
+        ----------
+        single_image_stats : DataFrame or None
+            Detailed statistics for the image series. Nothing is written
+            if None or empty.
+        """
+        if single_image_stats is None or len(single_image_stats) == 0:
+            return
+        # Row numbers continue on from the previous image series
+        df = single_image_stats.reset_index(drop=True)
+        df.index += self.n_rows
+        if self.output_format == 'csv':
+            df.to_csv(self.output_filename,
+                      mode='w' if self.n_rows == 0 else 'a',
+                      header=(self.n_rows == 0))
+        else:
+            self._write_arrow(df)
+        self.n_rows += len(df)
+
+    def close(self):
+        """Finish writing the output file."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self.n_rows > 0:
+            logging.info(f"Saved detailed statistics to file: "
+                         f"{self.output_filename}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_arrow(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema
+            if self.output_format == 'parquet':
+                dictionary_columns = [column for column in DICTIONARY_COLUMNS
+                                      if column in df.columns]
+                self._writer = pq.ParquetWriter(
+                    self.output_filename, self._schema,
+                    use_dictionary=dictionary_columns)
+            else:
+                self._writer = pa.ipc.new_file(self.output_filename,
+                                               self._schema)
+        else:
+            # eg: integer columns read back from a checkpoint csv file
+            table = table.cast(self._schema)
+        self._writer.write_table(table)
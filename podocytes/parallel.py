@@ -0,0 +1,234 @@
+import queue
+import logging
+import threading
+import multiprocessing
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from podocytes.image_processing import find_podocytes
+from podocytes.reader import ReaderPool
+
+
+__all__ = ['Prefetcher',
+           'find_podocytes_parallel',
+           'process_pool',
+           'worker_reader']
+
+_worker_readers = {}  # one ReaderPool per process, by cache settings
+_END = object()  # marks the end of the prefetched items
+
+
+def process_pool(workers):
+    """Return a process pool for running whole image series jobs.
+
+    Worker processes are started with the 'spawn' method, so each worker
+    starts its own Java virtual machine for Bio-Formats the first time it
+    opens an image file (the JVM cannot be shared across a fork).
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes.
+
+    Returns
+    -------
+    pool : concurrent.futures.ProcessPoolExecutor
+    """
+    log_filenames = [handler.baseFilename
+                     for handler in logging.getLogger().handlers
+                     if isinstance(handler, logging.FileHandler)]
+    context = multiprocessing.get_context('spawn')
+    pool = ProcessPoolExecutor(max_workers=workers,
+                               mp_context=context,
+                               initializer=_initialize_worker,
+                               initargs=(log_filenames,))
+    return pool
+
+
+def _initialize_worker(log_filenames):
+    """Send worker process log messages to the same log files as the parent."""
+    handlers = [logging.FileHandler(log_filename)
+                for log_filename in log_filenames]
+    handlers.append(logging.StreamHandler())
+    logging.basicConfig(format="%(asctime)s %(message)s",
+                        level=logging.DEBUG,
+                        handlers=handlers)
+
+
+def worker_reader(filename, cache_directory=None, cache_size=100):
+    """Return the image reader for filename, one reader per process.
+
+    The reader is kept open between jobs (in a ReaderPool), so consecutive
+    image series from the same file do not need to reopen it. Opening a
+    different file closes the previous reader.
+
+    Parameters
+    ----------
+    filename : str
+        Input image filename.
+    cache_directory : str, optional
+        Location of the decoded image cache, see reader.open_image.
+    cache_size : float, optional
+        Maximum total size of the image cache, in gigabytes.
+
+    Returns
+    -------
+    images : pims image object or CachedImages
+    """
+    key = (cache_directory, cache_size)
+    if key not in _worker_readers:
+        pool = ReaderPool(max_open_readers=1,
+                          cache_directory=cache_directory,
+                          cache_size=cache_size)
+        # Close the open file when the worker process exits
+        Finalize(pool, pool.close, exitpriority=10)
+        _worker_readers[key] = pool
+    return _worker_readers[key].open(filename)
+
+
+def find_podocytes_parallel(podocyte_image, glom_regions, workers,
+                            **kwargs):
+    """Run find_podocytes on many glomeruli at the same time.
+
+    Worker threads read directly from the podocyte image, so it is never
+    copied per glomerulus.
+
+    Parameters
+    ----------
+    podocyte_image : 3D ndarray
+        Denoised image of podocyte fluorescence.
+    glom_regions : list of RegionProperties
+        Glomeruli regions, found with scikit-image regionprops.
+    workers : int
+        Number of worker threads.
+    **kwargs : optional
+        Keyword arguments passed on to find_podocytes.
+
+    Returns
+    -------
+    results : list of tuple
+        Output of find_podocytes for each glomerulus, in the same order
+        as glom_regions.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(find_podocytes, podocyte_image, glom, **kwargs)
+                   for glom in glom_regions]
+        results = [future.result() for future in futures]
+    return results
+
+
+class Prefetcher(object):
+    """Iterate over items that a background thread produces ahead of time.
+
+    A loader thread takes the next items from iterable while the current
+    item is being processed, so slow I/O (eg: decoding the next image
+    series) overlaps with computation.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Items to prefetch. It is iterated over in the loader thread.
+    depth : int, optional
+        Maximum number of items waiting to be processed.
+    max_bytes : float, optional
+        The loader thread does not start on another item while the items
+        waiting to be processed add up to at least this many bytes.
+        If None (default), only the depth is limited.
+    nbytes : callable, optional
+        Function returning the size of an item in bytes.
+        Default is the nbytes attribute of the item, or zero.
+
+    Examples
+    --------
+    >>> with Prefetcher(load_all_series(filelist), depth=2) as series_list:
+    ...     for series in series_list:
+    ...         process(series)
+    """
+    def __init__(self, iterable, depth=1, max_bytes=None, nbytes=None):
+        if depth < 1:
+            raise ValueError("'depth' keyword argument must be at least 1.")
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._nbytes = nbytes or (lambda item: getattr(item, 'nbytes', 0))
+        self._queue = queue.Queue(maxsize=depth)
+        self._condition = threading.Condition()
+        self._waiting_bytes = 0
+        self._stopped = False
+        self._finished = False
+        self._thread = threading.Thread(target=self._load,
+                                        args=(iter(iterable),),
+                                        name='podocytes-prefetch',
+                                        daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        item, size, error = self._queue.get()
+        with self._condition:
+            self._waiting_bytes -= size
+            self._condition.notify_all()
+        if error is not None:
+            self._finished = True
+            raise error
+        if item is _END:
+            self._finished = True
+            raise StopIteration
+        return item
+
+    def close(self):
+        """Stop the loader thread, discarding any prefetched items."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)  # unblock the loader thread
+            except queue.Empty:
+                pass
+        self._finished = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load(self, iterator):
+        try:
+            while True:
+                with self._condition:
+                    while (not self._stopped and self.max_bytes is not None
+                           and self._waiting_bytes >= self.max_bytes):
+                        self._condition.wait()
+                    if self._stopped:
+                        return
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    self._put(_END, 0, None)
+                    return
+                size = self._nbytes(item)
+                with self._condition:
+                    self._waiting_bytes += size
+                if not self._put(item, size, None):
+                    return
+        except Exception as err:
+            self._put(None, 0, err)  # raised again in the main thread
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()  # eg: run the finally clauses of a generator
+
+    def _put(self, item, size, error):
+        """Add to the queue, unless stopped. Returns False if stopped."""
+        while not self._stopped:
+            try:
+                self._queue.put((item, size, error), timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
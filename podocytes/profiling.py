@@ -0,0 +1,209 @@
+"""Per-stage timing and memory measurements for the processing pipeline.
+
+Each stage of the pipeline is wrapped in profile_stage, which records the
+wall time, CPU time and the peak resident memory of the process so far,
+plus the size of the main array the stage works on. The process peak memory
+is a high-water mark over the process lifetime, not the memory used by the
+stage itself: it only goes up at the stage that raised it. Records are tagged with the image
+file, series and glomerulus they belong to. Profiling is off by default,
+and costs nothing more than a function call per stage when it is off.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# CPU time of the current thread, so worker threads measure only themselves.
+# Falls back to the CPU time of the whole process where it is unavailable.
+_thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+__all__ = ['add_profile_records',
+           'enable_profiling',
+           'pop_profile_records',
+           'profile_stage',
+           'record_array',
+           'set_profile_context',
+           'summarize_profile',
+           'write_profile']
+
+PROFILE_COLUMNS = ['filename', 'series', 'glomerulus', 'stage',
+                   'wall_time', 'cpu_time', 'process_peak_rss_mb',
+                   'array_shape', 'array_mb']
+
+_enabled = False
+_context = {}
+_records = []
+_lock = threading.Lock()
+
+
+def enable_profiling(enabled=True):
+    """Turn per-stage profiling on or off for this process."""
+    global _enabled
+    _enabled = enabled
+
+
+def set_profile_context(filename=None, series=None):
+    """Set the image file and series that the next stages belong to."""
+    _context['filename'] = filename
+    _context['series'] = series
+
+
+@contextmanager
+def profile_stage(stage, glomerulus=None):
+    """Measure a single stage of the pipeline.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the pipeline stage.
+    glomerulus : int, optional
+        Label number of the glomerulus, for per glomerulus stages.
+
+    Yields
+    ------
+    record : dict
+        Profile record for the stage. Use record_array to add the size
+        of the array the stage works on.
+
+    Examples
+    --------
+    >>> with profile_stage('denoise_image') as record:
+    ...     denoised = denoise_image(image)
+    ...     record_array(record, denoised)
+    """
+    record = {}
+    if not _enabled:
+        yield record
+        return
+    wall_start = time.perf_counter()
+    cpu_start = _thread_time()
+    yield record
+    cpu_time = _thread_time() - cpu_start
+    wall_time = time.perf_counter() - wall_start
+    record = dict(filename=_context.get('filename'),
+                  series=_context.get('series'),
+                  glomerulus=glomerulus,
+                  stage=stage,
+                  wall_time=wall_time,
+                  cpu_time=cpu_time,
+                  process_peak_rss_mb=_process_peak_rss_mb(),
+                  **record)
+    with _lock:
+        _records.append(record)
+
+
+def record_array(record, *arrays):
+    """Add the shape and total size of the stage arrays to a profile record.
+
+    Parameters
+    ----------
+    record : dict
+        Profile record, from profile_stage.
+    *arrays : ndarray
+        Arrays used by the stage. The shape of the first array is recorded,
+        and the total size of all of them in megabytes.
+    """
+    record['array_shape'] = 'x'.join(str(n) for n in arrays[0].shape)
+    record['array_mb'] = sum(array.nbytes for array in arrays) / 2 ** 20
+
+
+def pop_profile_records():
+    """Return the profile records collected so far, and clear them."""
+    with _lock:
+        records = list(_records)
+        _records.clear()
+    return records
+
+
+def add_profile_records(records):
+    """Add profile records, for example those returned by a worker process."""
+    with _lock:
+        _records.extend(records)
+
+
+def summarize_profile(profile, n_stages=10):
+    """Summary table of the slowest pipeline stages.
+
+    Parameters
+    ----------
+    profile : DataFrame
+        Profile records, one row per stage run.
+    n_stages : int, optional
+        Number of stages in the summary table.
+
+    Returns
+    -------
+    summary : DataFrame
+        Number of runs, total, mean and maximum wall time, total CPU time
+        and the largest process peak memory seen after each stage, sorted
+        by total wall time (slowest first).
+    """
+    grouped = profile.groupby('stage')
+    summary = pd.DataFrame({
+        'count': grouped['wall_time'].count(),
+        'total_wall_time': grouped['wall_time'].sum(),
+        'mean_wall_time': grouped['wall_time'].mean(),
+        'max_wall_time': grouped['wall_time'].max(),
+        'total_cpu_time': grouped['cpu_time'].sum(),
+        'process_peak_rss_mb': grouped['process_peak_rss_mb'].max(),
+    })
+    summary = summary.sort_values('total_wall_time', ascending=False)
+    return summary.head(n_stages)
+
+
+def write_profile(output_directory, timestamp):
+    """Save the collected profile records and log the slowest stages.
+
+    Writes one row per stage run to a csv file, and the same records plus
+    the summary table to a json file, next to the log file.
+
+    Parameters
+    ----------
+    output_directory : str
+        Output directory location.
+    timestamp : str
+        Timestamp used in the output filenames.
+
+    Returns
+    -------
+    profile : DataFrame or None
+        Profile records, or None if profiling was not enabled.
+    """
+    records = pop_profile_records()
+    if len(records) == 0:
+        return None
+    profile = pd.DataFrame(records, columns=PROFILE_COLUMNS)
+    summary = summarize_profile(profile)
+    basename = os.path.join(output_directory, f"profile_podo_{timestamp}")
+    profile.to_csv(basename + '.csv', index=False)
+    with open(basename + '.json', 'w') as output_file:
+        json.dump({'records': json.loads(profile.to_json(orient='records')),
+                   'summary': json.loads(summary.reset_index()
+                                         .to_json(orient='records'))},
+                  output_file, indent=2)
+    logging.info("========== SLOWEST STAGES ==========")
+    for line in summary.round(3).to_string().splitlines():
+        logging.info(line)
+    logging.info(f"Profile saved to {basename}.csv and {basename}.json")
+    return profile
+
+
+def _process_peak_rss_mb():
+    """Peak resident memory of this process so far, in megabytes."""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss / 2 ** 20  # bytes on macOS
+    return peak_rss / 2 ** 10  # kilobytes on Linux
@@ -0,0 +1,680 @@
+"""Image file readers, with a pool of open readers and read metrics.
+
+TIFF and OME-TIFF files are read directly with tifffile, and uncompressed
+image data is memory-mapped instead of decoded. Every other file format
+(eg: .lif) is read with Bio-Formats.
+
+Opening an image file with Bio-Formats is slow, so a ReaderPool keeps
+recently used readers open and hands back the same reader when a file is
+opened again. The Java virtual machine is started by the first Bio-Formats
+reader in each process and shared by every reader after that.
+
+The time spent opening files and decoding image planes is added up per
+process, see reader_metrics.
+"""
+import os
+import time
+import mmap
+import logging
+import threading
+import collections
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pims
+import tifffile
+
+from podocytes.cache import (evict_cache,
+                             load_cached_channel,
+                             load_manifest,
+                             save_cached_channel,
+                             save_manifest)
+from podocytes.chunked import empty_array
+
+
+__all__ = ['CachedImages',
+           'LoadedSeries',
+           'ReaderPool',
+           'TiffImages',
+           'add_reader_metrics',
+           'is_memory_mapped',
+           'load_series',
+           'log_reader_metrics',
+           'open_image',
+           'pop_reader_metrics',
+           'read_channel',
+           'read_channels',
+           'reader_metrics',
+           'uses_bioformats']
+
+# Filename extensions read with tifffile instead of Bio-Formats
+TIFF_EXTENSIONS = ('.tif', '.tiff')  # including .ome.tif and .ome.tiff
+
+# Conversion of OME and ImageJ length units to microns
+MICRONS_PER_UNIT = {'pm': 1e-6, 'nm': 1e-3, 'um': 1.0, 'µm': 1.0,
+                    '\\u00B5m': 1.0, 'micron': 1.0, 'microns': 1.0,
+                    'mm': 1e3, 'cm': 1e4, 'm': 1e6}
+
+READER_METRICS = ['files_opened', 'open_time', 'readers_reused',
+                  'readers_closed', 'planes_decoded', 'bytes_decoded',
+                  'decode_time', 'bytes_mapped']
+
+_metrics = collections.Counter()
+_metrics_lock = threading.Lock()
+
+
+def open_image(filename, cache_directory=None, cache_size=100):
+    """Open an image file, reading from the image cache when possible.
+
+    Parameters
+    ----------
+    filename : str
+        Input image filename.
+    cache_directory : str, optional
+        Location of the decoded image cache. If None (default),
+        the image file is opened directly, see uses_bioformats.
+    cache_size : float, optional
+        Maximum total size of the image cache, in gigabytes.
+
+    Returns
+    -------
+    images : pims image object, TiffImages or CachedImages
+    """
+    if cache_directory is None:
+        return _open_file(filename)
+    return CachedImages(filename, cache_directory, cache_size)
+
+
+def uses_bioformats(filename):
+    """Whether an image file is read with Bio-Formats, from its extension.
+
+    TIFF and OME-TIFF files are read with tifffile, which does not need
+    the Java virtual machine. All other file formats use Bio-Formats.
+
+    Parameters
+    ----------
+    filename : str
+        Input image filename.
+
+    Returns
+    -------
+    bool
+    """
+    return not filename.lower().endswith(TIFF_EXTENSIONS)
+
+
+class ReaderPool(object):
+    """Open image readers, reused whenever the same file is opened again.
+
+    At most max_open_readers readers are kept open. Opening another file
+    closes the least recently used reader, and closing the pool closes
+    all of them, so file handles are released at a predictable time.
+
+    Parameters
+    ----------
+    max_open_readers : int, optional
+        Maximum number of image files kept open at once.
+    cache_directory : str, optional
+        Location of the decoded image cache, see open_image.
+    cache_size : float, optional
+        Maximum total size of the image cache, in gigabytes.
+
+    Examples
+    --------
+    >>> with ReaderPool(cache_directory=args.cache_directory) as pool:
+    ...     for filename in filelist:
+    ...         images = pool.open(filename)
+    """
+    def __init__(self, max_open_readers=2, cache_directory=None,
+                 cache_size=100):
+        if max_open_readers < 1:
+            raise ValueError("'max_open_readers' keyword argument "
+                             "must be at least 1.")
+        self.max_open_readers = max_open_readers
+        self.cache_directory = cache_directory
+        self.cache_size = cache_size
+        self._readers = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def open(self, filename):
+        """Return an image reader for filename, reusing an open reader.
+
+        Parameters
+        ----------
+        filename : str
+            Input image filename.
+
+        Returns
+        -------
+        images : pims image object or CachedImages
+        """
+        with self._lock:
+            if filename in self._readers:
+                self._readers.move_to_end(filename)
+                _add_metrics(readers_reused=1)
+                return self._readers[filename]
+            images = open_image(filename, self.cache_directory,
+                                self.cache_size)
+            self._readers[filename] = images
+            while len(self._readers) > self.max_open_readers:
+                self._close_reader(next(iter(self._readers)))
+            return images
+
+    def close(self, filename=None):
+        """Close the reader for filename, or every reader if None."""
+        with self._lock:
+            if filename is None:
+                for open_filename in list(self._readers):
+                    self._close_reader(open_filename)
+            elif filename in self._readers:
+                self._close_reader(filename)
+
+    def __contains__(self, filename):
+        return filename in self._readers
+
+    def __len__(self):
+        """Number of open readers."""
+        return len(self._readers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _close_reader(self, filename):
+        images = self._readers.pop(filename)
+        close = getattr(images, 'close', None)
+        if close is not None:
+            close()
+        _add_metrics(readers_closed=1)
+
+
+class CachedImages(object):
+    """Image file reader backed by the on-disk image cache.
+
+    Behaves like the pims Bio-Formats reader for the parts of its interface
+    used by this program (series metadata, selecting a series, reading
+    channels). The image file (and for Bio-Formats, the Java virtual
+    machine) is only opened if something is missing from the cache.
+
+    Parameters
+    ----------
+    filename : str
+        Input image filename.
+    cache_directory : str
+        Location of the decoded image cache.
+    cache_size : float, optional
+        Maximum total size of the image cache, in gigabytes.
+    """
+    def __init__(self, filename, cache_directory, cache_size=100):
+        self.filename = filename
+        self.cache_directory = cache_directory
+        self.cache_size = cache_size
+        self.series = 0
+        self.bundle_axes = 'zyxc'
+        self._images = None
+        manifest = load_manifest(cache_directory, filename)
+        if manifest is None:
+            manifest = self._build_manifest()
+            save_manifest(cache_directory, filename, manifest)
+        self.metadata = _CachedMetadata(manifest)
+
+    def read_channel(self, channel):
+        """Read a single channel of the current series, see read_channel."""
+        volume = load_cached_channel(self.cache_directory, self.filename,
+                                     self.series, channel)
+        if volume is None:
+            images = self._open()
+            images.series = self.series
+            volume = read_channel(images, channel)
+            volume = save_cached_channel(self.cache_directory, self.filename,
+                                         self.series, channel, volume)
+            evict_cache(self.cache_directory, self.cache_size)
+        return volume
+
+    def __getitem__(self, index):
+        """Return the whole 'zyxc' image bundle for the current series."""
+        if index != 0:
+            raise IndexError('Only one zyxc image bundle per series.')
+        n_channels = self.metadata.n_channels(self.series)
+        channels = read_channels(self, list(range(n_channels)))
+        metadata = dict(channels[0].metadata, axes='zyxc')
+        return pims.Frame(np.stack(channels, axis=-1), metadata=metadata)
+
+    def close(self):
+        if self._images is not None:
+            self._images.close()
+            self._images = None
+
+    def _open(self):
+        if self._images is None:
+            logging.info(f"Decoding {self.filename}")
+            self._images = _open_file(self.filename)
+        return self._images
+
+    def _build_manifest(self):
+        metadata = self._open().metadata
+        series = [{'id': str(metadata.ImageID(i)),
+                   'name': str(metadata.ImageName(i)),
+                   'n_channels': int(metadata.PixelsSizeC(i))}
+                  for i in range(metadata.ImageCount())]
+        return {'series': series}
+
+
+class _CachedMetadata(object):
+    """Series metadata from the image cache, named like pims metadata."""
+    def __init__(self, manifest):
+        self._series = manifest['series']
+
+    def ImageCount(self):
+        return len(self._series)
+
+    def ImageID(self, series):
+        return self._series[series]['id']
+
+    def ImageName(self, series):
+        return self._series[series]['name']
+
+    def n_channels(self, series):
+        return self._series[series]['n_channels']
+
+
+class TiffImages(object):
+    """TIFF and OME-TIFF file reader using tifffile, without Bio-Formats.
+
+    Behaves like the pims Bio-Formats reader for the parts of its interface
+    used by this program (series metadata, selecting a series, reading
+    channels). Uncompressed image data stored contiguously in the file is
+    memory-mapped, so only the planes that are used are read from disk:
+    images[0] and read_channel return views of the file contents.
+    Compressed image data is decoded once per image series.
+
+    Physical pixel sizes are read from the OME-XML or ImageJ metadata,
+    or else the TIFF resolution tags, into the 'mpp' and 'mppZ'
+    metadata fields (in microns).
+
+    Parameters
+    ----------
+    filename : str
+        Input image filename.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.bundle_axes = 'zyxc'
+        self._tif = tifffile.TiffFile(filename)
+        self._series = 0
+        self._volume = None
+        self.metadata = _TiffMetadata(self._tif, filename)
+
+    @property
+    def series(self):
+        """Current image series number."""
+        return self._series
+
+    @series.setter
+    def series(self, series):
+        if series != self._series:
+            self._volume = None
+        self._series = series
+
+    def read_channel(self, channel):
+        """Read a single channel of the current series, see read_channel.
+
+        Memory-mapped image data is returned as a view, without copying,
+        so image planes are only read from disk when they are used.
+        """
+        start = time.perf_counter()
+        bundle = self[0]
+        volume = bundle[..., channel]
+        if is_memory_mapped(bundle):
+            _add_metrics(bytes_mapped=volume.nbytes)
+        else:
+            volume = np.ascontiguousarray(volume)
+            _add_metrics(planes_decoded=len(volume),
+                         bytes_decoded=volume.nbytes,
+                         decode_time=time.perf_counter() - start)
+        return pims.Frame(volume, metadata=dict(bundle.metadata, axes='zyx'))
+
+    def __getitem__(self, index):
+        """Return the whole 'zyxc' image bundle for the current series."""
+        if index != 0:
+            raise IndexError('Only one zyxc image bundle per series.')
+        if self._volume is None:
+            series = self._tif.series[self._series]
+            if series.dataoffset is not None:  # uncompressed and contiguous
+                array = tifffile.memmap(self.filename, series=self._series,
+                                        mode='r')
+            else:
+                array = series.asarray()
+            mpp, mpp_z = _physical_pixel_sizes(self._tif, self._series)
+            self._volume = pims.Frame(_zyxc(array, series.axes),
+                                      metadata={'mpp': mpp, 'mppZ': mpp_z,
+                                                'axes': 'zyxc'})
+        return self._volume
+
+    def close(self):
+        self._volume = None
+        self._tif.close()
+
+
+class _TiffMetadata(object):
+    """Series metadata of a TIFF file, named like pims metadata."""
+    def __init__(self, tif, filename):
+        self._tif = tif
+        self._filename = filename
+
+    def ImageCount(self):
+        return len(self._tif.series)
+
+    def ImageID(self, series):
+        return f"Image:{series}"
+
+    def ImageName(self, series):
+        return self._tif.series[series].name or os.path.basename(
+            self._filename)
+
+    def PixelsSizeC(self, series):
+        tiff_series = self._tif.series[series]
+        shape_only = np.broadcast_to(np.uint8(0), tiff_series.shape)
+        return _zyxc(shape_only, tiff_series.axes).shape[-1]
+
+
+def _zyxc(array, axes):
+    """View of a tifffile series array with 'zyxc' axes.
+
+    Samples (eg: RGB) are used as channels if there is no channel axis,
+    and an unnamed stack of pages as planes if there is no z axis. Only the
+    first time point of any other axis is used, like read_channel.
+    """
+    axes = axes.upper()
+    if 'Z' not in axes:
+        for stack_axis in 'QI':
+            if stack_axis in axes:
+                axes = axes.replace(stack_axis, 'Z', 1)
+                break
+    if 'C' not in axes:
+        axes = axes.replace('S', 'C', 1)
+    array = array[tuple(slice(None) if axis in 'ZYXC' else 0
+                        for axis in axes)]
+    axes = ''.join(axis for axis in axes if axis in 'ZYXC')
+    for axis in 'ZC':
+        if axis not in axes:
+            array = array[..., np.newaxis]
+            axes += axis
+    return array.transpose([axes.index(axis) for axis in 'ZYXC'])
+
+
+def _physical_pixel_sizes(tif, series):
+    """Pixel size in x-y and z of a TIFF image series, in microns.
+
+    Falls back to 1 micron voxels, with a warning, if the pixel size
+    is missing or recorded in a unit that is not recognized.
+    """
+    if tif.is_ome:
+        root = ET.fromstring(tif.ome_metadata)
+        images = [element for element in root if element.tag.endswith('Image')]
+        pixels = [element for element in images[series]
+                  if element.tag.endswith('Pixels')][0].attrib
+        if 'PhysicalSizeX' in pixels:
+            unit = MICRONS_PER_UNIT.get(pixels.get('PhysicalSizeXUnit', 'µm'))
+            unit_z = MICRONS_PER_UNIT.get(pixels.get('PhysicalSizeZUnit', 'µm'))
+            if unit is None or unit_z is None:
+                logging.warning(f"Unrecognized physical size unit in "
+                                f"{tif.filename}, assuming 1 micron voxels.")
+                return 1.0, 1.0
+            mpp = float(pixels['PhysicalSizeX']) * unit
+            mpp_z = float(pixels.get('PhysicalSizeZ', 1.0)) * unit_z
+            return mpp, mpp_z
+    page = tif.series[series].pages[0]
+    resolution = page.tags.get('XResolution')
+    if tif.is_imagej and resolution is not None:
+        imagej_metadata = tif.imagej_metadata
+        unit = MICRONS_PER_UNIT.get(imagej_metadata.get('unit'))
+        if unit is None:
+            logging.warning(f"Unrecognized physical size unit in "
+                            f"{tif.filename}, assuming 1 micron voxels.")
+            return 1.0, 1.0
+        mpp = unit * resolution.value[1] / resolution.value[0]
+        mpp_z = unit * imagej_metadata.get('spacing', 1.0)
+        return mpp, mpp_z
+    resolution_unit = page.tags.get('ResolutionUnit')
+    if resolution is not None and resolution_unit is not None:
+        unit = {2: 25400.0, 3: 1e4}.get(resolution_unit.value)  # inch, cm
+        if unit is not None:
+            mpp = unit * resolution.value[1] / resolution.value[0]
+            return mpp, mpp
+    logging.warning(f"No physical pixel size found in {tif.filename}, "
+                    f"assuming 1 micron voxels.")
+    return 1.0, 1.0
+
+
+class LoadedSeries(object):
+    """Image series with its channels already read into memory.
+
+    Used in place of an image reader by read_channel, eg: for image series
+    read ahead of time in another thread (see load_series).
+
+    Parameters
+    ----------
+    series : int
+        Image series number.
+    image_id : str
+        Image series ID, from the image metadata.
+    image_name : str
+        Image series name, from the image metadata.
+    volumes : dict
+        3D image arrays, keyed by channel number.
+    """
+    def __init__(self, series, image_id, image_name, volumes):
+        self.series = series
+        self.metadata = _SeriesMetadata(image_id, image_name)
+        self._volumes = volumes
+
+    @property
+    def nbytes(self):
+        """Total size of the channels read, in bytes."""
+        return sum(volume.nbytes for volume in self._volumes.values())
+
+    def read_channel(self, channel):
+        """Return a channel read by load_series."""
+        return self._volumes[channel]
+
+
+class _SeriesMetadata(object):
+    """Metadata of a single image series, named like pims metadata."""
+    def __init__(self, image_id, image_name):
+        self._image_id = image_id
+        self._image_name = image_name
+
+    def ImageID(self, series):
+        return self._image_id
+
+    def ImageName(self, series):
+        return self._image_name
+
+
+def load_series(images, channels):
+    """Read channels of the current image series into memory.
+
+    Parameters
+    ----------
+    images : pims image object or CachedImages
+        Image reader, with the image series already selected.
+    channels : list of int
+        Channel numbers (0-based indexing).
+
+    Returns
+    -------
+    series : LoadedSeries
+        Image series that can be used instead of images, without
+        reading from the image file again. Memory-mapped channels
+        are copied into memory.
+    """
+    volumes = {}
+    for channel, volume in zip(channels, read_channels(images, channels)):
+        if is_memory_mapped(volume):
+            volume = pims.Frame(np.array(volume), metadata=volume.metadata)
+        volumes[channel] = volume
+    return LoadedSeries(images.series,
+                        str(images.metadata.ImageID(images.series)),
+                        str(images.metadata.ImageName(images.series)),
+                        volumes)
+
+
+def is_memory_mapped(array):
+    """Whether an array is a view of a memory-mapped file.
+
+    Parameters
+    ----------
+    array : ndarray
+        Image array, eg: from read_channel.
+
+    Returns
+    -------
+    bool
+    """
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def read_channel(images, channel, directory=None):
+    """Read a single fluorescence channel of the current image series.
+
+    Only the planes belonging to the requested channel are read from disk,
+    one at a time, into a preallocated array. This avoids reading every
+    channel of the whole 'zyxc' image bundle into memory.
+
+    Parameters
+    ----------
+    images : pims image object
+        Image reader, with the image series already selected.
+    channel : int
+        Channel number (0-based indexing).
+    directory : str, optional
+        If given, planes decoded with Bio-Formats are written to a temporary
+        memory-mapped file in this directory instead of held in memory,
+        eg: for chunked processing (see chunked.empty_array).
+
+    Returns
+    -------
+    volume : pims.Frame
+        3D image array with 'zyx' axes and pims metadata,
+        including 'mpp' and 'mppZ' voxel sizes.
+    """
+    if isinstance(images, (CachedImages, LoadedSeries, TiffImages)):
+        return images.read_channel(channel)
+    start = time.perf_counter()
+    if not hasattr(images, 'get_frame_2D') or getattr(images, 'isRGB', False):
+        images.bundle_axes = 'zyxc'
+        volume = images[0][..., channel]
+    else:
+        n_planes = images.sizes.get('z', 1)
+        volume = None
+        for z in range(n_planes):
+            plane = images.get_frame_2D(c=channel, z=z, t=0)
+            if volume is None:
+                volume = empty_array((n_planes,) + plane.shape,
+                                     plane.dtype, directory)
+                metadata = dict(plane.metadata)
+            volume[z] = plane
+        for key in ['frame', 'c', 'z', 't']:
+            metadata.pop(key, None)  # per-plane metadata
+        metadata['axes'] = 'zyx'
+        volume = pims.Frame(volume, metadata=metadata)
+    _add_metrics(planes_decoded=len(volume), bytes_decoded=volume.nbytes,
+                 decode_time=time.perf_counter() - start)
+    return volume
+
+
+def read_channels(images, channels, directory=None):
+    """Read several fluorescence channels of the current image series.
+
+    Parameters
+    ----------
+    images : pims image object
+        Image reader, with the image series already selected.
+    channels : list of int
+        Channel numbers (0-based indexing).
+        Channels requested more than once are only read once.
+    directory : str, optional
+        Directory for temporary memory-mapped arrays, see read_channel.
+
+    Returns
+    -------
+    volumes : list of pims.Frame
+        3D image arrays for each channel, in the order requested.
+    """
+    volumes = {}
+    for channel in channels:
+        if channel not in volumes:
+            volumes[channel] = read_channel(images, channel, directory)
+    return [volumes[channel] for channel in channels]
+
+
+def reader_metrics():
+    """Image file open and decode metrics for this process so far.
+
+    Returns
+    -------
+    metrics : dict
+        Number of image files opened and the time it took
+        (open_time, in seconds), number of times an open reader was reused
+        or closed by a ReaderPool, the number of image planes and
+        bytes decoded and the time it took (decode_time, in seconds),
+        and the number of bytes memory-mapped instead of decoded.
+    """
+    with _metrics_lock:
+        return {key: _metrics[key] for key in READER_METRICS}
+
+
+def pop_reader_metrics():
+    """Return the reader metrics collected so far, and reset them."""
+    with _metrics_lock:
+        metrics = {key: _metrics[key] for key in READER_METRICS}
+        _metrics.clear()
+    return metrics
+
+
+def add_reader_metrics(metrics):
+    """Add reader metrics, for example those returned by a worker process."""
+    _add_metrics(**metrics)
+
+
+def log_reader_metrics(metrics=None):
+    """Log the time spent opening image files and decoding image planes.
+
+    Parameters
+    ----------
+    metrics : dict, optional
+        Reader metrics. Default is reader_metrics() for this process.
+    """
+    metrics = metrics or reader_metrics()
+    logging.info(f"Opened {metrics['files_opened']} image files in "
+                 f"{metrics['open_time']:.1f} seconds "
+                 f"({metrics['readers_reused']} reused open readers).")
+    logging.info(f"Decoded {metrics['planes_decoded']} image planes "
+                 f"({metrics['bytes_decoded'] / 2 ** 20:.1f} MB) in "
+                 f"{metrics['decode_time']:.1f} seconds.")
+    if metrics['bytes_mapped'] > 0:
+        logging.info(f"Memory-mapped {metrics['bytes_mapped'] / 2 ** 20:.1f} "
+                     f"MB of uncompressed image data.")
+
+
+def _add_metrics(**metrics):
+    with _metrics_lock:
+        _metrics.update(metrics)
+
+
+def _open_file(filename):
+    """Open an image file with tifffile or Bio-Formats, recording the time."""
+    start = time.perf_counter()
+    if uses_bioformats(filename):
+        images = pims.Bioformats(filename)
+    else:
+        images = TiffImages(filename)
+    _add_metrics(files_opened=1, open_time=time.perf_counter() - start)
+    return images
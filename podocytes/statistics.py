@@ -1,8 +1,165 @@
 import logging
+import collections
 
 import numpy as np
 import pandas as pd
 
+from podocytes.image_processing import LabelCounts
+
+DETAILED_COLUMNS = ['podocyte_label_number',
+                    'podocyte_voxel_number',
+                    'podocyte_volume',
+                    'podocyte_equiv_diam_pixels',
+                    'podocyte_centroid_x',
+                    'podocyte_centroid_y',
+                    'podocyte_centroid_z',
+                    'avg_podocyte_voxel_number',
+                    'avg_podocyte_volume',
+                    'avg_podocyte_equiv_diam_pixels',
+                    'number_of_podocytes',
+                    'podocyte_density',
+                    'glomeruli_index',
+                    'glomeruli_label_number',
+                    'glomeruli_voxel_number',
+                    'glomeruli_volume',
+                    'glomeruli_equiv_diam_pixels',
+                    'glomeruli_centroid_x',
+                    'glomeruli_centroid_y',
+                    'glomeruli_centroid_z',
+                    'image_series_num',
+                    'image_series_name',
+                    'image_filename']
+
+SUMMARY_COLUMNS = ['image_filename',
+                   'image_series_name',
+                   'image_series_num',
+                   'glomeruli_index',
+                   'glomeruli_label_number',
+                   'glomeruli_voxel_number',
+                   'glomeruli_volume',
+                   'glomeruli_equiv_diam_pixels',
+                   'glomeruli_centroid_x',
+                   'glomeruli_centroid_y',
+                   'glomeruli_centroid_z',
+                   'number_of_podocytes',
+                   'avg_podocyte_voxel_number',
+                   'avg_podocyte_volume',
+                   'podocyte_density']
+
+
+class StatisticsAccumulator(object):
+    """Columnar podocyte and glomerulus statistics for one image series.
+
+    Podocyte measurements are kept as NumPy arrays and glomerulus
+    measurements as one value per glomerulus. The detailed statistics
+    DataFrame is built once by to_dataframe, with the same columns as
+    podocyte_statistics, podocyte_avg_statistics and glom_statistics
+    produce for each glomerulus.
+
+    Parameters
+    ----------
+    image_filename : str
+        Input image filename.
+    image_series_num : str
+        Image series ID, from the image metadata.
+    image_series_name : str
+        Image series name, from the image metadata.
+    """
+    def __init__(self, image_filename, image_series_num, image_series_name):
+        self.image_filename = image_filename
+        self.image_series_num = image_series_num
+        self.image_series_name = image_series_name
+        self._podocytes = collections.defaultdict(list)  # arrays
+        self._glomeruli = collections.defaultdict(list)  # one value per glom
+        self._n_podocytes = []
+
+    def __len__(self):
+        """Number of podocyte rows collected so far."""
+        return int(sum(self._n_podocytes))
+
+    def add_glomerulus(self, glom, podocyte_regions, centroid_offset,
+                       voxel_volume):
+        """Add the statistics for a single glomerulus and its podocytes.
+
+        Glomeruli without any podocytes are not added, and do not use up
+        a glomeruli_index number.
+
+        Parameters
+        ----------
+        glom : GlomerulusMeasurement or RegionProperties
+            Glomerulus measurements, see glom_statistics.
+        podocyte_regions : LabelCounts or list of RegionProperties
+            Podocyte measurements, from count_labels (faster),
+            or region properties (from scikit-image regionprops).
+        centroid_offset : tuple of int
+            Coordinate offset of glomeruli subvolume in image.
+        voxel_volume : float
+            Real space volume of a single image voxel.
+
+        Returns
+        -------
+        n_podocytes : int
+            Number of podocytes added.
+        """
+        counts = _label_counts(podocyte_regions)
+        n_podocytes = len(counts.label)
+        if n_podocytes == 0:
+            return 0
+        voxel_number = counts.area
+        # Centroid coords are (x, y, z) and NOT (plane, row, column)
+        centroid = counts.centroid + np.asarray(centroid_offset)
+        equiv_diam = counts.equivalent_diameter
+        podocytes = {
+            'podocyte_label_number': counts.label,
+            'podocyte_voxel_number': voxel_number,
+            'podocyte_volume': voxel_number * voxel_volume,
+            'podocyte_equiv_diam_pixels': equiv_diam,
+            'podocyte_centroid_x': centroid[:, 2],
+            'podocyte_centroid_y': centroid[:, 1],
+            'podocyte_centroid_z': centroid[:, 0],
+        }
+        for column, values in podocytes.items():
+            self._podocytes[column].append(values)
+        filled_area = glom.filled_area
+        glomerulus = {
+            'avg_podocyte_voxel_number': np.mean(voxel_number),
+            'avg_podocyte_volume': np.mean(podocytes['podocyte_volume']),
+            'avg_podocyte_equiv_diam_pixels': np.mean(equiv_diam),
+            'number_of_podocytes': n_podocytes,
+            'podocyte_density': n_podocytes / (filled_area * voxel_volume),
+            'glomeruli_index': len(self._n_podocytes),
+            'glomeruli_label_number': glom.label,
+            'glomeruli_voxel_number': filled_area,
+            'glomeruli_volume': filled_area * voxel_volume,
+            'glomeruli_equiv_diam_pixels': glom.equivalent_diameter,
+            'glomeruli_centroid_x': glom.centroid[2],
+            'glomeruli_centroid_y': glom.centroid[1],
+            'glomeruli_centroid_z': glom.centroid[0],
+            'image_series_num': self.image_series_num,
+            'image_series_name': self.image_series_name,
+            'image_filename': self.image_filename,
+        }
+        for column, value in glomerulus.items():
+            self._glomeruli[column].append(value)
+        self._n_podocytes.append(n_podocytes)
+        return n_podocytes
+
+    def to_dataframe(self):
+        """Return the detailed statistics, one row per podocyte.
+
+        Returns
+        -------
+        df : DataFrame
+            Pandas dataframe with the DETAILED_COLUMNS.
+        """
+        columns = {}
+        for column, arrays in self._podocytes.items():
+            columns[column] = np.concatenate(arrays)
+        for column, values in self._glomeruli.items():
+            columns[column] = np.repeat(np.array(values), self._n_podocytes)
+        df = pd.DataFrame(columns, columns=DETAILED_COLUMNS)
+        return df
+
 
 def glom_statistics(df, glom, glom_index, voxel_volume):
     """Add glomerulus information to podocyte statistics for a single glom.
@@ -11,8 +168,9 @@ def glom_statistics(df, glom, glom_index, voxel_volume):
     ----------
     df : DataFrame
         Pandas dataframe containing values for podocytes.
-    glom : RegionProperties
-         Glomerulus region properties (from scikit-image regionprops).
+    glom : GlomerulusMeasurement or RegionProperties
+         Glomerulus measurements (from measure_glomerulus),
+         or region properties (from scikit-image regionprops).
     glom_index : int
         Integer label for glomerulus.
     voxel_volume : float
@@ -24,12 +182,13 @@ def glom_statistics(df, glom, glom_index, voxel_volume):
         Input pandas dataframe now containing additional columns
         containing data about the outer glomerulus.
     """
+    filled_area = glom.filled_area  # only read once, slow for regionprops
     df['number_of_podocytes'] = len(df)
-    df['podocyte_density'] = len(df) / (glom.filled_area * voxel_volume)
+    df['podocyte_density'] = len(df) / (filled_area * voxel_volume)
     df['glomeruli_index'] = glom_index
     df['glomeruli_label_number'] = glom.label
-    df['glomeruli_voxel_number'] = glom.filled_area
-    df['glomeruli_volume'] = (glom.filled_area * voxel_volume)
+    df['glomeruli_voxel_number'] = filled_area
+    df['glomeruli_volume'] = (filled_area * voxel_volume)
     df['glomeruli_equiv_diam_pixels'] = glom.equivalent_diameter
     df['glomeruli_centroid_x'] = glom.centroid[2]
     df['glomeruli_centroid_y'] = glom.centroid[1]
@@ -42,8 +201,9 @@ def podocyte_statistics(podocyte_regions, centroid_offset, voxel_volume):
 
     Parameters
     ----------
-    podocyte_regions : List of RegionProperties
-        Region properties for podocytes identified.
+    podocyte_regions : LabelCounts or list of RegionProperties
+        Podocyte measurements, from count_labels (faster),
+        or region properties (from scikit-image regionprops).
     centroid_offset : tuple of int
         Coordinate offset of glomeruli subvolume in image.
     voxel_volume : float
@@ -62,22 +222,17 @@ def podocyte_statistics(podocyte_regions, centroid_offset, voxel_volume):
                     'podocyte_centroid_x',
                     'podocyte_centroid_y',
                     'podocyte_centroid_z']
-    contents_list = []
-    for pod in podocyte_regions:
-        real_podocyte_centroid = tuple(pod.centroid[dim] + centroid_offset[dim]
-                                       for dim in range(len(pod.centroid)))
-        # Add interesting statistics to the dataframe
-        # Centroid coords are (x, y, z) and NOT (plane, row, column)
-        contents = [pod.label,
-                    pod.area,
-                    pod.area * voxel_volume,
-                    pod.equivalent_diameter,
-                    real_podocyte_centroid[2],
-                    real_podocyte_centroid[1],
-                    real_podocyte_centroid[0]]
-        # Add individual podocyte statistics to dataframe
-        contents_list.append(contents)
-    df = pd.DataFrame(contents_list, columns=column_names)
+    counts = _label_counts(podocyte_regions)
+    # Centroid coords are (x, y, z) and NOT (plane, row, column)
+    centroid = counts.centroid + np.asarray(centroid_offset)
+    contents = [counts.label,
+                counts.area,
+                counts.area * voxel_volume,
+                counts.equivalent_diameter,
+                centroid[:, 2],
+                centroid[:, 1],
+                centroid[:, 0]]
+    df = pd.DataFrame(dict(zip(column_names, contents)), columns=column_names)
     return df
 
 
@@ -121,23 +276,27 @@ def summarize_statistics(detailed_stats, output_filename):
         Pandas dataframe containing average podocyte statistics per glomerulus.
     """
     if len(detailed_stats) > 0:
-        summary_columns = ['image_filename',
-                           'image_series_name',
-                           'image_series_num',
-                           'glomeruli_index',
-                           'glomeruli_label_number',
-                           'glomeruli_voxel_number',
-                           'glomeruli_volume',
-                           'glomeruli_equiv_diam_pixels',
-                           'glomeruli_centroid_x',
-                           'glomeruli_centroid_y',
-                           'glomeruli_centroid_z',
-                           'number_of_podocytes',
-                           'avg_podocyte_voxel_number',
-                           'avg_podocyte_volume',
-                           'podocyte_density']
-        summary_stats = detailed_stats[summary_columns].drop_duplicates()
+        group_columns = SUMMARY_COLUMNS[:4]  # one group per glomerulus
+        summary_stats = detailed_stats[SUMMARY_COLUMNS].drop_duplicates(
+            subset=group_columns)
         summary_stats.reset_index(drop=True, inplace=True)
         summary_stats.to_csv(output_filename)
         logging.info(f'Saved summary statistics to file: {output_filename}')
         return summary_stats
+
+
+def _label_counts(podocyte_regions):
+    """Podocyte measurements as LabelCounts arrays."""
+    if isinstance(podocyte_regions, LabelCounts):
+        return podocyte_regions
+    area = np.array([pod.area for pod in podocyte_regions], dtype=np.int64)
+    centroid = np.array([pod.centroid for pod in podocyte_regions],
+                        dtype=np.float64)
+    if len(area) == 0:
+        centroid = np.zeros((0, 3))
+    ndim = centroid.shape[1]
+    return LabelCounts(np.array([pod.label for pod in podocyte_regions],
+                                dtype=np.int64),
+                       area,
+                       centroid,
+                       (2 * ndim * area / np.pi) ** (1 / ndim))
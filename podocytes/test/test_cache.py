@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import pims
+
+from podocytes.cache import (array_cache_key,
+                             cached_intermediate,
+                             denoise_image_cached,
+                             evict_cache,
+                             file_cache_key,
+                             find_glomeruli_cached,
+                             load_cached_channel,
+                             load_manifest,
+                             save_cached_channel,
+                             save_manifest)
+from podocytes.reader import CachedImages, read_channels
+
+
+def make_image_file(tmpdir, content=b'image'):
+    filename = os.path.join(str(tmpdir), 'image.lif')
+    with open(filename, 'wb') as image_file:
+        image_file.write(content)
+    return filename
+
+
+def make_volume(channel=0):
+    volume = np.full((4, 8, 8), channel, dtype=np.uint8)
+    metadata = {'mpp': 0.5, 'mppZ': 2.0, 'axes': 'zyx'}
+    return pims.Frame(volume, metadata=metadata)
+
+
+def test_file_cache_key(tmpdir):
+    filename = make_image_file(tmpdir)
+    key = file_cache_key(filename)
+    assert key == file_cache_key(filename)
+    make_image_file(tmpdir, content=b'a different image')
+    assert key != file_cache_key(filename)
+
+
+def test_cached_channel_roundtrip(tmpdir):
+    filename = make_image_file(tmpdir)
+    cache_directory = os.path.join(str(tmpdir), 'cache')
+    assert load_cached_channel(cache_directory, filename, 0, 1) is None
+    save_cached_channel(cache_directory, filename, 0, 1, make_volume(1))
+    output = load_cached_channel(cache_directory, filename, 0, 1)
+    assert not output.flags.writeable  # read-only memory map
+    np.testing.assert_array_equal(output, make_volume(1))
+    assert output.metadata['mppZ'] == 2.0
+
+
+def test_evict_cache(tmpdir):
+    filename = make_image_file(tmpdir)
+    cache_directory = os.path.join(str(tmpdir), 'cache')
+    for series in range(3):
+        save_cached_channel(cache_directory, filename, series, 0,
+                            make_volume())
+    array_filename = os.path.join(cache_directory, file_cache_key(filename),
+                                  'series0_channel0.npy')
+    os.utime(array_filename, (0, 0))  # least recently used
+    volume_size = os.path.getsize(array_filename)
+    n_evicted = evict_cache(cache_directory, 2.5 * volume_size / 1e9)
+    assert n_evicted == 1
+    assert load_cached_channel(cache_directory, filename, 0, 0) is None
+    assert load_cached_channel(cache_directory, filename, 1, 0) is not None
+
+
+def test_cached_images(tmpdir):
+    filename = make_image_file(tmpdir)
+    cache_directory = os.path.join(str(tmpdir), 'cache')
+    manifest = {'series': [{'id': 'Image:0', 'name': 'glom6',
+                            'n_channels': 2}]}
+    save_manifest(cache_directory, filename, manifest)
+    for channel in range(2):
+        save_cached_channel(cache_directory, filename, 0, channel,
+                            make_volume(channel))
+    assert load_manifest(cache_directory, filename)['series'] == \
+        manifest['series']
+    images = CachedImages(filename, cache_directory)  # no Bio-Formats needed
+    assert images.metadata.ImageCount() == 1
+    assert images.metadata.ImageName(0) == 'glom6'
+    glomeruli_view, podocytes_view = read_channels(images, [0, 1])
+    np.testing.assert_array_equal(podocytes_view, make_volume(1))
+    bundle = images[0]
+    assert bundle.shape == (4, 8, 8, 2)
+    assert bundle.metadata['axes'] == 'zyxc'
+
+
+def test_array_cache_key():
+    image = make_volume()
+    key = array_cache_key(image, sigma=[0.25, 1.0, 1.0])
+    assert key == array_cache_key(image.copy(), sigma=[0.25, 1.0, 1.0])
+    assert key != array_cache_key(image, sigma=[0.5, 1.0, 1.0])
+    assert key != array_cache_key(make_volume(1), sigma=[0.25, 1.0, 1.0])
+
+
+def test_cached_intermediate(tmpdir):
+    calls = []
+
+    def multiply(image, factor=1):
+        calls.append(image)
+        return image * factor
+
+    image = np.arange(24).reshape(2, 3, 4)
+    output = cached_intermediate(str(tmpdir), multiply, image, {'factor': 2})
+    cached = cached_intermediate(str(tmpdir), multiply, image, {'factor': 2})
+    assert len(calls) == 1
+    np.testing.assert_array_equal(output, image * 2)
+    np.testing.assert_array_equal(cached, image * 2)
+    cached_intermediate(str(tmpdir), multiply, image, {'factor': 3})
+    assert len(calls) == 2
+
+
+def test_denoise_image_cached(tmpdir):
+    image = make_volume(3)
+    output = denoise_image_cached(image, str(tmpdir))
+    cached = denoise_image_cached(image, str(tmpdir))
+    expected = denoise_image_cached(image)
+    assert not cached.flags.writeable  # loaded from disk
+    np.testing.assert_array_equal(output, expected)
+    np.testing.assert_array_equal(cached, expected)
+
+
+def test_find_glomeruli_cached_chunked(tmpdir):
+    volume = np.zeros((8, 24, 24), dtype=np.uint8)
+    volume[2:6, 4:12, 4:12] = 200
+    volume[2:6, 14:22, 14:22] = 150
+    image = pims.Frame(volume, metadata={'mpp': 0.5, 'mppZ': 2.0,
+                                         'axes': 'zyx'})
+    intermediate_directory = str(tmpdir.join('intermediate'))
+    output = find_glomeruli_cached(image, intermediate_directory,
+                                   chunk_size=(4, 12, 12),
+                                   directory=str(tmpdir))
+    assert len(os.listdir(intermediate_directory)) == 1
+    other_directory = tmpdir.mkdir('other')  # not part of the cache key
+    cached = find_glomeruli_cached(image, intermediate_directory,
+                                   chunk_size=(4, 12, 12),
+                                   directory=str(other_directory))
+    assert not cached.flags.writeable  # loaded from disk
+    assert len(os.listdir(intermediate_directory)) == 1
+    np.testing.assert_array_equal(output, find_glomeruli_cached(image))
+    np.testing.assert_array_equal(cached, output)
@@ -2,7 +2,10 @@ import os
 import argparse
 import xml.etree.ElementTree as ET
 
-from podocytes.cellcounter_xml import main, marker_coords
+import pandas as pd
+
+from podocytes.cellcounter_xml import main
+from podocytes.util import marker_coords, read_marker_coords
 
 
 def test_main(tmpdir):
@@ -24,3 +27,29 @@ def test_marker_coords():
     markers = marker_coords(xml_tree, 2)
     expected = 48
     assert len(markers) == expected
+
+
+def test_main_workers(tmpdir):
+    input_directory = os.path.join(os.path.dirname(__file__),
+                                   'testdata')
+    args = argparse.Namespace(input_directory=input_directory,
+                              output_directory=tmpdir,
+                              number_of_image_channels=2,
+                              workers=2)
+    counts = main(args)
+    assert list(counts['n_podocytes']) == [48]
+    assert list(counts['xml_image_name']) == ['51715_glom6.tif']
+
+
+def test_read_marker_coords():
+    fname = 'testdata/CellCounter_51715_glom6.xml'
+    xml_filename = os.path.join(os.path.dirname(__file__), fname)
+    expected = marker_coords(ET.parse(xml_filename), 2)
+    output = read_marker_coords(xml_filename, 2)
+    pd.testing.assert_frame_equal(output, expected)
+    assert list(output.columns) == ['Image_Filename',
+                                    'MarkerX', 'MarkerY', 'MarkerZ']
+    assert output['MarkerX'].iloc[0] == 97
+    assert output['MarkerY'].iloc[0] == 59
+    assert output['MarkerZ'].iloc[0] == 20
+    assert output['Image_Filename'].iloc[0] == '51715_glom6.tif'
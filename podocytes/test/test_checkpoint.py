@@ -0,0 +1,64 @@
+import os
+
+import pytest
+import pandas as pd
+
+from podocytes.checkpoint import Checkpoint
+
+
+def test_checkpoint_resume(tmpdir):
+    directory = os.path.join(str(tmpdir), 'checkpoint')
+    stats = pd.DataFrame({'podocyte_volume': [30.5, 40.25],
+                          'image_series_name': ['glom6', 'glom6']})
+    checkpoint = Checkpoint(directory)
+    checkpoint.save('/test/input/image.lif', 0, stats)
+    checkpoint.save('/test/input/image.lif', 1, None)
+    resumed = Checkpoint(directory, resume=True)
+    assert resumed.is_complete('/test/input/image.lif', 0)
+    assert resumed.is_complete('/test/input/image.lif', 1)
+    assert not resumed.is_complete('/test/input/image.lif', 2)
+    pd.testing.assert_frame_equal(resumed.load('/test/input/image.lif', 0),
+                                  stats)
+    assert resumed.load('/test/input/image.lif', 1) is None
+
+
+def test_checkpoint_restart(tmpdir):
+    directory = os.path.join(str(tmpdir), 'checkpoint')
+    checkpoint = Checkpoint(directory)
+    checkpoint.save('/test/input/image.lif', 0, None)
+    restarted = Checkpoint(directory, resume=False)
+    assert not restarted.is_complete('/test/input/image.lif', 0)
+
+
+def test_checkpoint_partial_manifest(tmpdir):
+    directory = os.path.join(str(tmpdir), 'checkpoint')
+    checkpoint = Checkpoint(directory)
+    checkpoint.save('/test/input/image.lif', 0, None)
+    with open(checkpoint.manifest_filename, 'a') as manifest_file:
+        manifest_file.write('/test/input/image.lif,1,missing_seri')
+    resumed = Checkpoint(directory, resume=True)
+    assert resumed.is_complete('/test/input/image.lif', 0)
+    assert not resumed.is_complete('/test/input/image.lif', 1)
+
+
+def test_checkpoint_parameters(tmpdir):
+    directory = os.path.join(str(tmpdir), 'checkpoint')
+    parameters = {'minimum_glomerular_diameter': 30.0, 'precision': 'float32'}
+    checkpoint = Checkpoint(directory, parameters=parameters)
+    checkpoint.save('/test/input/image.lif', 0, None)
+    resumed = Checkpoint(directory, resume=True, parameters=dict(parameters))
+    assert resumed.is_complete('/test/input/image.lif', 0)
+    changed = dict(parameters, minimum_glomerular_diameter=40.0)
+    with pytest.raises(ValueError, match='minimum_glomerular_diameter'):
+        Checkpoint(directory, resume=True, parameters=changed)
+    restarted = Checkpoint(directory, resume=False, parameters=changed)
+    assert not restarted.is_complete('/test/input/image.lif', 0)
+
+
+def test_checkpoint_remove(tmpdir):
+    directory = os.path.join(str(tmpdir), 'checkpoint')
+    checkpoint = Checkpoint(directory)
+    checkpoint.save('/test/input/image.lif', 0, None)
+    checkpoint.remove()
+    assert not os.path.exists(directory)
+    assert not checkpoint.is_complete('/test/input/image.lif', 0)
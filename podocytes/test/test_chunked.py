@@ -0,0 +1,69 @@
+import numpy as np
+import pims
+from scipy import ndimage as ndi
+from skimage.filters import gaussian, threshold_yen
+from skimage.measure import label
+
+from podocytes.chunked import (denoise_image_chunked,
+                               find_glomeruli_chunked,
+                               gaussian_chunked,
+                               iter_chunks,
+                               label_chunked,
+                               threshold_yen_chunked)
+from podocytes.image_processing import denoise_image, find_glomeruli
+
+
+def synthetic_image():
+    rng = np.random.RandomState(0)
+    image = ndi.gaussian_filter(rng.random_sample((30, 70, 65)), 2) * 255
+    metadata = {'mpp': 0.5, 'mppZ': 1.0, 'axes': 'zyx'}
+    return pims.Frame(image.astype(np.uint8), metadata=metadata)
+
+
+def test_iter_chunks():
+    chunks = list(iter_chunks((10, 7), (4, 7)))
+    expected = [(slice(0, 4), slice(0, 7)),
+                (slice(4, 8), slice(0, 7)),
+                (slice(8, 10), slice(0, 7))]
+    assert chunks == expected
+
+
+def test_gaussian_chunked():
+    image = synthetic_image()
+    output = gaussian_chunked(image, [0.5, 1, 1], (7, 16, 20),
+                              dtype=np.float64)
+    expected = gaussian(np.asarray(image), sigma=[0.5, 1, 1])
+    np.testing.assert_array_equal(output, expected)
+
+
+def test_denoise_image_chunked_float32():
+    image = synthetic_image()
+    output = denoise_image_chunked(image, (7, 16, 20))
+    expected = denoise_image(image)
+    assert output.dtype == np.float32
+    np.testing.assert_array_equal(output, expected)
+
+
+def test_threshold_yen_chunked():
+    image = gaussian(np.asarray(synthetic_image()), sigma=1)
+    output = threshold_yen_chunked(image, (7, 16, 20))
+    expected = threshold_yen(image)
+    assert output == expected
+
+
+def test_label_chunked(tmpdir):
+    image = gaussian(np.asarray(synthetic_image()), sigma=1)
+    threshold = threshold_yen(image)
+    for connectivity in [1, 2, 3]:
+        output = label_chunked(image, threshold, (7, 16, 20),
+                               connectivity=connectivity,
+                               directory=str(tmpdir))
+        expected = label(image > threshold, connectivity=connectivity)
+        np.testing.assert_array_equal(output, expected)
+
+
+def test_find_glomeruli_chunked():
+    image = synthetic_image()
+    output = find_glomeruli_chunked(image, (8, 20, 20))
+    expected = find_glomeruli(image)
+    np.testing.assert_array_equal(output, expected)
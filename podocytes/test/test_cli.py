@@ -0,0 +1,51 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+from podocytes import cli
+
+
+def test_configure_parser_run():
+    parser = cli.configure_parser()
+    args = cli.parse_args(parser, ['run', '/test/input/dir', '/test/output/dir',
+                                   '1', '2', '30.0', '300.0', '.lif',
+                                   '--workers', '4', '--profile'])
+    assert args.function is cli.run
+    assert args.glomeruli_channel_number == 0  # 0-based indexing
+    assert args.podocyte_channel_number == 1
+    assert args.workers == 4
+    assert args.profile
+    assert args.output_format == 'csv'
+
+
+def test_configure_parser_validate():
+    parser = cli.configure_parser()
+    args = cli.parse_args(parser, ['validate', '/test/input/dir',
+                                   '/test/output/dir', '1', '2', '30.0',
+                                   '300.0', '.lif', '.xml', '/test/counts'])
+    assert args.function is cli.validate
+    assert args.counts_directory == '/test/counts'
+
+
+def test_configure_parser_no_command():
+    with pytest.raises(SystemExit):
+        cli.configure_parser().parse_args([])
+
+
+def test_count_markers(tmpdir):
+    input_directory = os.path.join(os.path.dirname(__file__), 'testdata')
+    counts = cli.main(['count-markers', input_directory, str(tmpdir), '2'])
+    assert list(counts['n_podocytes']) == [48]
+    assert os.path.exists(os.path.join(str(tmpdir),
+                                       'number_of_podocytes_from_markers.csv'))
+
+
+def test_headless_imports():
+    code = ('import sys, podocytes.cli; '
+            'print(" ".join(sorted(sys.modules)))')
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            stdout=subprocess.PIPE).stdout.decode().split()
+    for module in ['gooey', 'wx', 'matplotlib', 'jpype']:
+        assert module not in output
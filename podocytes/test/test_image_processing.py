@@ -4,14 +4,25 @@ import pytest
 import pims
 import numpy as np
 
-from podocytes.image_processing import (crop_region_of_interest,
+from scipy import ndimage as ndi
+from skimage.measure import label, regionprops
+
+from podocytes.image_processing import (count_labels,
+                                        crop_ground_truth,
+                                        crop_region_of_interest,
                                         denoise_image,
+                                        filled_voxel_count,
                                         filter_by_size,
                                         find_glomeruli,
                                         find_podocytes,
                                         gradient_of_image,
+                                        ground_truth_image,
                                         marker_controlled_watershed,
-                                        markers_from_blob_coords)
+                                        markers_from_blob_coords,
+                                        measure_glomerulus,
+                                        region_of_interest_slices,
+                                        voxel_geometry)
+from podocytes.reader import open_image
 
 blank_image = np.zeros((128, 128, 128))
 
@@ -19,7 +30,7 @@ blank_image = np.zeros((128, 128, 128))
 def open_test_image():
     fname = 'testdata/51715_glom6.tif'
     filename = os.path.join(os.path.dirname(__file__), fname)
-    images = pims.Bioformats(filename)
+    images = open_image(filename)  # read with tifffile, no Java needed
     images.bundle_axes = 'zyxc'
     return images[0]
 
@@ -35,7 +46,137 @@ class TestFindGlomeruli(object):
         assert output == expected
 
 
+def synthetic_label_image():
+    rng = np.random.RandomState(0)
+    label_image = label(rng.random_sample((12, 40, 40)) > 0.8)
+    label_image[2:10, 5:30, 8:35] = label_image.max() + 2  # skip one label
+    return label_image
+
+
+class TestFilterBySize(object):
+    @pytest.mark.parametrize('offset', [0, -1000, 0.5])
+    def test_count_labels(self, offset):
+        label_image = synthetic_label_image()
+        regions = regionprops(label_image)
+        # Non-integer or negative labels fall back on np.unique
+        labels = np.where(label_image > 0, label_image + offset, 0)
+        counts = count_labels(labels)
+        expected_labels = [region.label + offset for region in regions]
+        np.testing.assert_allclose(counts.label, expected_labels)
+        assert list(counts.area) == [region.area for region in regions]
+        np.testing.assert_allclose(counts.centroid,
+                                   [region.centroid for region in regions])
+        np.testing.assert_allclose(
+            counts.equivalent_diameter,
+            [region.equivalent_diameter for region in regions])
+
+    def test_count_labels_empty(self):
+        counts = count_labels(np.zeros((4, 8, 8), dtype=np.int32))
+        assert len(counts.label) == 0
+        assert counts.centroid.shape == (0, 3)
+
+    def test_filter_by_size(self):
+        label_image = synthetic_label_image()
+        expected = [region for region in regionprops(label_image)
+                    if 2.0 <= region.equivalent_diameter <= 30.0]
+        output = filter_by_size(label_image, 2.0, 30.0)
+        assert [region.label for region in output] == \
+               [region.label for region in expected]
+        for region, expected_region in zip(output, expected):
+            assert region.area == expected_region.area
+            assert region.bbox == expected_region.bbox
+            np.testing.assert_allclose(region.centroid,
+                                       expected_region.centroid)
+        assert output[-1].bbox == (2, 5, 8, 10, 30, 35)
+
+    def test_filter_by_size_none_found(self):
+        assert filter_by_size(np.zeros((4, 8, 8), dtype=int), 1, 10) == []
+
+    def test_filter_by_size_microns(self):
+        label_image = synthetic_label_image()
+        image = pims.Frame(label_image, metadata={'mpp': 0.5, 'mppZ': 2.0,
+                                                  'axes': 'zyx'})
+        geometry = voxel_geometry(image)
+        # Voxel volume is 0.5 cubic microns, so micron diameters are
+        # smaller than pixel diameters by a factor of 0.5 ** (1/3)
+        scale = 0.5 ** (1 / 3)
+        expected = filter_by_size(label_image, 2.0, 30.0)
+        output = filter_by_size(label_image, 2.0 * scale, 30.0 * scale,
+                                geometry=geometry)
+        assert [region.label for region in output] == \
+               [region.label for region in expected]
+
+
+class TestMeasureGlomerulus(object):
+    def test_filled_voxel_count(self):
+        rng = np.random.RandomState(0)
+        for _ in range(5):
+            mask = ndi.binary_closing(rng.random_sample((10, 20, 20)) > 0.5)
+            expected = np.count_nonzero(
+                ndi.binary_fill_holes(mask, np.ones((3, 3, 3))))
+            assert filled_voxel_count(mask) == expected
+
+    def test_filled_voxel_count_hollow_ball(self):
+        mask = np.zeros((9, 9, 9), dtype=bool)
+        mask[1:8, 1:8, 1:8] = True
+        mask[3:6, 3:6, 3:6] = False
+        assert filled_voxel_count(mask) == 7 ** 3
+
+    def test_measure_glomerulus(self):
+        label_image = np.zeros((12, 30, 30), dtype=int)
+        label_image[2:10, 4:24, 5:25] = 3
+        label_image[4:8, 10:15, 10:15] = 0  # hole
+        region = regionprops(label_image)[0]
+        output = measure_glomerulus(region)
+        assert output.label == 3
+        assert output.bbox == region.bbox
+        np.testing.assert_allclose(output.centroid, region.centroid)
+        assert output.filled_area == region.filled_area == 8 * 20 * 20
+        assert output.equivalent_diameter == region.equivalent_diameter
+
+
+class TestVoxelGeometry(object):
+    def test_voxel_geometry(self):
+        image = pims.Frame(np.zeros((4, 8, 8)),
+                           metadata={'mpp': 0.5, 'mppZ': 2.0, 'axes': 'zyx'})
+        geometry = voxel_geometry(image)
+        assert geometry.spacing == (2.0, 0.5, 0.5)
+        assert geometry.voxel_volume == 0.5
+        np.testing.assert_allclose(geometry.sigma, [0.25, 1.0, 1.0])
+        np.testing.assert_allclose(geometry.equivalent_diameter(
+            4 / 3 * np.pi * 27 / 0.5), 6.0)
+
+    def test_voxel_geometry_channel_axis(self):
+        image = pims.Frame(np.zeros((4, 8, 8)),
+                           metadata={'mpp': 0.5, 'mppZ': 2.0, 'axes': 'zyxc'})
+        assert voxel_geometry(image).axes == 'zyx'
+
+
+class TestDenoiseImage(object):
+    def test_denoise_image_precision(self):
+        image = pims.Frame(np.random.randint(0, 255, (16, 32, 32),
+                                             dtype=np.uint8),
+                           metadata={'mpp': 0.5, 'mppZ': 1.0, 'axes': 'zyx'})
+        single = denoise_image(image)
+        double = denoise_image(image, dtype=np.float64)
+        assert single.dtype == np.float32
+        assert double.dtype == np.float64
+        np.testing.assert_allclose(single, double, atol=1e-6)
+
+    def test_denoise_image_bad_dtype(self):
+        image = pims.Frame(np.zeros((4, 8, 8), dtype=np.uint8),
+                           metadata={'mpp': 0.5, 'mppZ': 1.0, 'axes': 'zyx'})
+        with pytest.raises(ValueError):
+            denoise_image(image, dtype=np.int32)
+
+
 class TestCropRegionOfInterest(object):
+    def test_crop_roi_keeps_float32(self):
+        image = np.random.random((32, 32, 32)).astype(np.float32)
+        bbox = (0, 0, 0, 16, 16, 16)
+        output = crop_region_of_interest(image, bbox, margin=4)
+        assert output.dtype == np.float32
+
     def test_crop_region_of_interest(self):
         image = np.random.random((32, 32, 32))
         bbox = (0, 0, 0, 16, 16, 16)
@@ -69,9 +210,101 @@ class TestCropRegionOfInterest(object):
                              [0., 1., 2., 3.]])
         assert output.all() == expected.all()
 
+    def test_crop_roi_interior_view(self):
+        image = np.random.random((32, 32, 32)).astype(np.float32)
+        bbox = (8, 8, 8, 16, 16, 16)
+        output = crop_region_of_interest(image, bbox, margin=4)
+        np.testing.assert_array_equal(output, image[4:20, 4:20, 4:20])
+        assert np.shares_memory(output, image)
+
+    def test_crop_roi_padding_keeps_dtype(self):
+        image = np.array([[1, 2, 4],
+                          [1, 2, 4],
+                          [1, 2, 4]], dtype=np.uint8)
+        output = crop_region_of_interest(image, (0, 0, 2, 2), margin=1)
+        expected = np.array([[2, 2, 2, 2],
+                             [2, 1, 2, 4],
+                             [2, 1, 2, 4],
+                             [2, 1, 2, 4]], dtype=np.uint8)
+        assert output.dtype == np.uint8
+        np.testing.assert_array_equal(output, expected)
+
+    def test_region_of_interest_slices(self):
+        image_slicer, pad_width = region_of_interest_slices(
+            (10, 20, 30), (1, 5, 20, 4, 15, 28), margin=3)
+        assert image_slicer == (slice(0, 7), slice(2, 18), slice(17, 30))
+        assert pad_width == ((2, 0), (0, 0), (0, 1))
+
     def test_crop_roi_bad_kwarg(self):
         image = np.random.random((32, 32, 32))
         bbox = (0, 0, 0, 16, 16, 16)
         with pytest.raises(ValueError) as e_info:
             output = crop_region_of_interest(image, bbox,
                                              pad_mode='bad_kwarg')
+
+
+class TestGradientOfImage(object):
+    def test_gradient_of_image_l1(self):
+        image = np.random.random((12, 16, 20)).astype(np.float32)
+        gradients = np.stack(np.gradient(image), axis=-1)
+        expected = np.sum(abs(gradients), axis=-1)
+        output = gradient_of_image(image)
+        assert output.dtype == np.float32
+        np.testing.assert_array_equal(output, expected)
+
+    def test_gradient_of_image_integer_input(self):
+        image = np.random.randint(0, 255, (12, 16, 20)).astype(np.uint8)
+        gradients = np.stack(np.gradient(image), axis=-1)
+        expected = np.sum(abs(gradients), axis=-1)
+        output = gradient_of_image(image)
+        np.testing.assert_array_equal(output, expected)
+
+    def test_gradient_of_image_l2(self):
+        image = np.random.random((12, 16, 20))
+        expected = np.sqrt(sum(grad ** 2 for grad in np.gradient(image)))
+        out = np.empty_like(image)
+        output = gradient_of_image(image, norm='l2', out=out)
+        assert output is out
+        np.testing.assert_allclose(output, expected)
+
+    def test_gradient_of_image_bad_kwarg(self):
+        with pytest.raises(ValueError):
+            gradient_of_image(blank_image, norm='bad_kwarg')
+
+
+class TestGroundTruthImage(object):
+    coords = np.array([[1, 2, 3],
+                       [4.7, 5.2, 6.9],   # truncated like int()
+                       [1, 2, 3],         # same pixel, last marker kept
+                       [0, 0, 10],        # outside image
+                       [-1, 2, 3]])       # outside image
+
+    def test_ground_truth_image(self):
+        output = ground_truth_image(self.coords, (8, 9, 10))
+        expected = np.zeros((8, 9, 10), dtype=np.int32)
+        expected[4, 5, 6] = 2
+        expected[1, 2, 3] = 3
+        assert output.dtype == np.int32
+        np.testing.assert_array_equal(output, expected)
+
+    def test_ground_truth_image_sparse(self):
+        output = ground_truth_image(self.coords, (8, 9, 10), sparse=True)
+        np.testing.assert_array_equal(output.coords, [[4, 5, 6], [1, 2, 3]])
+        np.testing.assert_array_equal(output.labels, [2, 3])
+        assert output.shape == (8, 9, 10)
+
+    def test_ground_truth_image_empty(self):
+        output = ground_truth_image(np.zeros((0, 3)), (4, 5, 6))
+        np.testing.assert_array_equal(output, np.zeros((4, 5, 6)))
+
+    @pytest.mark.parametrize('bbox', [(1, 1, 1, 5, 6, 7), (0, 0, 0, 2, 3, 4),
+                                      (5, 6, 7, 8, 9, 10)])
+    def test_crop_ground_truth(self, bbox):
+        rng = np.random.RandomState(0)
+        coords = rng.randint(0, 10, (40, 3))
+        dense = ground_truth_image(coords, (8, 9, 10))
+        points = ground_truth_image(coords, (8, 9, 10), sparse=True)
+        output = crop_ground_truth(points, bbox, margin=2)
+        expected = crop_region_of_interest(dense, bbox, margin=2,
+                                           pad_mode='zeros')
+        np.testing.assert_array_equal(output, expected)
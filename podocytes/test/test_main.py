@@ -2,9 +2,35 @@ import os
 import argparse
 
 import pims
+import numpy as np
 import pandas as pd
+import tifffile
+from scipy import ndimage as ndi
 
-from podocytes.main import process_image_series
+from podocytes.main import (process_files,
+                            process_files_parallel,
+                            process_image_series)
+from podocytes.output import StatisticsWriter
+
+
+def synthetic_tiff(filename, size, seed):
+    """Write an ImageJ TIFF with one glomerulus and scattered podocytes."""
+    rng = np.random.RandomState(seed)
+    zz, yy, xx = np.ogrid[:20, :size, :size]
+    centre = size // 2
+    glomerulus = (((zz - 10) / 8) ** 2 + ((yy - centre) / 30) ** 2 +
+                  ((xx - centre) / 30) ** 2) < 1
+    podocytes = np.zeros(glomerulus.shape)
+    for z, y, x in rng.randint(-15, 15, (10, 3)):
+        podocytes[10 + z // 4 - 2:10 + z // 4 + 3,
+                  centre + y - 3:centre + y + 4,
+                  centre + x - 3:centre + x + 4] = 1
+    glomeruli = ndi.gaussian_filter(glomerulus * 180.0, 2)
+    volume = np.stack([glomeruli + rng.random_sample(glomerulus.shape) * 40,
+                       podocytes * 200 + rng.random_sample(podocytes.shape) * 50],
+                      axis=1).astype(np.uint8)
+    tifffile.imwrite(filename, volume, imagej=True, resolution=(2.0, 2.0),
+                     metadata={'axes': 'ZCYX', 'spacing': 1.0, 'unit': 'um'})
 
 
 def test_process_image_series():
@@ -23,3 +49,64 @@ def test_process_image_series():
     found_number_of_podocytes = len(single_image_stats)
     expected_number_of_podocytes = 48
     assert found_number_of_podocytes == expected_number_of_podocytes
+
+
+def test_process_files_parallel():
+    input_directory = os.path.join(os.path.dirname(__file__), 'testdata')
+    filelist = [os.path.join(input_directory, '51715_glom6.tif')]
+    args = argparse.Namespace(input_directory=input_directory,
+                              output_directory='/test/output/dir',
+                              glomeruli_channel_number=0,
+                              podocyte_channel_number=1,
+                              minimum_glomerular_diameter=30.0,
+                              maximum_glomerular_diameter=300.0,
+                              file_extension='.tif',
+                              workers=2)
+    serial = pd.concat(process_files(filelist, args), ignore_index=True)
+    parallel = pd.concat(process_files_parallel(filelist, args, 2),
+                         ignore_index=True)
+    pd.testing.assert_frame_equal(serial, parallel)
+
+
+def test_process_files_parallel_output_order(tmpdir):
+    # Larger images first, so later jobs are likely to finish first
+    filelist = [str(tmpdir.join(f'image{i}.tif')) for i in range(3)]
+    for i, filename in enumerate(filelist):
+        synthetic_tiff(filename, [192, 128, 96][i], seed=i)
+    args = argparse.Namespace(input_directory=str(tmpdir),
+                              output_directory=str(tmpdir),
+                              glomeruli_channel_number=0,
+                              podocyte_channel_number=1,
+                              minimum_glomerular_diameter=10.0,
+                              maximum_glomerular_diameter=300.0,
+                              file_extension='.tif')
+    basename = str(tmpdir.join('detailed_stats'))
+    with StatisticsWriter(basename) as writer:
+        stats_list = process_files_parallel(filelist, args, 2, writer=writer)
+    written = pd.read_csv(writer.output_filename, index_col=0)
+    assert len(written) > 0
+    assert list(written['image_filename'].unique()) == filelist
+    expected = pd.concat(stats_list, ignore_index=True)
+    assert list(written['image_filename']) == \
+        list(expected['image_filename'])
+
+
+def test_process_image_series_precision():
+    fname = 'testdata/51715_glom6.tif'
+    filename = os.path.join(os.path.dirname(__file__), fname)
+    images = pims.Bioformats(filename)
+    images.bundle_axes = 'zyxc'
+    output = {}
+    for precision in ['float32', 'float64']:
+        args = argparse.Namespace(input_directory='/test/input/dir',
+                                  output_directory='/test/output/dir',
+                                  glomeruli_channel_number=0,
+                                  podocyte_channel_number=1,
+                                  minimum_glomerular_diameter=30.0,
+                                  maximum_glomerular_diameter=300.0,
+                                  file_extension='.tif',
+                                  precision=precision)
+        output[precision] = process_image_series(images, filename, args)
+    assert len(output['float32']) == len(output['float64']) == 48
+    assert list(output['float32']['number_of_podocytes']) == \
+        list(output['float64']['number_of_podocytes'])
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from podocytes.output import StatisticsWriter
+
+
+def series_stats(n_rows, series_name):
+    return pd.DataFrame({'podocyte_label_number': np.arange(1, n_rows + 1),
+                         'podocyte_volume': np.linspace(10, 20, n_rows),
+                         'image_series_name': series_name,
+                         'image_filename': 'image.lif'})
+
+
+def test_statistics_writer_csv(tmpdir):
+    basename = os.path.join(str(tmpdir), 'detailed_stats')
+    stats_list = [series_stats(3, 'glom1'), None, series_stats(2, 'glom2')]
+    with StatisticsWriter(basename) as writer:
+        for single_image_stats in stats_list:
+            writer.write(single_image_stats)
+    assert writer.output_filename == basename + '.csv'
+    expected = os.path.join(str(tmpdir), 'expected.csv')
+    pd.concat(stats_list, ignore_index=True).to_csv(expected)
+    with open(writer.output_filename) as output, open(expected) as expected:
+        assert output.read() == expected.read()
+
+
+def test_statistics_writer_parquet(tmpdir):
+    pq = pytest.importorskip('pyarrow.parquet')
+    basename = os.path.join(str(tmpdir), 'detailed_stats')
+    stats_list = [series_stats(3, 'glom1'), series_stats(2, 'glom2')]
+    stats_list[1]['podocyte_label_number'] = [1.0, 2.0]  # from checkpoint
+    with StatisticsWriter(basename, 'parquet') as writer:
+        for single_image_stats in stats_list:
+            writer.write(single_image_stats)
+    parquet_file = pq.ParquetFile(writer.output_filename)
+    assert parquet_file.metadata.num_row_groups == 2
+    column = parquet_file.schema_arrow.get_field_index('image_filename')
+    assert parquet_file.metadata.row_group(0).column(column) \
+        .has_dictionary_page
+    output = pd.read_parquet(writer.output_filename)
+    expected = pd.concat(stats_list, ignore_index=True)
+    pd.testing.assert_frame_equal(output, expected, check_dtype=False)
+
+
+def test_statistics_writer_arrow(tmpdir):
+    pa = pytest.importorskip('pyarrow')
+    basename = os.path.join(str(tmpdir), 'detailed_stats')
+    stats_list = [series_stats(3, 'glom1'), series_stats(2, 'glom2')]
+    with StatisticsWriter(basename, 'arrow') as writer:
+        for single_image_stats in stats_list:
+            writer.write(single_image_stats)
+    with pa.ipc.open_file(writer.output_filename) as reader:
+        assert reader.num_record_batches == 2
+        output = reader.read_pandas()
+    expected = pd.concat(stats_list, ignore_index=True)
+    pd.testing.assert_frame_equal(output, expected, check_dtype=False)
+
+
+def test_statistics_writer_bad_kwarg(tmpdir):
+    with pytest.raises(ValueError):
+        StatisticsWriter(os.path.join(str(tmpdir), 'stats'), 'bad_kwarg')
@@ -0,0 +1,106 @@
+import time
+import threading
+
+import numpy as np
+import pytest
+
+from podocytes.image_processing import find_podocytes
+from podocytes.parallel import Prefetcher, find_podocytes_parallel
+
+
+def synthetic_podocyte_image():
+    rng = np.random.RandomState(0)
+    image = rng.random_sample((40, 64, 64)) * 0.1
+    for z, y, x in [(10, 12, 12), (12, 20, 14), (30, 45, 50), (28, 50, 40)]:
+        image[z-2:z+3, y-2:y+3, x-2:x+3] = 1.0
+    return image
+
+
+class GlomerulusRegion(object):
+    def __init__(self, bbox):
+        self.bbox = bbox
+
+
+def test_find_podocytes_parallel():
+    image = synthetic_podocyte_image()
+    glom_regions = [GlomerulusRegion((5, 5, 5, 18, 28, 22)),
+                    GlomerulusRegion((22, 38, 34, 36, 58, 58))]
+    expected = [find_podocytes(image, glom) for glom in glom_regions]
+    output = find_podocytes_parallel(image, glom_regions, 2)
+    assert len(output) == len(expected)
+    for (counts, offset, wshed), (exp_counts, exp_offset, exp_wshed) in \
+            zip(output, expected):
+        assert offset == exp_offset
+        np.testing.assert_array_equal(wshed, exp_wshed)
+        np.testing.assert_array_equal(counts.area, exp_counts.area)
+
+
+def test_prefetcher():
+    loader_threads = set()
+
+    def items():
+        for i in range(5):
+            loader_threads.add(threading.current_thread())
+            yield np.full(3, i)
+
+    with Prefetcher(items(), depth=2) as prefetcher:
+        output = [item[0] for item in prefetcher]
+    assert output == [0, 1, 2, 3, 4]
+    assert threading.current_thread() not in loader_threads
+
+
+@pytest.mark.parametrize('depth, max_bytes, expected', [(2, None, 3),
+                                                        (4, 16, 2)])
+def test_prefetcher_limits(depth, max_bytes, expected):
+    produced = []
+
+    def items():
+        for i in range(10):
+            produced.append(i)
+            yield np.zeros(1)  # 8 bytes each
+
+    with Prefetcher(items(), depth=depth, max_bytes=max_bytes) as prefetcher:
+        time.sleep(0.3)  # give the loader thread time to run ahead
+        # depth items queued, plus one waiting to be put in the queue;
+        # or stop reading once max_bytes are waiting
+        assert len(produced) == expected
+        next(prefetcher)
+        time.sleep(0.3)
+        assert len(produced) == expected + 1
+
+
+def test_prefetcher_error():
+    def items():
+        yield 1
+        raise OSError('unreadable file')
+
+    prefetcher = Prefetcher(items())
+    assert next(prefetcher) == 1
+    with pytest.raises(OSError):
+        next(prefetcher)
+    with pytest.raises(StopIteration):
+        next(prefetcher)
+
+
+def test_prefetcher_close():
+    closed = threading.Event()
+
+    def items():
+        try:
+            while True:
+                yield 1
+        finally:
+            closed.set()
+
+    prefetcher = Prefetcher(items(), depth=1)
+    next(prefetcher)
+    prefetcher.close()
+    assert closed.is_set()
+    assert not prefetcher._thread.is_alive()
+    with pytest.raises(StopIteration):
+        next(prefetcher)
+
+
+def test_prefetcher_bad_kwarg():
+    with pytest.raises(ValueError):
+        Prefetcher([], depth=0)
@@ -0,0 +1,95 @@
+import os
+import json
+import collections
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from podocytes.profiling import (enable_profiling,
+                                 pop_profile_records,
+                                 profile_stage,
+                                 record_array,
+                                 set_profile_context,
+                                 summarize_profile,
+                                 write_profile)
+
+
+@pytest.fixture
+def profiling():
+    pop_profile_records()
+    enable_profiling()
+    yield
+    enable_profiling(False)
+    pop_profile_records()
+
+
+def test_profile_stage(profiling):
+    set_profile_context('image.lif', 2)
+    image = np.zeros((4, 5, 6), dtype=np.float32)
+    with profile_stage('blob_dog', glomerulus=3) as record:
+        record_array(record, image, image)
+    records = pop_profile_records()
+    assert len(records) == 1
+    record = records[0]
+    assert record['filename'] == 'image.lif'
+    assert record['series'] == 2
+    assert record['glomerulus'] == 3
+    assert record['stage'] == 'blob_dog'
+    assert record['array_shape'] == '4x5x6'
+    assert np.isclose(record['array_mb'], 2 * image.nbytes / 2 ** 20)
+    assert record['wall_time'] >= 0
+    assert record['cpu_time'] >= 0
+    assert 'process_peak_rss_mb' in record
+    assert pop_profile_records() == []
+
+
+def test_profile_stage_disabled():
+    enable_profiling(False)
+    with profile_stage('blob_dog') as record:
+        record_array(record, np.zeros(3))
+    assert pop_profile_records() == []
+
+
+def test_summarize_profile():
+    profile = pd.DataFrame({'stage': ['blob_dog', 'regionprops', 'blob_dog'],
+                            'wall_time': [2.0, 3.0, 4.0],
+                            'cpu_time': [1.0, 1.0, 1.0],
+                            'process_peak_rss_mb': [10.0, 20.0, 30.0]})
+    summary = summarize_profile(profile)
+    assert list(summary.index) == ['blob_dog', 'regionprops']
+    assert list(summary['count']) == [2, 1]
+    assert list(summary['total_wall_time']) == [6.0, 3.0]
+    assert list(summary['max_wall_time']) == [4.0, 3.0]
+    assert list(summary['process_peak_rss_mb']) == [30.0, 20.0]
+
+
+def test_write_profile(tmpdir, profiling):
+    output_directory = str(tmpdir)
+    set_profile_context('image.lif', 0)
+    with profile_stage('find_glomeruli'):
+        pass
+    profile = write_profile(output_directory, 'timestamp')
+    assert list(profile['stage']) == ['find_glomeruli']
+    basename = os.path.join(output_directory, 'profile_podo_timestamp')
+    assert len(pd.read_csv(basename + '.csv')) == 1
+    with open(basename + '.json') as profile_file:
+        content = json.load(profile_file)
+    assert content['records'][0]['filename'] == 'image.lif'
+    assert content['summary'][0]['stage'] == 'find_glomeruli'
+    assert write_profile(output_directory, 'timestamp') is None
+
+
+def test_find_podocytes_profile(profiling):
+    from podocytes.image_processing import find_podocytes
+    GlomerulusRegion = collections.namedtuple("GlomerulusRegion",
+                                              ["bbox", "label"])
+    image = np.random.RandomState(0).random_sample((20, 32, 32)) * 0.1
+    image[8:13, 14:19, 14:19] = 1.0
+    find_podocytes(image, GlomerulusRegion((5, 10, 10, 15, 22, 22), 7))
+    records = pop_profile_records()
+    assert [record['stage'] for record in records] == [
+        'crop_region_of_interest', 'blob_dog',
+        'marker_controlled_watershed', 'count_labels']
+    assert all(record['glomerulus'] == 7 for record in records)
+    assert records[0]['array_shape'] == '30x32x32'
@@ -0,0 +1,284 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+import numpy as np
+import pims
+import tifffile
+from pims import FramesSequenceND
+
+from podocytes import reader
+from podocytes.reader import (LoadedSeries,
+                              ReaderPool,
+                              TiffImages,
+                              is_memory_mapped,
+                              load_series,
+                              open_image,
+                              pop_reader_metrics,
+                              read_channel,
+                              read_channels,
+                              uses_bioformats)
+
+
+class ArrayReader(FramesSequenceND):
+    """Minimal pims reader for a 'zcyx' array, counting planes read."""
+    def __init__(self, array):
+        super(ArrayReader, self).__init__()
+        self._array = array
+        self.planes_read = 0
+        self._init_axis('z', array.shape[0])
+        self._init_axis('c', array.shape[1])
+        self._init_axis('y', array.shape[2])
+        self._init_axis('x', array.shape[3])
+        self._register_get_frame(self.get_frame_2D, 'yx')
+
+    @property
+    def pixel_type(self):
+        return self._array.dtype
+
+    def get_frame_2D(self, **coords):
+        self.planes_read += 1
+        plane = self._array[coords.get('z', 0), coords.get('c', 0)]
+        return pims.Frame(plane, metadata={'mpp': 0.5, 'mppZ': 2.0})
+
+
+def test_read_channel():
+    array = np.random.randint(0, 255, (5, 4, 16, 16)).astype(np.uint8)
+    images = ArrayReader(array)
+    output = read_channel(images, 2)
+    np.testing.assert_array_equal(output, array[:, 2])
+    assert output.metadata['axes'] == 'zyx'
+    assert output.metadata['mppZ'] == 2.0
+    assert images.planes_read == 5
+
+
+def test_read_channel_memory_mapped(tmpdir):
+    array = np.random.randint(0, 255, (5, 4, 16, 16)).astype(np.uint8)
+    output = read_channel(ArrayReader(array), 2, directory=str(tmpdir))
+    assert is_memory_mapped(output)
+    np.testing.assert_array_equal(output, array[:, 2])
+    assert output.metadata['axes'] == 'zyx'
+
+
+def test_read_channels():
+    array = np.random.randint(0, 255, (5, 4, 16, 16)).astype(np.uint8)
+    images = ArrayReader(array)
+    output = read_channels(images, [1, 3, 1])
+    assert len(output) == 3
+    np.testing.assert_array_equal(output[0], array[:, 1])
+    np.testing.assert_array_equal(output[1], array[:, 3])
+    assert output[2] is output[0]
+    assert images.planes_read == 10
+
+
+def test_load_series():
+    array = np.random.randint(0, 255, (5, 4, 16, 16)).astype(np.uint8)
+    images = ArrayReader(array)
+    images.series = 0
+    images.metadata = reader._SeriesMetadata('Image:0', 'series name')
+    series = load_series(images, [0, 2])
+    assert isinstance(series, LoadedSeries)
+    assert series.nbytes == 2 * 5 * 16 * 16
+    assert series.metadata.ImageName(series.series) == 'series name'
+    planes_read = images.planes_read
+    output = read_channel(series, 2)
+    np.testing.assert_array_equal(output, array[:, 2])
+    assert output.metadata['mpp'] == 0.5
+    assert images.planes_read == planes_read
+
+
+class FakeBioformats(object):
+    """Stands in for pims.Bioformats, recording when files are closed."""
+    closed = []
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def close(self):
+        FakeBioformats.closed.append(self.filename)
+
+
+@pytest.fixture
+def fake_bioformats(monkeypatch):
+    monkeypatch.setattr(reader.pims, 'Bioformats', FakeBioformats)
+    FakeBioformats.closed = []
+    pop_reader_metrics()
+    yield FakeBioformats
+    pop_reader_metrics()
+
+
+def test_reader_pool(fake_bioformats):
+    with ReaderPool(max_open_readers=2) as pool:
+        first = pool.open('a.lif')
+        assert pool.open('a.lif') is first
+        pool.open('b.lif')
+        pool.open('a.lif')  # now b.lif is the least recently used
+        pool.open('c.lif')
+        assert fake_bioformats.closed == ['b.lif']
+        assert len(pool) == 2
+        assert 'a.lif' in pool and 'c.lif' in pool
+    assert sorted(fake_bioformats.closed) == ['a.lif', 'b.lif', 'c.lif']
+    metrics = pop_reader_metrics()
+    assert metrics['files_opened'] == 3
+    assert metrics['readers_reused'] == 2
+    assert metrics['readers_closed'] == 3
+    assert metrics['open_time'] >= 0
+
+
+def test_reader_pool_close_one(fake_bioformats):
+    pool = ReaderPool()
+    pool.open('a.lif')
+    pool.open('b.lif')
+    pool.close('a.lif')
+    assert fake_bioformats.closed == ['a.lif']
+    assert 'a.lif' not in pool and len(pool) == 1
+    pool.close()
+    assert len(pool) == 0
+
+
+def test_reader_pool_bad_kwarg():
+    with pytest.raises(ValueError):
+        ReaderPool(max_open_readers=0)
+
+
+def test_read_channel_metrics():
+    array = np.random.randint(0, 255, (5, 4, 16, 16)).astype(np.uint8)
+    pop_reader_metrics()
+    read_channels(ArrayReader(array), [0, 1])
+    metrics = pop_reader_metrics()
+    assert metrics['planes_decoded'] == 10
+    assert metrics['bytes_decoded'] == 2 * 5 * 16 * 16
+    assert metrics['decode_time'] > 0
+
+
+def zcyx_array():
+    return np.random.randint(0, 255, (5, 2, 16, 20)).astype(np.uint8)
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_tiff_images_ome(tmpdir, compression):
+    array = zcyx_array()
+    filename = str(tmpdir.join('test.ome.tif'))
+    tifffile.imwrite(filename, array, compression=compression,
+                     metadata={'axes': 'ZCYX', 'Name': 'glom6',
+                               'PhysicalSizeX': 250,
+                               'PhysicalSizeXUnit': 'nm',
+                               'PhysicalSizeY': 250,
+                               'PhysicalSizeYUnit': 'nm',
+                               'PhysicalSizeZ': 1.5})
+    images = open_image(filename)
+    assert isinstance(images, TiffImages)
+    assert images.metadata.ImageCount() == 1
+    assert images.metadata.ImageName(0) == 'glom6'
+    assert images.metadata.PixelsSizeC(0) == 2
+    assert images[0].shape == (5, 16, 20, 2)
+    output = read_channel(images, 1)
+    np.testing.assert_array_equal(output, array[:, 1])
+    assert is_memory_mapped(output) == (compression is None)
+    assert output.metadata['mpp'] == 0.25
+    assert output.metadata['mppZ'] == 1.5
+    assert output.metadata['axes'] == 'zyx'
+    images.close()
+
+
+def test_tiff_images_imagej(tmpdir):
+    array = zcyx_array()
+    filename = str(tmpdir.join('test.tif'))
+    tifffile.imwrite(filename, array, imagej=True, resolution=(2.0, 2.0),
+                     metadata={'axes': 'ZCYX', 'spacing': 2.0, 'unit': 'um'})
+    with ReaderPool() as pool:
+        images = pool.open(filename)
+        assert images.metadata.ImageName(0) == 'test.tif'
+        output = read_channel(images, 0)
+        np.testing.assert_array_equal(output, array[:, 0])
+        assert output.metadata['mpp'] == 0.5
+        assert output.metadata['mppZ'] == 2.0
+
+
+def test_tiff_images_ome_unknown_unit(tmpdir, caplog):
+    array = zcyx_array()
+    filename = str(tmpdir.join('test.ome.tif'))
+    tifffile.imwrite(filename, array,
+                     metadata={'axes': 'ZCYX',
+                               'PhysicalSizeX': 2500,
+                               'PhysicalSizeXUnit': 'Å',
+                               'PhysicalSizeZ': 1.5})
+    images = TiffImages(filename)
+    output = read_channel(images, 0)
+    assert output.metadata['mpp'] == 1.0
+    assert output.metadata['mppZ'] == 1.0
+    assert 'Unrecognized physical size unit' in caplog.text
+    images.close()
+
+
+def test_tiff_images_imagej_unknown_unit(tmpdir, caplog):
+    array = zcyx_array()
+    filename = str(tmpdir.join('test.tif'))
+    tifffile.imwrite(filename, array, imagej=True, resolution=(2.0, 2.0),
+                     metadata={'axes': 'ZCYX', 'spacing': 2.0,
+                               'unit': 'pixel'})
+    images = TiffImages(filename)
+    output = read_channel(images, 0)
+    assert output.metadata['mpp'] == 1.0
+    assert output.metadata['mppZ'] == 1.0
+    assert 'Unrecognized physical size unit' in caplog.text
+    images.close()
+
+def test_physical_pixel_sizes_imagej_no_resolution(caplog):
+    page = SimpleNamespace(tags={})
+    tif = SimpleNamespace(filename='test.tif', is_ome=False, is_imagej=True,
+                          imagej_metadata={'unit': 'um', 'spacing': 2.0},
+                          series=[SimpleNamespace(pages=[page])])
+    assert reader._physical_pixel_sizes(tif, 0) == (1.0, 1.0)
+    assert 'No physical pixel size found' in caplog.text
+
+
+def test_tiff_images_memory_mapped(tmpdir):
+    array = zcyx_array()
+    filename = str(tmpdir.join('test.tif'))
+    tifffile.imwrite(filename, array, imagej=True,
+                     metadata={'axes': 'ZCYX'})
+    images = TiffImages(filename)
+    pop_reader_metrics()
+    output = read_channel(images, 1)
+    metrics = pop_reader_metrics()
+    assert is_memory_mapped(images[0])
+    assert is_memory_mapped(output)  # view, not a copy
+    assert is_memory_mapped(output[1:3, 4:8])
+    assert metrics['bytes_mapped'] == output.nbytes
+    assert metrics['planes_decoded'] == 0
+    np.testing.assert_array_equal(output, array[:, 1])
+    loaded = load_series(images, [0, 1])
+    assert not is_memory_mapped(loaded.read_channel(1))
+    np.testing.assert_array_equal(loaded.read_channel(1), array[:, 1])
+    images.close()
+
+
+def test_tiff_images_plain_stack(tmpdir):
+    array = zcyx_array()[:, 0]
+    filename = str(tmpdir.join('test.tiff'))
+    tifffile.imwrite(filename, array)
+    images = TiffImages(filename)
+    assert images[0].shape == (5, 16, 20, 1)
+    np.testing.assert_array_equal(read_channel(images, 0), array)
+    assert read_channel(images, 0).metadata['mpp'] == 1.0
+    images.close()
+
+
+def test_uses_bioformats():
+    assert uses_bioformats('image.lif')
+    assert not uses_bioformats('image.tif')
+    assert not uses_bioformats('IMAGE.TIFF')
+    assert not uses_bioformats('image.ome.tif')
+
+
+def test_read_channel_bioformats():
+    fname = 'testdata/51715_glom6.tif'
+    filename = os.path.join(os.path.dirname(__file__), fname)
+    images = pims.Bioformats(filename)
+    output = read_channel(images, 1)
+    images.bundle_axes = 'zyxc'
+    expected = images[0][..., 1]
+    np.testing.assert_array_equal(output, expected)
+    assert output.metadata['mpp'] == expected.metadata['mpp']
+    assert output.metadata['mppZ'] == expected.metadata['mppZ']
@@ -1,7 +1,16 @@
 import os
+import collections
+
+import numpy as np
 import pandas as pd
 
-from podocytes.statistics import (glom_statistics,
+from skimage.measure import regionprops
+
+from podocytes.image_processing import GlomerulusMeasurement, count_labels
+from podocytes.statistics import (DETAILED_COLUMNS,
+                                  SUMMARY_COLUMNS,
+                                  StatisticsAccumulator,
+                                  glom_statistics,
                                   podocyte_statistics,
                                   podocyte_avg_statistics,
                                   summarize_statistics)
@@ -21,6 +30,21 @@ def test_podocyte_avg_statistics():
     assert output.all().all() == expected.all().all()
 
 
+def test_glom_statistics():
+    df = pd.DataFrame({'podocyte_voxel_number': [100, 200]})
+    glom = GlomerulusMeasurement(label=4, bbox=(0, 0, 0, 10, 20, 30),
+                                 centroid=(5.0, 10.0, 15.0), filled_area=500,
+                                 equivalent_diameter=9.8)
+    output = glom_statistics(df, glom, 1, 0.5)
+    assert list(output['number_of_podocytes']) == [2, 2]
+    assert list(output['podocyte_density']) == [2 / 250, 2 / 250]
+    assert list(output['glomeruli_label_number']) == [4, 4]
+    assert list(output['glomeruli_voxel_number']) == [500, 500]
+    assert list(output['glomeruli_volume']) == [250, 250]
+    assert list(output['glomeruli_centroid_x']) == [15.0, 15.0]
+    assert list(output['glomeruli_centroid_z']) == [5.0, 5.0]
+
+
 def test_summarize_statistics(tmpdir):
     input_filename = os.path.join(os.path.dirname(__file__),
         'testdata/csv/Podocyte_detailed_stats_12-Oct-2018_12-02PM.csv')
@@ -31,3 +55,82 @@ def test_summarize_statistics(tmpdir):
     output = summarize_statistics(detailed_stats, output_filename)
     expected = pd.read_csv(expected_filename)
     assert output.all().all() == expected.all().all()
+
+
+def fake_podocyte_regions():
+    Region = collections.namedtuple('Region', ['label', 'area', 'centroid',
+                                               'equivalent_diameter'])
+    areas = [30, 45, 60]
+    return [Region(label, area, (2.0 + label, 5.5, 7.25 * label),
+                   (6 * area / np.pi) ** (1 / 3))
+            for label, area in zip([1, 2, 4], areas)]
+
+
+def test_statistics_accumulator():
+    glom = GlomerulusMeasurement(label=4, bbox=(0, 0, 0, 10, 20, 30),
+                                 centroid=(5.0, 10.0, 15.0), filled_area=500,
+                                 equivalent_diameter=9.8)
+    regions = fake_podocyte_regions()
+    centroid_offset = (3, 4, 5)
+    accumulator = StatisticsAccumulator('image.lif', 'Image:1', 'glom6')
+    assert accumulator.add_glomerulus(glom, [], centroid_offset, 0.5) == 0
+    for _ in range(2):
+        accumulator.add_glomerulus(glom, regions, centroid_offset, 0.5)
+    output = accumulator.to_dataframe()
+    expected = []
+    for glom_index in range(2):
+        df = podocyte_statistics(regions, centroid_offset, 0.5)
+        df = podocyte_avg_statistics(df)
+        df = glom_statistics(df, glom, glom_index, 0.5)
+        df['image_series_num'] = 'Image:1'
+        df['image_series_name'] = 'glom6'
+        df['image_filename'] = 'image.lif'
+        expected.append(df)
+    expected = pd.concat(expected, ignore_index=True)
+    assert len(accumulator) == 6
+    assert list(output.columns) == DETAILED_COLUMNS
+    pd.testing.assert_frame_equal(output, expected[DETAILED_COLUMNS],
+                                  check_dtype=False)
+
+
+def test_podocyte_statistics_label_counts():
+    label_image = np.zeros((10, 20, 20), dtype=np.int32)
+    label_image[1:4, 2:6, 3:8] = 1
+    label_image[5:9, 10:15, 12:19] = 3
+    label_image[2, 15:18, 1:4] = 7
+    centroid_offset = (3, 4, 5)
+    output = podocyte_statistics(count_labels(label_image), centroid_offset,
+                                 0.5)
+    expected = podocyte_statistics(regionprops(label_image), centroid_offset,
+                                   0.5)
+    pd.testing.assert_frame_equal(output, expected, check_dtype=False)
+
+
+def test_statistics_accumulator_empty():
+    accumulator = StatisticsAccumulator('image.lif', 'Image:1', 'glom6')
+    output = accumulator.to_dataframe()
+    assert len(output) == 0
+    assert list(output.columns) == DETAILED_COLUMNS
+
+
+def test_summarize_statistics_groupby(tmpdir):
+    input_filename = os.path.join(os.path.dirname(__file__),
+        'testdata/csv/Podocyte_detailed_stats_12-Oct-2018_12-02PM.csv')
+    output_filename = os.path.join(tmpdir, 'test_summary_stats.csv')
+    detailed_stats = pd.read_csv(input_filename)
+    output = summarize_statistics(detailed_stats, output_filename)
+    expected = detailed_stats[SUMMARY_COLUMNS].drop_duplicates()
+    expected.reset_index(drop=True, inplace=True)
+    pd.testing.assert_frame_equal(output, expected)
+
+
+def test_summarize_statistics_first_row(tmpdir):
+    input_filename = os.path.join(os.path.dirname(__file__),
+        'testdata/csv/Podocyte_detailed_stats_12-Oct-2018_12-02PM.csv')
+    output_filename = os.path.join(tmpdir, 'test_summary_stats.csv')
+    detailed_stats = pd.read_csv(input_filename)
+    detailed_stats['image_series_name'] = np.nan  # missing in a group column
+    detailed_stats.loc[0, 'podocyte_density'] = np.nan
+    output = summarize_statistics(detailed_stats, output_filename)
+    assert len(output) == 2
+    assert np.isnan(output['podocyte_density'][0])  # first row kept as is
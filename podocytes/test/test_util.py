@@ -7,7 +7,7 @@ import argparse
 from gooey.python_bindings.gooey_parser import GooeyParser
 
 from podocytes import __version__
-from podocytes.util import find_files, configure_parser_default
+from podocytes.util import find_files, configure_parser_default, parse_args
 
 
 def test_find_files():
@@ -31,3 +31,14 @@ def test_configure_parser_default():
                 'maximum_glomerular_diameter',
                 'file_extension'].sort()
     return output == expected
+
+
+def test_configure_parser_default_argparse():
+    parser = argparse.ArgumentParser()
+    parser = configure_parser_default(parser)  # no Gooey widget keywords
+    dummy_input = ['/test/input/dir', '/test/output/dir',
+                   '1', '2', '30.0', '300.0', '.lif']
+    args = parse_args(parser, dummy_input)
+    assert args.input_directory == '/test/input/dir'
+    assert args.glomeruli_channel_number == 0
+    assert args.podocyte_channel_number == 1
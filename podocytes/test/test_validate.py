@@ -87,6 +87,33 @@ def test_count_podocytes_in_label_image():
     assert output == expected
 
 
+def test_crop_multiple_images():
+    from podocytes.image_processing import (GroundTruthPoints,
+                                            crop_region_of_interest)
+    args = argparse.Namespace(glomeruli_channel_number=0,
+                              podocyte_channel_number=1)
+    rng = np.random.RandomState(0)
+    whole_image = rng.randint(0, 255, (8, 30, 30, 2)).astype(np.uint8)
+    whole_labels = np.zeros((8, 30, 30), dtype=np.int32)
+    whole_labels[2:6, 3:12, 20:28] = 1
+    points = GroundTruthPoints(np.array([[3, 5, 22]]), np.array([1]),
+                               whole_labels.shape)
+    bbox = (2, 3, 20, 6, 12, 28)  # margin runs past the image edges
+    cropped = validate.crop_multiple_images(args, whole_image, points,
+                                            whole_labels, bbox,
+                                            cropping_margin=4)
+    for channel, output in [(0, cropped.glomerulus_image),
+                            (1, cropped.podoyctes_image)]:
+        expected = crop_region_of_interest(whole_image[..., channel], bbox,
+                                           margin=4)
+        np.testing.assert_array_equal(output, expected)
+    expected = crop_region_of_interest(whole_labels, bbox, margin=4,
+                                       pad_mode='zeros')
+    np.testing.assert_array_equal(cropped.glomerulus_labels, expected)
+    assert cropped.ground_truth_image.shape == expected.shape
+    assert cropped.ground_truth_image.sum() == 1
+
+
 def test_match_filenames_1():
     xml_image_name = '51715_glom6.tif'
     image_filenames = ['/test/testdata/51715_glom6.tif',
@@ -1,13 +1,17 @@
 import os
 import time
 import logging
+import argparse
+import functools
+import xml.etree.ElementTree as ET
 
 import numpy as np
 import pandas as pd
-from gooey.python_bindings.gooey_decorator import Gooey as gooey
-from gooey.python_bindings.gooey_parser import GooeyParser
 
 from podocytes.__init__ import __version__
+from podocytes.output import OUTPUT_FORMATS
+
+MARKER_TAGS = ['MarkerX', 'MarkerY', 'MarkerZ']
 
 
 def find_files(input_directory, ext):
@@ -35,11 +39,52 @@ def find_files(input_directory, ext):
     return filelist
 
 
+def gooey(**gooey_kwargs):
+    """Gooey decorator, importing Gooey (and wx) only when it is called.
+
+    Modules with a Gooey user interface can then be imported on machines
+    without a display, for example by the podocytes.cli entry point.
+
+    Parameters
+    ----------
+    **gooey_kwargs : optional
+        Keyword arguments for the Gooey decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                import matplotlib
+                matplotlib.use('wxagg')  # same GUI toolkit as Gooey
+            except ImportError:
+                pass
+            from gooey.python_bindings.gooey_decorator import Gooey
+            return Gooey(**gooey_kwargs)(function)(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_argument(parser, *args, widget=None, **kwargs):
+    """Add argument to parser, with a Gooey widget if it is a GooeyParser.
+
+    Parameters
+    ----------
+    parser : argparse or Gooey parser object
+    *args, **kwargs :
+        Passed on to parser.add_argument.
+    widget : str, optional
+        Gooey widget name, eg: 'DirChooser'. Ignored by argparse parsers.
+    """
+    if widget is not None and not isinstance(parser, argparse.ArgumentParser):
+        kwargs['widget'] = widget
+    return parser.add_argument(*args, **kwargs)
+
+
 def configure_parser_default(parser):
-    parser.add_argument('input_directory', widget='DirChooser',
-                        help='Folder containing files for processing.')
-    parser.add_argument('output_directory', widget='DirChooser',
-                        help='Folder to save output analysis files.')
+    add_argument(parser, 'input_directory', widget='DirChooser',
+                 help='Folder containing files for processing.')
+    add_argument(parser, 'output_directory', widget='DirChooser',
+                 help='Folder to save output analysis files.')
     parser.add_argument('glomeruli_channel_number',
                         help='Fluorescence channel with glomeruli.',
                         type=int, default=1)
@@ -55,15 +100,110 @@ def configure_parser_default(parser):
     parser.add_argument('file_extension',
                         help='Extension of image file format (.tif, etc.)',
                         type=str, default='.lif')
+    add_argument(parser, '--cache_directory', widget='DirChooser',
+                 help='Folder to keep decoded images in, so they '
+                      'are faster to open next time (optional).',
+                 default=None)
+    parser.add_argument('--cache_size',
+                        help='Maximum size of the decoded image cache (GB).',
+                        type=float, default=100)
+    parser.add_argument('--precision', choices=['float32', 'float64'],
+                        help='Floating point precision for image processing. '
+                             'float32 uses half as much memory.',
+                        default='float32')
+    parser.add_argument('--cache_intermediates', action='store_true',
+                        help='Save denoised images and glomeruli labels in '
+                             'the output folder, and reuse them next time.')
+    return parser
+
+
+def configure_parser_main(parser):
+    """Add the podocyte counting arguments (podocytes.main) to parser."""
+    parser = configure_parser_default(parser)
+    parser.add_argument('--workers',
+                        help='Number of image series to process at once.',
+                        type=int, default=1)
+    parser.add_argument('--glomeruli_workers',
+                        help='Number of glomeruli to segment at once.',
+                        type=int, default=1)
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run, skipping image '
+                             'series that were already processed.')
+    parser.add_argument('--chunk_size',
+                        help='Process image volumes in chunks of this many '
+                             'voxels per side, for images larger than memory.',
+                        type=int, default=None)
+    parser.add_argument('--output_format',
+                        help='File format for the detailed statistics. '
+                             'Parquet and arrow need pyarrow installed.',
+                        choices=list(OUTPUT_FORMATS), default='csv')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record the time and memory used by each '
+                             'processing stage, saved next to the log file.')
+    parser.add_argument('--prefetch',
+                        help='Number of image series to read ahead from disk '
+                             'while the current one is processed '
+                             '(0 to turn off).',
+                        type=int, default=0)
+    parser.add_argument('--prefetch_memory',
+                        help='Maximum size of the image series read ahead '
+                             '(GB).',
+                        type=float, default=4)
     return parser
 
 
-def parse_args(parser):
+def configure_parser_validate(parser):
+    """Add the validation arguments (podocytes.validate) to parser."""
+    parser = configure_parser_default(parser)
+    parser.add_argument('xml_extension',
+                        help='Extension of image file format (.xml)',
+                        type=str, default='.xml')
+    add_argument(parser, 'counts_directory', widget='DirChooser',
+                 help='Folder containing Fiji CellCounter files.')
+    return parser
+
+
+def configure_parser_cellcounter(parser):
+    """Add the marker counting arguments (podocytes.cellcounter_xml)."""
+    add_argument(parser, 'input_directory', widget='DirChooser',
+                 help='Folder containing files for processing.')
+    add_argument(parser, 'output_directory', widget='DirChooser',
+                 help='Folder to save output analysis files.')
+    parser.add_argument('number_of_image_channels',
+                        help='Total number of color channels in image.',
+                        type=int, default=2)
+    parser.add_argument('--workers',
+                        help='Number of xml files to read at once.',
+                        type=int, default=1)
+    return parser
+
+
+def intermediate_directory(args):
+    """Directory for saved intermediate results, or None if not wanted.
+
+    Parameters
+    ----------
+    args : user input arguments
+
+    Returns
+    -------
+    directory : str or None
+        Filepath inside the output directory, if the user asked for
+        intermediate results to be cached, otherwise None.
+    """
+    if getattr(args, 'cache_intermediates', False):
+        return os.path.join(args.output_directory, 'intermediate_results')
+    return None
+
+
+def parse_args(parser, argv=None):
     """Parse user input and return arguments.
 
     Parameters
     ----------
     parser : argparse or Gooey parser object
+    argv : list of str, optional
+        Command line arguments. Default is sys.argv[1:].
 
     Returns
     -------
@@ -74,9 +214,10 @@ def parse_args(parser):
     User input arguments are expected to have 1-based indexing, so
     we convert to 0-based indexing for the python program logic.
     """
-    args = parser.parse_args()
-    args.glomeruli_channel_number = args.glomeruli_channel_number - 1
-    args.podocyte_channel_number = args.podocyte_channel_number - 1
+    args = parser.parse_args(argv)
+    if hasattr(args, 'glomeruli_channel_number'):
+        args.glomeruli_channel_number = args.glomeruli_channel_number - 1
+        args.podocyte_channel_number = args.podocyte_channel_number - 1
     return args
 
 
@@ -147,16 +288,94 @@ def log_file_ends(time_start, total_gloms_counted=None):
 
 
 def marker_coords(tree, n_channels):
-    """Parse CellCounter xml"""
-    df = pd.DataFrame()
+    """Parse CellCounter xml marker coordinates from a parsed xml tree.
+
+    Parameters
+    ----------
+    tree : xml.etree.ElementTree.ElementTree
+        Parsed CellCounter xml file.
+    n_channels : int
+        Total number of color channels in the image. CellCounter counts
+        each channel as a separate z slice.
+
+    Returns
+    -------
+    df : DataFrame
+        Marker coordinates, with 'Image_Filename', 'MarkerX', 'MarkerY'
+        and 'MarkerZ' columns.
+    """
     image_name = tree.find('.//Image_Filename').text
-    for marker in tree.findall('.//Marker'):
-        x_coord = int(marker.find('MarkerX').text)
-        y_coord = int(marker.find('MarkerY').text)
-        z_coord = np.floor(int(marker.find('MarkerZ').text) / n_channels)
-        contents = {'Image_Filename': image_name,
-                    'MarkerX': x_coord,
-                    'MarkerY': y_coord,
-                    'MarkerZ': z_coord}
-        df = df.append(contents, ignore_index=True)
+    coords = {tag: [] for tag in MARKER_TAGS}
+    for marker in tree.iter('Marker'):
+        for tag in MARKER_TAGS:
+            coords[tag].append(int(marker.find(tag).text))
+    df = _marker_dataframe(image_name, coords, n_channels)
+    return df
+
+
+def read_marker_coords(xml_filename, n_channels):
+    """Stream CellCounter xml marker coordinates from a file.
+
+    Parameters
+    ----------
+    xml_filename : str
+        CellCounter xml filename.
+    n_channels : int
+        Total number of color channels in the image, see marker_coords.
+
+    Returns
+    -------
+    df : DataFrame
+        Marker coordinates, the same as marker_coords returns.
+    """
+    image_name, coords = iterparse_markers(xml_filename)
+    df = _marker_dataframe(image_name, coords, n_channels)
+    return df
+
+
+def iterparse_markers(xml_filename):
+    """Read the image name and marker coordinates from a CellCounter file.
+
+    The file is read with iterparse in a single pass, and each marker
+    element is discarded once its coordinates are read, so the whole xml
+    tree is never held in memory.
+
+    Parameters
+    ----------
+    xml_filename : str
+        CellCounter xml filename.
+
+    Returns
+    -------
+    image_name : str
+        Image filename recorded in the CellCounter xml file.
+    coords : dict of ndarray
+        Marker coordinates (not adjusted for the number of channels),
+        for each of the 'MarkerX', 'MarkerY' and 'MarkerZ' tags.
+    """
+    image_name = None
+    coords = {tag: [] for tag in MARKER_TAGS}
+    for _, element in ET.iterparse(xml_filename):
+        if element.tag in coords:
+            coords[element.tag].append(int(element.text))
+        elif element.tag == 'Marker':
+            element.clear()
+        elif element.tag == 'Image_Filename':
+            image_name = element.text
+    coords = {tag: np.array(values, dtype=np.int64)
+              for tag, values in coords.items()}
+    return image_name, coords
+
+
+def _marker_dataframe(image_name, coords, n_channels):
+    """Marker coordinate DataFrame from lists of CellCounter coordinates."""
+    coords = {tag: np.asarray(values, dtype=np.int64)
+              for tag, values in coords.items()}
+    df = pd.DataFrame({
+        'Image_Filename': np.full(len(coords['MarkerX']), image_name,
+                                  dtype=object),
+        'MarkerX': coords['MarkerX'],
+        'MarkerY': coords['MarkerY'],
+        'MarkerZ': np.floor(coords['MarkerZ'] / n_channels),
+    })
     return df
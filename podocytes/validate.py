@@ -7,27 +7,28 @@ import xml.etree.ElementTree as ET
 
 import numpy as np
 import pandas as pd
-from skimage import io
-import matplotlib as mpl
-mpl.use('wxagg')
-import pims
-from gooey.python_bindings.gooey_decorator import Gooey as gooey
-from gooey.python_bindings.gooey_parser import GooeyParser
 
 from podocytes.__init__ import __version__
-from podocytes.util import (configure_parser_default,
+from podocytes.util import (configure_parser_validate,
+                            gooey,
                             parse_args,
                             find_files,
                             marker_coords,
                             log_file_begins,
-                            log_file_ends)
-from podocytes.image_processing import (crop_region_of_interest,
-                                        denoise_image,
+                            log_file_ends,
+                            intermediate_directory)
+from podocytes.image_processing import (count_labels,
+                                        crop_ground_truth,
                                         filter_by_size,
-                                        find_glomeruli,
                                         find_podocytes,
                                         gradient_of_image,
-                                        ground_truth_image)
+                                        ground_truth_image,
+                                        measure_glomerulus,
+                                        pad_region_of_interest,
+                                        region_of_interest_slices,
+                                        voxel_geometry)
+from podocytes.cache import denoise_image_cached, find_glomeruli_cached
+from podocytes.reader import ReaderPool, log_reader_metrics, open_image
 
 
 def main(args):
@@ -38,15 +39,21 @@ def main(args):
                                        args.xml_extension)
     logging.info(f"Found {len(cellcounter_filenames)} xml count files. ")
     all_statistics = []
-    for xml_filename in cellcounter_filenames:
-        xml_tree = ET.parse(xml_filename)
-        xml_image_name = xml_tree.find('.//Image_Filename').text
-        filename, image = open_matching_image(image_filenames, xml_image_name)
-        if image is not None:
-            image_validation_stats = validate_image(args, image, xml_tree)
-            image_validation_stats['image_filename'] = filename
-            image_validation_stats['xml_filename'] = xml_filename
-            all_statistics.append(image_validation_stats)
+    # Several CellCounter files often belong to the same image file,
+    # so image readers are kept open and reused.
+    with ReaderPool(cache_directory=getattr(args, 'cache_directory', None),
+                    cache_size=getattr(args, 'cache_size', 100)) as pool:
+        for xml_filename in cellcounter_filenames:
+            xml_tree = ET.parse(xml_filename)
+            xml_image_name = xml_tree.find('.//Image_Filename').text
+            filename, image = open_matching_image(image_filenames,
+                                                  xml_image_name, pool=pool)
+            if image is not None:
+                image_validation_stats = validate_image(args, image, xml_tree)
+                image_validation_stats['image_filename'] = filename
+                image_validation_stats['xml_filename'] = xml_filename
+                all_statistics.append(image_validation_stats)
+    log_reader_metrics()
     try:
         podocyte_comparison_stats = pd.concat(all_statistics,
                                               ignore_index=True, copy=False)
@@ -72,13 +79,9 @@ def configure_parser():
     args : argparse arguments
         Parsed user input arguments.
     """
+    from gooey.python_bindings.gooey_parser import GooeyParser
     parser = GooeyParser(prog='Podocyte Profiler', description=__DESCR__)
-    parser = configure_parser_default(parser)
-    parser.add_argument('xml_extension',
-                        help='Extension of image file format (.xml)',
-                        type=str, default='.xml')
-    parser.add_argument('counts_directory', widget='DirChooser',
-                        help='Folder containing Fiji CellCounter files.')
+    parser = configure_parser_validate(parser)
     args = parse_args(parser)
     return args
 
@@ -103,18 +106,27 @@ def validate_image(args, image, xml_tree, cropping_margin=10):
     ground_truth = cellcounter_ground_truth(xml_tree, image_shape)
     podocyte_number_ground_truth = len(ground_truth.dataframe)
     # Find glomeruli in the image ourselves
-    glomeruli_labels = find_glomeruli(image[..., args.glomeruli_channel_number])
+    precision = getattr(args, 'precision', 'float32')
+    glomeruli_view = image[..., args.glomeruli_channel_number]
+    geometry = voxel_geometry(glomeruli_view)
+    glomeruli_labels = find_glomeruli_cached(
+        glomeruli_view, intermediate_directory(args), dtype=precision,
+        geometry=geometry)
     glom_regions = filter_by_size(glomeruli_labels,
                                   args.minimum_glomerular_diameter,
-                                  args.maximum_glomerular_diameter)
+                                  args.maximum_glomerular_diameter,
+                                  geometry=geometry)
+    glom_regions = [measure_glomerulus(glom) for glom in glom_regions]
     logging.info(f"{len(glom_regions)} glomeruli identified.")
     # Count the podocytes
-    podocytes_view = denoise_image(image[..., args.podocyte_channel_number])
+    podocytes_view = denoise_image_cached(
+        image[..., args.podocyte_channel_number], intermediate_directory(args),
+        dtype=precision, geometry=geometry)
     single_image_stats = []
     for glom in glom_regions:
         cropped = crop_multiple_images(args,
                                        image,
-                                       ground_truth.image,
+                                       ground_truth.points,
                                        glomeruli_labels,
                                        glom.bbox,
                                        cropping_margin=cropping_margin)
@@ -122,9 +134,9 @@ def validate_image(args, image, xml_tree, cropping_margin=10):
         # Eg: multiple glomeruli can exist in one image, but we may only
         # have annotations for one of them.
         if np.sum(cropped.ground_truth_image) > 0:
-            podocyte_regions, centroid_offset, watershed = find_podocytes(
+            podocyte_counts, centroid_offset, watershed = find_podocytes(
                 podocytes_view, glom, cropping_margin=cropping_margin)
-            podocyte_number_counted = count_podocytes_in_label_image(watershed)
+            podocyte_number_counted = len(podocyte_counts.label)
             stats = comparison_statistics(glom,
                                           podocyte_number_ground_truth,
                                           podocyte_number_counted)
@@ -154,7 +166,8 @@ def comparison_statistics(glom_region,
 
     Parameters
     ----------
-    glom_region : skimage regionprops object representing the glomerulus.
+    glom_region : GlomerulusMeasurement or skimage regionprops object
+        representing the glomerulus.
     podocyte_number_ground_truth : number of podocytes in CellCounter xml file.
     podocyte_number_counted : number of podocytes counted by this software.
 
@@ -193,9 +206,7 @@ def count_podocytes_in_label_image(label_image):
     podocyte_number : int
         Number of podocytes in the label image.
     """
-    label_set = set(label_image.ravel())
-    label_set.remove(0)  # excludes zero label
-    podocyte_number = len(label_set)
+    podocyte_number = len(count_labels(label_image).label)
     return podocyte_number
 
 
@@ -216,6 +227,8 @@ def save_validation_images(args, podocyte_watershed, cropped,
     -------
     output_fname : filename where output validation images are saved.
     """
+    from skimage import io  # only needed to save validation images
+
     cellcounter_clicks = (cropped.ground_truth_image > 0) * 255
     glomerulus_mask = (cropped.glomerulus_labels > 0) * 255
     # ImageJ expects input in 'zcyx' format
@@ -245,18 +258,20 @@ def cellcounter_ground_truth(xml_tree, image_shape):
 
     Returns
     -------
-    ground_truth :named tuple with ground_truth.dataframe, ground_truth.image
+    ground_truth : named tuple with ground_truth.dataframe and
+        ground_truth.points (sparse ground truth, see ground_truth_image).
     """
     ground_truth_dataframe = marker_coords(xml_tree, 2)
     columns = ['MarkerZ', 'MarkerY', 'MarkerX']
-    ground_truth_img = ground_truth_image(
-        ground_truth_dataframe[columns].values, image_shape)
+    ground_truth_points = ground_truth_image(
+        ground_truth_dataframe[columns].values, image_shape, sparse=True)
     ground_truth = collections.namedtuple("ground_truth",
-                                          ["dataframe", "image"])
-    return ground_truth(ground_truth_dataframe, ground_truth_img)
+                                          ["dataframe", "points"])
+    return ground_truth(ground_truth_dataframe, ground_truth_points)
 
 
-def open_matching_image(image_filenames, xml_image_name):
+def open_matching_image(image_filenames, xml_image_name,
+                        cache_directory=None, cache_size=100, pool=None):
     """Find image matching CellCounter xml file and return opened image.
 
     Parameters
@@ -265,6 +280,13 @@ def open_matching_image(image_filenames, xml_image_name):
         List of all image filesnames to search for match.
     xml_image_name : str
         Name to match, recorded in CellCounter xml file.
+    cache_directory : str, optional
+        Location of the decoded image cache, see reader.open_image.
+    cache_size : float, optional
+        Maximum total size of the image cache, in gigabytes.
+    pool : ReaderPool, optional
+        Open image readers to reuse. If given, the cache_directory and
+        cache_size of the pool are used instead.
 
     Returns
     -------
@@ -272,7 +294,10 @@ def open_matching_image(image_filenames, xml_image_name):
     """
     filename = match_filenames(image_filenames, xml_image_name)
     if filename:
-        images = pims.Bioformats(filename)
+        if pool is not None:
+            images = pool.open(filename)
+        else:
+            images = open_image(filename, cache_directory, cache_size)
         image_series_index = match_image_index(images,
                                                xml_image_name,
                                                os.path.basename(filename))
@@ -343,7 +368,7 @@ def match_image_index(images, xml_image_name, basename):
 
 def crop_multiple_images(args,
                          whole_image,
-                         whole_ground_truth_image,
+                         ground_truth_points,
                          whole_glomeruli_labels,
                          bounding_box,
                          cropping_margin=10):
@@ -353,7 +378,8 @@ def crop_multiple_images(args,
     ----------
     args : User input arguments
     whole_image : grayscale image of whole image
-    whole_ground_truth_image :
+    ground_truth_points : GroundTruthPoints
+        Sparse ground truth markers, see cellcounter_ground_truth.
     whole_glomeruli_labels : label image of glomeruli regions, filtered by size
     bounding_box : tuple
         Bounding box coordinates as tuple.
@@ -372,24 +398,21 @@ def crop_multiple_images(args,
         cropped.podoyctes_image, cropped.glomerulus_image,
         and cropped.glomerulus_labels.
     """
-    whole_glomeruli_view = whole_image[..., args.glomeruli_channel_number]
-    whole_podocytes_view = whole_image[..., args.podocyte_channel_number]
-    ground_truth_image = crop_region_of_interest(whole_ground_truth_image,
-                                                 bounding_box,
-                                                 margin=cropping_margin,
-                                                 pad_mode='zeros')
-    podoyctes_image = crop_region_of_interest(whole_podocytes_view,
-                                              bounding_box,
-                                              margin=cropping_margin,
-                                              pad_mode='mean')
-    glomeruli_image = crop_region_of_interest(whole_glomeruli_view,
-                                              bounding_box,
-                                              margin=cropping_margin,
-                                              pad_mode='mean')
-    glomeruli_labels = crop_region_of_interest(whole_glomeruli_labels,
-                                               bounding_box,
-                                               margin=cropping_margin,
-                                               pad_mode='zeros')
+    # One slice computation shared by all the cropped images
+    image_slicer, pad_width = region_of_interest_slices(
+        whole_glomeruli_labels.shape, bounding_box, margin=cropping_margin)
+    image_roi = whole_image[image_slicer]  # all channels, no copy
+    ground_truth_image = crop_ground_truth(ground_truth_points,
+                                           bounding_box,
+                                           margin=cropping_margin)
+    podoyctes_image = pad_region_of_interest(
+        image_roi[..., args.podocyte_channel_number], pad_width,
+        pad_mode='mean')
+    glomeruli_image = pad_region_of_interest(
+        image_roi[..., args.glomeruli_channel_number], pad_width,
+        pad_mode='mean')
+    glomeruli_labels = pad_region_of_interest(
+        whole_glomeruli_labels[image_slicer], pad_width, pad_mode='zeros')
     cropped = collections.namedtuple("cropped", ["ground_truth_image",
                                                  "podoyctes_image",
                                                  "glomerulus_image",
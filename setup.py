@@ -11,7 +11,7 @@ URL                 = 'https://github.com/jni/podocytes'
 LICENSE             = 'BSD 3-clause'
 DOWNLOAD_URL        = 'https://github.com/jni/podocytes'
 VERSION             = '0.0.1-dev'
-PYTHON_VERSION      = (3, 6)
+PYTHON_VERSION      = (3, 7)
 INST_DEPENDENCIES   = []
 
 
@@ -33,7 +33,7 @@ if __name__ == '__main__':
             'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
             'Programming Language :: Python',
             'Programming Language :: Python :: 3',
-            'Programming Language :: Python :: 3.6',
+            'Programming Language :: Python :: 3.7',
             'Topic :: Scientific/Engineering',
             'Operating System :: Microsoft :: Windows',
             'Operating System :: POSIX',
@@ -43,8 +43,10 @@ if __name__ == '__main__':
         packages=['podocytes'],
         package_data={},
         install_requires=INST_DEPENDENCIES,
+        python_requires='>={}.{}'.format(*PYTHON_VERSION),
         entry_points = {
-            'console_scripts': ['convert-lif=podocytes.main:main']
+            'console_scripts': ['convert-lif=podocytes.main:main',
+                                'podocytes=podocytes.cli:main']
         }
     )
 